@@ -18,13 +18,13 @@
 ###############################################################################
 
 from __future__ import absolute_import
-from ftplib import FTP
 import logging
 import os
 import datetime
 import re
 import shutil
 from django.conf import settings
+from dataqs.ftp_helpers import get_ftp_client
 from dataqs.processor_base import GeoDataMosaicProcessor
 from dataqs.helpers import warp_image, style_exists
 
@@ -85,11 +85,9 @@ Data Exchange Guidelines at http://airnowapi.org/docs/DataUseGuidelines.pdf.
         :param days:
         :return:
         """
-        ftp = FTP(self.base_url)
         username, pwd = auth_account.split(":")
-        ftp.login(username, pwd)
-        ftp.cwd('GRIB2')
-        file_list = ftp.nlst()
+        client = get_ftp_client(self.base_url, username, pwd)
+        file_list = client.nlst('GRIB2')
         dl_files = []
         for pattern in self.img_patterns:
             time_rx = "\d{8}" if days == 1 else "\d{6}12"
@@ -97,12 +95,10 @@ Data Exchange Guidelines at http://airnowapi.org/docs/DataUseGuidelines.pdf.
             re_1day = re.compile(time_pattern)
             files = sorted([x for x in file_list if re_1day.search(x)])[-days:]
             for file_1day in files:
-                filename = '{}_{}'.format(self.prefix, file_1day)
-                with open(os.path.join(self.tmp_dir, filename),
-                          'wb') as outfile:
-                    ftp.retrbinary('RETR %s' % file_1day, outfile.write)
-                dl_files.append(filename)
-        return dl_files
+                dl_files.append((file_1day, os.path.join(
+                    self.tmp_dir, '{}_{}'.format(self.prefix, file_1day))))
+        client.retrieve_many('GRIB2', dl_files)
+        return [os.path.basename(outfile) for _, outfile in dl_files]
 
     def parse_name(self, imgname):
         """
@@ -23,12 +23,13 @@ import os
 import datetime
 from django.test import TestCase
 from dataqs.airnow.airnow import AirNowGRIB2HourlyProcessor
-from mock import patch
+from dataqs.ftp_helpers import FTPClient
+from mock import call, patch
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
 
-def mock_retrbinary(self, name, writer):
+def mock_retrbinary(self, name, writer, *args):
     """
     Mocks the ftplib.FTP.retrbinary method, writes test image to disk.
     """
@@ -78,6 +79,7 @@ class AirNowTest(TestCase):
     @patch('ftplib.FTP.nlst', mock_nlst)
     @patch('ftplib.FTP.connect', mock_none)
     @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
     @patch('ftplib.FTP.cwd', mock_none)
     def test_download(self, mock_ftp):
         """
@@ -97,6 +99,7 @@ class AirNowTest(TestCase):
     @patch('ftplib.FTP.nlst', mock_nlst)
     @patch('ftplib.FTP.connect', mock_none)
     @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
     @patch('ftplib.FTP.cwd', mock_none)
     def test_download_multiple_days(self, mock_ftp):
         """
@@ -130,6 +133,7 @@ class AirNowTest(TestCase):
     @patch('ftplib.FTP.nlst', mock_nlst)
     @patch('ftplib.FTP.connect', mock_none)
     @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
     @patch('ftplib.FTP.cwd', mock_none)
     def test_convert_image(self, mock_ftp):
         """
@@ -146,6 +150,7 @@ class AirNowTest(TestCase):
     @patch('ftplib.FTP.nlst', mock_nlst)
     @patch('ftplib.FTP.connect', mock_none)
     @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
     @patch('ftplib.FTP.cwd', mock_none)
     def test_cleanup(self, mock_ftp):
         """
@@ -158,3 +163,44 @@ class AirNowTest(TestCase):
         self.processor.cleanup()
         self.assertEquals([], glob.glob(os.path.join(
             self.processor.tmp_dir, self.processor.prefix + '*')))
+
+    @patch('dataqs.ftp_helpers.FTP')
+    def test_ftp_client(self, mock_ftp):
+        """
+        Verify that FTP sessions and directory listings are reused
+        """
+        mock_ftp.return_value.nlst.side_effect = lambda: mock_nlst(None)
+        mock_ftp.return_value.retrbinary.side_effect = \
+            lambda cmd, writer, *args: mock_retrbinary(None, cmd, writer)
+        client = FTPClient(self.processor.base_url)
+        file_list = client.nlst('GRIB2')
+        self.assertEquals(file_list, client.nlst('GRIB2'))
+        self.assertEquals(1, mock_ftp.return_value.nlst.call_count)
+        outfile = os.path.join(self.processor.tmp_dir,
+                               '{}_{}'.format(self.processor.prefix,
+                                              file_list[0]))
+        client.retrieve('GRIB2', file_list[0], outfile)
+        self.assertTrue(os.path.exists(outfile))
+        self.assertFalse(os.path.exists(outfile + '.part'))
+        # One login for both the listing and the transfer
+        self.assertEquals(1, mock_ftp.call_count)
+
+    @patch('dataqs.ftp_helpers.FTP')
+    def test_ftp_session_cwd(self, mock_ftp):
+        """
+        Verify that a reused session returns to the login directory
+        before changing to a relative path
+        """
+        mock_ftp.return_value.pwd.return_value = '/home/airnow'
+        client = FTPClient(self.processor.base_url)
+        with client.session('GRIB2'):
+            pass
+        with client.session('GRIB2'):
+            pass
+        with client.session('/pub'):
+            pass
+        self.assertEquals(1, mock_ftp.call_count)
+        self.assertEquals(
+            [call('GRIB2'), call('/home/airnow'), call('GRIB2'),
+             call('/pub')],
+            mock_ftp.return_value.cwd.call_args_list)
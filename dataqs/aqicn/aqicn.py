@@ -22,18 +22,19 @@ import logging
 import os
 import sys
 import re
+import threading
 import time
 from multiprocessing.pool import ThreadPool
-from random import randint
 
-import requests
+import lxml.html
 from bs4 import BeautifulSoup as bs
 import datetime
 import traceback
 from dateutil.parser import parse
 from dateutil.tz import tzutc
 from dataqs.helpers import postgres_query, layer_exists, table_exists, \
-    style_exists, asciier
+    style_exists, asciier, postgres_transaction
+from dataqs.http_helpers import HostLimiter, PooledSession
 from dataqs.processor_base import GeoDataProcessor, DEFAULT_WORKSPACE
 from geonode.geoserver.helpers import ogc_server_settings
 
@@ -41,6 +42,8 @@ logger = logging.getLogger("dataqs.processors")
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
+MAP_DATA_REGEX = re.compile(r'(?<=mapInitWithData\()\[\{[^;]*\}\]')
+
 REQ_HEADER = {
     'Accept': 'text/html,application/xhtml+xml,application/xml;'
               'q=0.9,image/webp,*/*;q=0.8',
@@ -49,19 +52,23 @@ REQ_HEADER = {
                   'Safari/537.36'
 }
 
-AQICN_SQL = u"""
-DELETE FROM {table} where city = '{city}';
-INSERT INTO {table}
-(datetime, lat, lng, city, {keys}, country, the_geom)
- SELECT '{time}', {lat}, {lng}, '{city}', {val}, '{cntry}',
- ST_GeomFromText('POINT({lng} {lat})',4326) WHERE NOT EXISTS (
- SELECT 1 from {table} WHERE city = '{city}');
-DELETE FROM {table}_archive where city = '{city}' and datetime = '{time}';
-INSERT INTO {table}_archive
-(datetime, lat, lng, city, {keys}, country, the_geom)
- SELECT '{time}', {lat}, {lng}, '{city}', {val}, '{cntry}',
- ST_GeomFromText('POINT({lng} {lat})',4326) WHERE NOT EXISTS (
- SELECT 1 from {table}_archive WHERE city = '{city}' and datetime = '{time}');
+AQICN_MEASUREMENTS = ('aqi', 'co', 'd', 'h', 'no2', 'o3', 'p', 'pm10', 'pm25',
+                      'r', 'so2', 't', 'uvi', 'w')
+
+AQICN_COLUMNS = ('datetime', 'lat', 'lng', 'city', 'country') + \
+    AQICN_MEASUREMENTS
+
+AQICN_UPSERT_SQL = u"""
+INSERT INTO {table} ({columns}, the_geom) VALUES {rows}
+ON CONFLICT ({key}) DO UPDATE SET {updates};
+"""
+
+# Remove duplicates left by the old delete/insert statements, so that
+# the unique index needed by ON CONFLICT can be created
+AQICN_UNIQUE_SQL = u"""
+DELETE FROM {table} a USING {table} b
+ WHERE {join} AND a.id < b.id;
+CREATE UNIQUE INDEX IF NOT EXISTS {table}_{name}_key ON {table}({key});
 """
 
 AQICN_TABLE = u"""
@@ -99,83 +106,165 @@ CREATE INDEX {table}_the_geom ON {table} USING gist (the_geom);
 """
 
 
-def thread_parse(table, cities):
+class AQICNWriter(object):
     """
-    Thread worker for a list of cities
+    Collect scraped cities and write them to the live and archive tables
+    in batches, with one multi-row INSERT ... ON CONFLICT per table.
+    A batch is written once it holds 'batch_size' cities, or when a city is
+    added 'max_wait' seconds or more after the last write.
     """
-    aqi_parser = AQICNWorker(table, cities)
-    aqi_parser.run()
+
+    def __init__(self, table, batch_size=100, max_wait=60):
+        self.table = table
+        self.archive = table + "_archive"
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.rows = {}
+        self.last_flush = time.time()
+        self.saved = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        for tablename, key in ((self.table, ('city',)),
+                               (self.archive, ('city', 'datetime'))):
+            if not table_exists(tablename):
+                postgres_query(AQICN_TABLE.format(table=tablename),
+                               commit=True)
+            self.create_unique_index(tablename, key)
+
+    @staticmethod
+    def create_unique_index(table, key):
+        name = '_'.join(key)
+        if postgres_query(
+                "SELECT 1 FROM pg_indexes WHERE indexname = %s;",
+                params=('{}_{}_key'.format(table, name),), returnable=True):
+            return
+        postgres_query(AQICN_UNIQUE_SQL.format(
+            table=table, name=name, key=', '.join(key),
+            join=' AND '.join('a.{0} = b.{0}'.format(k) for k in key)),
+            commit=True)
+
+    @staticmethod
+    def to_int(value):
+        try:
+            return int(round(float(value)))
+        except (TypeError, ValueError):
+            return None
+
+    def city_row(self, city):
+        """
+        Convert a scraped city to a tuple of column values
+        :param city: city dict from AQICNWorker.handle_city
+        :return: tuple in AQICN_COLUMNS order
+        """
+        data = dict((key[4:], value) for key, value in city['data'].items())
+        unknown = set(data.keys()).difference(AQICN_MEASUREMENTS)
+        if unknown:
+            logger.debug("Ignoring {} for {}".format(
+                ','.join(unknown), city['city']))
+        return (city['dateTime'].strftime('%Y-%m-%d %H:%M:%S'),
+                float(city['g'][0]), float(city['g'][1]),
+                unicode(city['city']),
+                city['country']) + tuple(
+            self.to_int(data.get(key)) for key in AQICN_MEASUREMENTS)
+
+    def add(self, city):
+        """
+        Queue a city to be saved, writing the batch if it is due
+        :param city: city dict from AQICNWorker.handle_city
+        """
+        row = self.city_row(city)
+        with self._lock:
+            # Later values for the same city and time replace earlier ones
+            self.rows[(row[3], row[0])] = row
+            due = len(self.rows) >= self.batch_size or \
+                time.time() - self.last_flush >= self.max_wait
+        if due:
+            self.flush()
+
+    def upsert(self, table, rows, key):
+        values = u"(%s, {}ST_SetSRID(ST_MakePoint(%s, %s), 4326))".format(
+            u"%s, " * (len(AQICN_COLUMNS) - 1))
+        params = []
+        for row in rows:
+            params.extend(row)
+            params.extend((row[2], row[1]))
+        postgres_query(AQICN_UPSERT_SQL.format(
+            table=table,
+            columns=', '.join(AQICN_COLUMNS),
+            rows=', '.join([values] * len(rows)),
+            key=', '.join(key),
+            updates=', '.join('{0} = EXCLUDED.{0}'.format(column) for column
+                              in AQICN_COLUMNS + ('the_geom',)
+                              if column not in key)), params=params)
+
+    def flush(self):
+        """
+        Write all queued cities
+        :return: number of cities written
+        """
+        with self._lock:
+            rows = sorted(self.rows.values(), key=lambda r: (r[3], r[0]))
+            self.rows = {}
+            self.last_flush = time.time()
+        if not rows:
+            return 0
+        # The live table holds only the latest time for each city
+        latest = {}
+        for row in rows:
+            latest[row[3]] = row
+        # One batch at a time, so concurrent flushes never deadlock
+        with self._flush_lock:
+            with postgres_transaction():
+                self.upsert(self.table, [
+                    latest[city] for city in sorted(latest)], ('city',))
+                self.upsert(self.archive, rows, ('city', 'datetime'))
+            self.saved += len(rows)
+        logger.debug("Saved {} cities".format(len(rows)))
+        return len(rows)
 
 
 class AQICNWorker(object):
-    def __init__(self, table, cities):
+    def __init__(self, table, cities, session=None, limiter=None,
+                 writer=None):
         self.cities = cities
         self.prefix = table
         self.archive = self.prefix + "_archive"
         self.max_wait = 5
-        if not table_exists(self.archive):
-            postgres_query(AQICN_TABLE.format(table=self.archive), commit=True)
+        self.session = session or PooledSession(timeout=60)
+        self.limiter = limiter or HostLimiter(rate=1.0 / self.max_wait)
+        self.writer = writer or AQICNWriter(table)
+
+    def fetch(self, url):
+        """
+        Retrieve a page, waiting for the per-host rate limit
+        :param url: URL of page
+        :return: response
+        """
+        with self.limiter.limit(url):
+            page = self.session.get(url, timeout=60, headers=REQ_HEADER)
+        page.raise_for_status()
+        return page
 
     def handle_city(self, i, city):
+        """
+        Scrape and save the current measurements for a city
+        :param i: Index of city in list
+        :param city: dict of city name, country and url
+        :return: True if measurements were saved
+        """
         try:
             logger.debug('Scraping %d of %d cities - %s' % (
                 i + 1, len(self.cities), city['url']))
-            time.sleep(randint(1, self.max_wait))
-            page = requests.get(city['url'], timeout=60, headers=REQ_HEADER)
-            page.raise_for_status()
-            soup = bs(page.text, "lxml")
-
-            aqi_div = soup.find('div', class_='aqivalue')
-            if not aqi_div:
-                logger.error('No AQI for {}'.format(city['url']))
-                return
-            aqi = aqi_div.text
-            if not aqi.isdigit():
-                logger.error('AQI is not a number - {}'.format(city['url']))
-                return
-
-            time_div = soup.find('span', id=re.compile(r'aqiwgtutime.*'))
-            if time_div:
-                city['utime'] = time_div.text
-            else:
-                logger.error('No date/time: {}'.format(city['url']))
-                return
-
-            map_string = re.search(
-                '(?<=mapInitWithData\()\[\{[^;]*\}\]', soup.text).group(0)
-            map_json = json.loads(map_string.strip('\n'))
-            for item in map_json:
-                if re.search(u'{}(,|$)'.format(asciier(city['city']).lower()),
-                             asciier(item['city']).lower()):
-                    for key in ['tz', 'g']:
-                        city[key] = item[key]
-                    break
-            if 'utime' not in city:
-                logger.error('No data for {}'.format(city['url']))
+            page = self.fetch(city['url'])
+            if not self.parse_city(page.text, city):
                 return
-            city['dateTime'] = self.get_time(city)
-            city["data"] = {}
-            cur_list = soup.find_all("td", {"id": re.compile('^cur_')})
-            # Go on to the next city if we don't find anything
-            if not cur_list:
-                logger.debug("Nothing found for %s" % city['city'])
-                return
-            # Loop through all the variables for this city
-            saved_vars = ""
-            for cur in cur_list:
-                curId = cur['id']
-                saved_vars += curId + ","
-                if type(cur.contents[0]).__name__ == 'Tag':
-                    city['data'][curId] = cur.contents[0].text
-                else:
-                    city['data'][curId] = cur.contents[0]
-            city['data']['cur_aqi'] = aqi
             self.save_data(city)
             logger.debug("Saved %s aqi for city %s" % (
-                saved_vars, city['city']))
+                ','.join(city['data'].keys()), city['city']))
             # Clear out the city to reduce memory footprint
             for key in city.keys():
                 city.pop(key, None)
+            return True
 
         except KeyboardInterrupt:
             sys.exit()
@@ -183,30 +272,79 @@ class AQICNWorker(object):
             logger.error('Error with city {}'.format(city['url']))
             logger.error(traceback.format_exc())
 
+    @staticmethod
+    def parse_city(html, city):
+        """
+        Extract the current measurements for a city from its page, adding
+        'utime', 'tz', 'g', 'dateTime' and 'data' to the city dict.  Only the
+        nodes needed are visited, via XPath on an lxml tree.
+        :param html: Page content
+        :param city: dict of city name, country and url
+        :return: True if measurements were found
+        """
+        tree = lxml.html.fromstring(html)
+
+        aqi_div = tree.xpath(
+            '(//div[contains(concat(" ", normalize-space(@class), " "), '
+            '" aqivalue ")])[1]')
+        if not aqi_div:
+            logger.error('No AQI for {}'.format(city['url']))
+            return False
+        aqi = aqi_div[0].text_content()
+        if not aqi.isdigit():
+            logger.error('AQI is not a number - {}'.format(city['url']))
+            return False
+
+        time_div = tree.xpath('(//span[starts-with(@id, "aqiwgtutime")])[1]')
+        if time_div:
+            city['utime'] = time_div[0].text_content()
+        else:
+            logger.error('No date/time: {}'.format(city['url']))
+            return False
+
+        map_string = None
+        for script in tree.xpath(
+                '//script[contains(text(), "mapInitWithData")]/text()'):
+            match = MAP_DATA_REGEX.search(script)
+            if match:
+                map_string = match.group(0)
+                break
+        if not map_string:
+            logger.error('No map data for {}'.format(city['url']))
+            return False
+        map_json = json.loads(map_string.strip('\n'))
+        for item in map_json:
+            if re.search(u'{}(,|$)'.format(asciier(city['city']).lower()),
+                         asciier(item['city']).lower()):
+                for key in ['tz', 'g']:
+                    city[key] = item[key]
+                break
+        if 'tz' not in city:
+            logger.error('No data for {}'.format(city['url']))
+            return False
+        city['dateTime'] = AQICNWorker.get_time(city)
+        city["data"] = {}
+        cur_list = tree.xpath('//td[starts-with(@id, "cur_")]')
+        # Go on to the next city if we don't find anything
+        if not cur_list:
+            logger.debug("Nothing found for %s" % city['city'])
+            return False
+        # Loop through all the variables for this city
+        for cur in cur_list:
+            if cur.text is None and len(cur):
+                city['data'][cur.get('id')] = cur[0].text_content()
+            else:
+                city['data'][cur.get('id')] = cur.text
+        city['data']['cur_aqi'] = aqi
+        return True
+
     def save_data(self, city):
-        for item in city['data']:
-            if city['data'][item] == '-':
-                city['data'][item] = 'NULL'
-        measurements = ','.join(x[4:] for x in city['data'].keys())
-        values = ','.join(
-            [x for x in city['data'].values()])
-        city_name = unicode(city['city'])
-        kv = ','.join(['{} = {}'.format(k, v) for k, v in zip(
-            [x[4:] for x in city['data'].keys()],
-            [x for x in city['data'].values()]
-        )])
-        sql_str = unicode(AQICN_SQL.format(
-            table=self.prefix,
-            time=city['dateTime'].strftime('%Y-%m-%d %H:%M:%S'),
-            lat=city['g'][0],
-            lng=city['g'][1],
-            city=city_name.replace('\'', '\'\''),
-            keys=measurements,
-            val=values,
-            kv=kv,
-            cntry=city['country']
-        ))
-        postgres_query(sql_str, commit=True)
+        """
+        Queue a city's measurements to be written with the next batch.
+        Missing ('-') or non-numeric measurements are saved as NULL.
+        :param city: city dict
+        """
+        self.writer.add(city)
 
     @staticmethod
     def get_time(city):
@@ -234,6 +372,7 @@ class AQICNWorker(object):
                 self.handle_city(i, city)
             else:
                 logger.warn('No url for {}'.format(city))
+        self.writer.flush()
         logger.debug("End %s" % str(datetime.datetime.now()))
 
 
@@ -242,7 +381,12 @@ class AQICNProcessor(GeoDataProcessor):
     directory = 'output'
     cities = None
     countries = None
+    # Maximum concurrent requests, and new requests per second, to aqicn.org
     pool_size = 6
+    rate = 2.0
+    # Cities per database write, and maximum seconds between writes
+    batch_size = 100
+    batch_wait = 60
     base_url = 'http://aqicn.org/city/all/'
     layers = {
         'aqi': 'Air Quality Index',
@@ -296,14 +440,6 @@ class AQICNProcessor(GeoDataProcessor):
                         'url': citylink.get('href')})
                     citylink = citylink.findNext('a')
 
-    def split_list(self, num):
-        """ Yield n successive lists from cities list.
-        """
-        newn = int(1.0 * len(self.cities) / num + 0.5)
-        for i in xrange(0, num - 1):
-            yield self.cities[i * newn:i * newn + newn]
-        yield self.cities[num * newn - newn:]
-
     def process(self):
         if not table_exists(self.prefix):
             postgres_query(AQICN_TABLE.format(table=self.prefix), commit=True)
@@ -311,11 +447,36 @@ class AQICNProcessor(GeoDataProcessor):
         if not self.cities:
             self.getCities()
         logger.debug("There are %s cities" % str(len(self.cities)))
+        # All threads share one keep-alive session and one rate limit,
+        # and take the next city as soon as they are free
+        writer = AQICNWriter(self.prefix, batch_size=self.batch_size,
+                             max_wait=self.batch_wait)
+        worker = AQICNWorker(
+            self.prefix, self.cities,
+            session=PooledSession(pool_size=self.pool_size, timeout=60),
+            limiter=HostLimiter(rate=self.rate,
+                                max_concurrent=self.pool_size),
+            writer=writer)
+        cities = [(i, city) for i, city in enumerate(self.cities)
+                  if 'url' in city]
+        start = time.time()
+        saved = 0
         pool = ThreadPool(self.pool_size)
-        for citylist in self.split_list(self.pool_size):
-            pool.apply_async(thread_parse, args=(self.prefix, citylist))
-        pool.close()
-        pool.join()
+        try:
+            for done, result in enumerate(pool.imap_unordered(
+                    lambda args: worker.handle_city(*args), cities), 1):
+                if result:
+                    saved += 1
+                if done % 100 == 0 or done == len(cities):
+                    minutes = max(time.time() - start, 1) / 60.0
+                    logger.info(
+                        "Scraped {} of {} cities ({} saved), "
+                        "{:.1f} cities/minute".format(
+                            done, len(cities), saved, done / minutes))
+        finally:
+            pool.close()
+            pool.join()
+            writer.flush()
 
     def run(self):
         self.process()
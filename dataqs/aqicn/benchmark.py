@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc. and Epidemico Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Compare the XPath city page extractor of AQICNWorker with the original
+BeautifulSoup version on the bundled Boston test page.
+
+    python -m dataqs.aqicn.benchmark --iterations 200
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import re
+import time
+
+from bs4 import BeautifulSoup as bs
+from dataqs.aqicn.aqicn import AQICNWorker
+from dataqs.helpers import asciier
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+
+BOSTON = {'city': u'Boston', 'country': u'USA',
+          'url': u'http://aqicn.org/city/boston/'}
+
+
+def soup_parse_city(html, city):
+    """
+    The original BeautifulSoup extraction, for comparison
+    """
+    soup = bs(html, "lxml")
+    aqi = soup.find('div', class_='aqivalue').text
+    city['utime'] = soup.find('span', id=re.compile(r'aqiwgtutime.*')).text
+    # soup.text skips <script> contents in newer versions of bs4
+    scripts = '\n'.join(script.string or '' for script in soup.find_all(
+        'script'))
+    map_string = re.search(
+        '(?<=mapInitWithData\()\[\{[^;]*\}\]', scripts).group(0)
+    for item in json.loads(map_string.strip('\n')):
+        if re.search(u'{}(,|$)'.format(asciier(city['city']).lower()),
+                     asciier(item['city']).lower()):
+            for key in ['tz', 'g']:
+                city[key] = item[key]
+            break
+    city['dateTime'] = AQICNWorker.get_time(city)
+    city['data'] = {}
+    for cur in soup.find_all("td", {"id": re.compile('^cur_')}):
+        if type(cur.contents[0]).__name__ == 'Tag':
+            city['data'][cur['id']] = cur.contents[0].text
+        else:
+            city['data'][cur['id']] = cur.contents[0]
+    city['data']['cur_aqi'] = aqi
+    return True
+
+
+def time_parser(parse, html, iterations):
+    city = None
+    start = time.time()
+    for _ in xrange(iterations):
+        city = dict(BOSTON)
+        parse(html, city)
+    return time.time() - start, city
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='Number of times to parse the page')
+    args = parser.parse_args()
+
+    with open(os.path.join(
+            script_dir, 'resources/test_aqicn_boston.html')) as infile:
+        html = infile.read().decode('utf-8')
+
+    results = {}
+    for name, parse in (('beautifulsoup', soup_parse_city),
+                        ('xpath', AQICNWorker.parse_city)):
+        elapsed, city = time_parser(parse, html, args.iterations)
+        results[name] = city
+        print('{}: {:.2f} ms/page ({:.0f} pages/s)'.format(
+            name, elapsed * 1000 / args.iterations,
+            args.iterations / max(elapsed, 0.001)))
+    if results['beautifulsoup']['data'] != results['xpath']['data']:
+        print('WARNING: extracted measurements differ')
+
+
+if __name__ == '__main__':
+    main()
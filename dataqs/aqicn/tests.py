@@ -20,9 +20,12 @@
 import json
 import os
 import datetime
+import time
 from django.test import TestCase
 import dataqs
-from dataqs.aqicn.aqicn import AQICNProcessor
+from dataqs.aqicn.aqicn import AQICNProcessor, AQICNWriter, \
+    AQICN_MEASUREMENTS
+from dataqs.http_helpers import HostLimiter, PooledSession
 import httpretty
 from mock import patch
 
@@ -55,6 +58,14 @@ def mock_worker_init(self, table, cities):
     self.prefix = table
     self.archive = self.prefix + "_archive"
     self.max_wait = 5
+    self.session = PooledSession(timeout=60)
+    self.limiter = HostLimiter(rate=1000)
+
+
+def mock_writer_init(self, table, batch_size=100, max_wait=60):
+    self.table = table
+    self.archive = table + "_archive"
+    self.rows = {}
 
 
 class AQICNTest(TestCase):
@@ -117,3 +128,33 @@ class AQICNTest(TestCase):
             self.assertEquals(city_json['data']['cur_pm25'], u'25')
             self.assertEquals(city_json['data']['cur_o3'], u'11')
             self.assertEquals(city_json['data']['cur_so2'], u'2')
+
+    @patch('dataqs.aqicn.aqicn.AQICNWriter.__init__', mock_writer_init)
+    def test_city_row(self):
+        """
+        Verify that measurements are converted to integers or NULL
+        """
+        writer = AQICNWriter('aqicn')
+        row = writer.city_row({
+            'city': u'Boston', 'country': u'USA', 'g': ['42.35', '-71.05'],
+            'dateTime': datetime.datetime(2016, 8, 1, 12),
+            'data': {'cur_aqi': u'25', 'cur_pm25': u'-', 'cur_t': u'21.6',
+                     'cur_xyz': u'1'}})
+        measurements = dict(zip(AQICN_MEASUREMENTS, row[5:]))
+        self.assertEquals(row[:5], ('2016-08-01 12:00:00', 42.35, -71.05,
+                                    u'Boston', u'USA'))
+        self.assertEquals(25, measurements['aqi'])
+        self.assertEquals(22, measurements['t'])
+        self.assertIsNone(measurements['pm25'])
+        self.assertIsNone(measurements['co'])
+
+    def test_limiter(self):
+        """
+        Verify that requests to the same host are spaced out by the rate limit
+        """
+        limiter = HostLimiter(rate=20)
+        start = time.time()
+        for i in range(3):
+            with limiter.limit('http://aqicn.org/city/boston/'):
+                pass
+        self.assertGreaterEqual(time.time() - start, 0.09)
@@ -4,13 +4,12 @@ import os
 import re
 import shutil
 from datetime import date
-from ftplib import FTP
 
 from dateutil.relativedelta import relativedelta
-from dataqs.processor_base import GeoDataMosaicProcessor, GS_DATA_DIR, \
-    GS_TMP_DIR
-from dataqs.helpers import get_band_count, gdal_translate, \
-    nc_convert, style_exists, cdo_fixlng
+from dataqs.ftp_helpers import get_ftp_client
+from dataqs.processor_base import GeoDataMosaicProcessor, GS_TMP_DIR
+from dataqs.helpers import export_bands, nc_convert, style_exists, \
+    cdo_fixlng, ftp_signature, nc_dimension_size
 
 logger = logging.getLogger("dataqs.processors")
 script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -85,25 +84,39 @@ Bull. Amer. Meteor. Soc., 78, 2539-2558.
     def download(self, url, tmp_dir=GS_TMP_DIR, filename=None):
         if not filename:
             filename = url.rsplit('/')[-1]
-        ftp = FTP(self.base_url)
-        ftp.login('anonymous', 'anonymous')
-        ftp.cwd(self.base_path)
-        with open(os.path.join(self.tmp_dir, filename),
-                  'wb') as outfile:
-            ftp.retrbinary('RETR %s' % self.base_name, outfile.write)
+        get_ftp_client(self.base_url).retrieve(
+            self.base_path, self.base_name,
+            os.path.join(self.tmp_dir, filename))
         return filename
 
-    def convert(self, nc_file):
+    def remote_signature(self):
+        """
+        Get the size and modification time of the NetCDF file on the server
+        :return: dict
+        """
+        with get_ftp_client(self.base_url).session(self.base_path) as ftp:
+            return ftp_signature(ftp, self.base_name)
+
+    def convert(self, nc_file, timesteps=None):
         nc_transform = nc_convert(nc_file)
-        cdo_transform = cdo_fixlng(nc_transform, bounds=self.bounds)
+        cdo_transform = cdo_fixlng(nc_transform, bounds=self.bounds,
+                                   timesteps=timesteps)
         return cdo_transform
 
     def extract_band(self, tif, band, outname):
-        outfile = os.path.join(self.tmp_dir, outname)
-        gdal_translate(tif, outfile, bands=[band],
-                       projection='EPSG:4326',
-                       options=['TILED=YES', 'COMPRESS=LZW'])
-        return outfile
+        return self.extract_bands(tif, [(band, outname)])[0]
+
+    def extract_bands(self, tif, bands):
+        """
+        Extract many bands to GeoTIFFs, reading the NetCDF file only once
+        :param tif: NetCDF file
+        :param bands: list of (band number, output filename) tuples
+        :return: list of output filepaths
+        """
+        return export_bands(tif, [
+            (band, os.path.join(self.tmp_dir, outname))
+            for band, outname in bands],
+            projection='EPSG:4326', processes=self.export_processes)
 
     def get_date(self, months):
         start_month = date(1979, 1, 1)
@@ -113,30 +126,40 @@ Bull. Amer. Meteor. Soc., 78, 2539-2558.
         end_month = self.get_date(months)
         return self.title.format(end_month.strftime('%Y/%m'))
 
+    def get_img_name(self, band):
+        band_date = re.sub('[\-\.]+', '', self.get_date(band).isoformat())
+        return '{}_{}T000000000Z.tif'.format(self.layer_name, band_date)
+
     def run(self):
         """
-        Retrieve and process the latest NetCDF file.
+        Retrieve and process the latest NetCDF file, if it has changed
+        since the last run.  Only months missing from the mosaic
+        are converted.
         """
+        signature = self.remote_signature()
+        if not self.source_changed(self.layer_name, signature):
+            logger.info("{} is unchanged, skipping".format(self.base_name))
+            return
         ncfile = self.download(
             self.base_url, filename='{}.nc'.format(self.layer_name))
-        cdf_file = self.convert(os.path.join(self.tmp_dir, ncfile))
-        bands = get_band_count(cdf_file)
+        nc_path = os.path.join(self.tmp_dir, ncfile)
+        bands = nc_dimension_size(nc_path)
         img_list = self.get_mosaic_filenames(self.layer_name)
-        for band in range(1, bands + 1):
-            band_date = re.sub('[\-\.]+', '', self.get_date(band).isoformat())
-            img_name = '{}_{}T000000000Z.tif'.format(self.layer_name, band_date)
-            if img_name not in img_list:
-                band_tif = self.extract_band(cdf_file, band, img_name)
-                dst_file = self.data_dir.format(gsd=GS_DATA_DIR,
-                                                ws=self.workspace,
-                                                layer=self.layer_name,
-                                                file=img_name)
-                dst_dir = os.path.dirname(dst_file)
-                if not os.path.exists(dst_dir):
-                    os.makedirs(dst_dir)
-                if dst_file.endswith('.tif'):
-                    shutil.move(os.path.join(self.tmp_dir, band_tif), dst_file)
-                    self.post_geoserver(dst_file, self.layer_name)
+        img_names = [(band, self.get_img_name(band))
+                     for band in range(1, bands + 1)]
+        new_imgs = [(band, img_name) for band, img_name in img_names
+                    if img_name not in img_list]
+        if new_imgs:
+            first_band = new_imgs[0][0]
+            cdf_file = self.convert(nc_path, timesteps=(first_band, bands))
+            band_tifs = self.extract_bands(cdf_file, [
+                (band - first_band + 1, img_name)
+                for band, img_name in new_imgs])
+            harvest_dir = self.get_harvest_dir(self.layer_name)
+            for band_tif in band_tifs:
+                shutil.move(band_tif, os.path.join(
+                    harvest_dir, os.path.basename(band_tif)))
+            self.harvest_geoserver(harvest_dir, self.layer_name)
 
         if not style_exists(self.layer_name):
             with open(os.path.join(script_dir,
@@ -151,6 +174,7 @@ Bull. Amer. Meteor. Soc., 78, 2539-2558.
                     'EPSG:4326'),
             extra_keywords=['category:Climatology Meteorology'])
         self.truncate_gs_cache(self.layer_name)
+        self.save_source_signature(self.layer_name, signature)
         self.cleanup()
 
 
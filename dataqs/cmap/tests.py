@@ -2,6 +2,7 @@ import glob
 import os
 import unittest
 from datetime import date
+import gdal
 from django.test import TestCase
 from dataqs.cmap.cmap import CMAPProcessor
 
@@ -42,6 +43,27 @@ class CMAPPTest(TestCase):
             self.dl_file, 1, os.path.join(self.processor.tmp_dir, 'cmap.tif'))
         self.assertTrue(os.path.exists(dl_tif))
 
+    def test_extract_bands(self):
+        """
+        Verify that several bands are exported with the same values
+        """
+        outfiles = self.processor.extract_bands(
+            self.dl_file, [(1, 'cmap_a.tif'), (1, 'cmap_b.tif')])
+        self.assertEquals(2, len(outfiles))
+        src = gdal.Open(self.dl_file)
+        try:
+            expected = src.GetRasterBand(1).ReadAsArray()
+            for outfile in outfiles:
+                img = gdal.Open(outfile)
+                try:
+                    self.assertEquals(1, img.RasterCount)
+                    self.assertTrue(
+                        (img.GetRasterBand(1).ReadAsArray() == expected).all())
+                finally:
+                    img = None
+        finally:
+            src = None
+
     def test_get_title(self):
         """
         Verify that the correct title is returned
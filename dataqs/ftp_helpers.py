@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc. and Epidemico Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+from __future__ import absolute_import
+
+import ftplib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from ftplib import FTP
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from dataqs.http_helpers import DOWNLOAD_ATTEMPTS, DOWNLOAD_CHUNK_SIZE
+
+logger = logging.getLogger("dataqs.ftp_helpers")
+
+FTP_POOL_SIZE = getattr(settings, 'FTP_POOL_SIZE', 4)
+FTP_TIMEOUT = getattr(settings, 'FTP_TIMEOUT', 120)
+FTP_LISTING_TTL = getattr(settings, 'FTP_LISTING_TTL', 300)
+
+# Idle sessions older than this are closed instead of reused, since most
+# servers drop inactive control connections after a minute or two
+FTP_IDLE_TIMEOUT = 60
+
+
+class FTPClient(object):
+    """
+    Logged-in FTP sessions to one host, shared by all processors in a
+    process.  At most pool_size sessions are open at a time; idle ones are
+    kept for reuse.  Directory listings are cached for listing_ttl seconds,
+    and files are retrieved in parallel over separate sessions, continuing
+    interrupted transfers with REST.
+    """
+
+    def __init__(self, host, user='anonymous', passwd='anonymous',
+                 pool_size=FTP_POOL_SIZE, timeout=FTP_TIMEOUT,
+                 listing_ttl=FTP_LISTING_TTL):
+        self.host = host
+        self.user = user
+        self.passwd = passwd
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.listing_ttl = listing_ttl
+        self._idle = []
+        self._listings = {}
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(pool_size)
+
+    def connect(self):
+        """
+        Open and log in a new session
+        :return: tuple of ftplib.FTP and its login directory
+        """
+        ftp = FTP(self.host, timeout=self.timeout)
+        ftp.login(self.user, self.passwd)
+        return ftp, ftp.pwd()
+
+    @staticmethod
+    def disconnect(ftp):
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+    @contextmanager
+    def session(self, path=None):
+        """
+        Borrow a logged-in session from the pool, connecting if none is idle.
+        A session that raises an error is closed rather than returned.
+        :param path: Optional directory to change to, relative paths are
+        resolved against the login directory
+        :return: ftplib.FTP
+        """
+        self._slots.acquire()
+        try:
+            ftp = None
+            with self._lock:
+                while self._idle and ftp is None:
+                    ftp, home, idle_since = self._idle.pop()
+                    if time.time() - idle_since > FTP_IDLE_TIMEOUT:
+                        self.disconnect(ftp)
+                        ftp = None
+            reused = ftp is not None
+            if not reused:
+                ftp, home = self.connect()
+            try:
+                if path:
+                    # An idle session is still in the last directory used
+                    if reused and not path.startswith('/'):
+                        ftp.cwd(home)
+                    ftp.cwd(path)
+                yield ftp
+            except Exception:
+                self.disconnect(ftp)
+                raise
+            with self._lock:
+                self._idle.append((ftp, home, time.time()))
+        finally:
+            self._slots.release()
+
+    def nlst(self, path):
+        """
+        List a directory, reusing a listing younger than listing_ttl
+        :param path: Directory on the server
+        :return: list of file names
+        """
+        with self._lock:
+            listing = self._listings.get(path)
+        if listing and time.time() - listing[0] < self.listing_ttl:
+            return listing[1]
+        try:
+            with self.session(path) as ftp:
+                files = ftp.nlst()
+        except ftplib.error_perm:
+            raise
+        except ftplib.all_errors:
+            # The server may have dropped an idle session, try a new one
+            with self.session(path) as ftp:
+                files = ftp.nlst()
+        with self._lock:
+            self._listings[path] = (time.time(), files)
+        return files
+
+    def retrieve(self, path, filename, outfile, attempts=DOWNLOAD_ATTEMPTS):
+        """
+        Download a file to <outfile>.part and rename it to outfile once
+        complete.  If the transfer drops, up to 'attempts' tries are made,
+        each continuing the .part file with a REST command.
+        :param path: Directory of the file on the server
+        :param filename: Name of the file on the server
+        :param outfile: Full path of the output file
+        :param attempts: Number of tries before giving up
+        :return: outfile
+        """
+        part = outfile + '.part'
+        if os.path.exists(part):
+            os.remove(part)
+        for attempt in range(1, attempts + 1):
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            try:
+                with self.session(path) as ftp, \
+                        open(part, 'ab' if offset else 'wb') as output:
+                    ftp.retrbinary('RETR {}'.format(filename), output.write,
+                                   DOWNLOAD_CHUNK_SIZE, offset or None)
+                break
+            except ftplib.error_perm:
+                raise
+            except ftplib.all_errors:
+                if attempt == attempts:
+                    raise
+                logger.warn("Transfer of {} interrupted, retrying ({}/{})"
+                            .format(filename, attempt, attempts))
+        os.rename(part, outfile)
+        return outfile
+
+    def retrieve_many(self, path, files, attempts=DOWNLOAD_ATTEMPTS):
+        """
+        Download several files from a directory in parallel, one session
+        per transfer, up to pool_size at a time
+        :param path: Directory of the files on the server
+        :param files: list of (filename on server, full output path) tuples
+        :param attempts: Number of tries per file before giving up
+        :return: list of output paths, in the same order as files
+        """
+        if len(files) < 2:
+            return [self.retrieve(path, filename, outfile, attempts)
+                    for filename, outfile in files]
+        start = time.time()
+        pool = ThreadPool(min(self.pool_size, len(files)))
+        try:
+            outfiles = pool.map(
+                lambda item: self.retrieve(path, item[0], item[1], attempts),
+                files)
+        finally:
+            pool.close()
+            pool.join()
+        logger.info("Retrieved {} files from {} in {:.1f}s".format(
+            len(files), self.host, time.time() - start))
+        return outfiles
+
+    def close(self):
+        """
+        Close all idle sessions and forget cached listings
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._listings = {}
+        for ftp, _, _ in idle:
+            self.disconnect(ftp)
+
+
+_ftp_clients = {}
+_ftp_clients_pid = None
+_ftp_clients_lock = threading.Lock()
+
+
+def get_ftp_client(host, user='anonymous', passwd='anonymous'):
+    """
+    Return the process-wide FTPClient for a host and account.  New clients
+    are created after a fork so celery workers never share sockets.
+    :param host: FTP server
+    :param user: Login name
+    :param passwd: Password
+    :return: FTPClient
+    """
+    global _ftp_clients, _ftp_clients_pid
+    with _ftp_clients_lock:
+        if _ftp_clients_pid != os.getpid():
+            _ftp_clients = {}
+            _ftp_clients_pid = os.getpid()
+        key = (host, user)
+        if key not in _ftp_clients:
+            _ftp_clients[key] = FTPClient(host, user, passwd)
+        return _ftp_clients[key]
@@ -21,11 +21,10 @@ from __future__ import absolute_import
 import logging
 import os
 import datetime
-import struct
 import re
-import requests
+import numpy
 from bs4 import BeautifulSoup as bs
-from dataqs.helpers import gdal_translate, style_exists
+from dataqs.helpers import array_to_geotiff, get_html, style_exists
 from dataqs.processor_base import GeoDataProcessor
 
 logger = logging.getLogger("dataqs.processors")
@@ -40,13 +39,8 @@ class GFMSProcessor(GeoDataProcessor):
     rows = 800
     cols = 2458
 
-    header = """ncols        {cols}
-    nrows        {rows}
-    xllcorner    -127.5
-    yllcorner    -50.0
-    cellsize     0.125
-    NODATA_value -9999
-    """.format(cols=cols, rows=rows)
+    nodata = -9999
+    geotransform = (-127.5, 0.125, 0.0, 50.0, 0.0, -0.125)
 
     base_url = "http://eagle1.umd.edu/flood/download/"
     layer_future = "gfms_latest"
@@ -76,8 +70,7 @@ last day, three days and seven days are displayed.
         base_url = self.base_url + "{year}/{year}{month}".format(
             year=year, month=month)
 
-        r = requests.get(base_url)
-        html = bs(r.text)
+        html = bs(get_html(base_url))
         latest_img = html.find_all('a')[-1].get('href')
         img_url = "{}/{}".format(base_url, latest_img)
         return img_url
@@ -115,28 +108,19 @@ last day, three days and seven days are displayed.
         :return: Name of converted GeoTIFF file
         """
         basename = os.path.splitext(img_file)[0]
-        aig_file = "{}.aig".format(basename)
         tif_file = "{}.tif".format(basename)
 
-        outfile = open(os.path.join(self.tmp_dir, aig_file), "w")
-        infile = open(os.path.join(self.tmp_dir, img_file), "rb")
-
+        # Memory-map the raw float32 grid (north row first) instead of
+        # reading it into Python objects
+        grid = numpy.memmap(os.path.join(self.tmp_dir, img_file),
+                            dtype=numpy.float32, mode='r',
+                            shape=(self.rows, self.cols))
         try:
-            coords = struct.unpack('f'*self.rows*self.cols,
-                                   infile.read(4*self.rows*self.cols))
-            outfile.write(self.header)
-
-            for idx, value in enumerate(coords):
-                outfile.write(str(value) + " ")
-                if (idx + 1) % 2458 == 0:
-                    outfile.write("\n")
+            array_to_geotiff(grid, os.path.join(self.tmp_dir, tif_file),
+                             self.geotransform, projection="EPSG:4326",
+                             nodata=self.nodata)
         finally:
-            outfile.close()
-            infile.close()
-
-        gdal_translate(os.path.join(self.tmp_dir, aig_file),
-                       os.path.join(self.tmp_dir, tif_file),
-                       projection="EPSG:4326")
+            del grid
         return tif_file
 
     def parse_title(self, tif_file):
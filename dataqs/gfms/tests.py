@@ -23,6 +23,8 @@ import os
 import datetime
 from django.test import TestCase
 import re
+import numpy
+from osgeo import gdal
 from dataqs.gfms.gfms import GFMSProcessor
 import httpretty
 
@@ -106,6 +108,30 @@ class GFMSTest(TestCase):
         self.assertTrue(os.path.exists(os.path.join(
             self.processor.tmp_dir, tif_file)))
 
+    def test_convert_values(self):
+        """
+        Verify that the GeoTIFF has the GFMS grid, georeferencing and values
+        """
+        current_url = self.processor.get_most_current()
+        httpretty.register_uri(httpretty.GET, current_url,
+                               body=get_mock_image())
+        imgfile = self.processor.download(current_url)
+        tif_file = self.processor.convert(imgfile)
+        raw = numpy.fromstring(get_mock_image()[
+            :4 * self.processor.rows * self.processor.cols],
+            dtype=numpy.float32).reshape(
+            self.processor.rows, self.processor.cols)
+        ds = gdal.Open(os.path.join(self.processor.tmp_dir, tif_file))
+        try:
+            self.assertEquals(ds.GetGeoTransform(),
+                              self.processor.geotransform)
+            band = ds.GetRasterBand(1)
+            self.assertEquals(band.GetNoDataValue(), self.processor.nodata)
+            self.assertTrue(numpy.array_equal(band.ReadAsArray(), raw))
+        finally:
+            band = None
+            ds = None
+
     def test_cleanup(self):
         current_url = self.processor.get_most_current()
         httpretty.register_uri(httpretty.GET, current_url,
@@ -19,9 +19,12 @@
 
 import glob
 import os
+import shutil
+import tempfile
 import httpretty
 from django.test import TestCase
 from dataqs.gistemp.gistemp import GISTEMPProcessor
+from geonode.geoserver.helpers import ogc_server_settings
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -74,3 +77,27 @@ class GISTEMPTest(TestCase):
         self.processor.cleanup()
         self.assertEquals([], glob.glob(os.path.join(
             self.processor.tmp_dir, self.processor.prefix + '*')))
+
+    def test_harvest_fallback(self):
+        """
+        Verify that images are added one at a time if the
+        bulk harvest is rejected
+        """
+        harvest_dir = tempfile.mkdtemp()
+        try:
+            for name in ('a.tif', 'b.tif'):
+                open(os.path.join(harvest_dir, name), 'w').close()
+            gs_url = self.processor.gs_url.format(
+                ogc_server_settings.hostname, self.processor.workspace,
+                self.processor.layer_name)
+            httpretty.register_uri(httpretty.POST, gs_url, responses=[
+                httpretty.Response(body='', status=500),
+                httpretty.Response(body='', status=201),
+                httpretty.Response(body='', status=201)])
+            self.processor.harvest_geoserver(
+                harvest_dir, self.processor.layer_name, sleeptime=0)
+            self.assertEquals('file://{}'.format(
+                os.path.join(harvest_dir, 'b.tif')),
+                httpretty.last_request().body)
+        finally:
+            shutil.rmtree(harvest_dir)
@@ -23,12 +23,11 @@ import os
 import re
 import shutil
 from datetime import date
-from time import sleep
 import gdal
 from dateutil.relativedelta import relativedelta
-from dataqs.processor_base import GeoDataMosaicProcessor, GS_DATA_DIR, \
-    GS_TMP_DIR, RSYNC_WAIT_TIME
-from dataqs.helpers import gdal_translate, style_exists,  create_band_vrt, untar
+from dataqs.processor_base import GeoDataMosaicProcessor, GS_TMP_DIR, \
+    RSYNC_WAIT_TIME
+from dataqs.helpers import export_bands, style_exists, untar
 
 logger = logging.getLogger("dataqs.processors")
 script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -87,51 +86,36 @@ class HadGHCNDProcessor(GeoDataMosaicProcessor):
         u"\nSource: http://www.metoffice.gov.uk/hadobs/hadghcnd/index.html\n\n"
         u"Raw data file: {}")
 
+    # The source grid starts at 0° longitude; rolling each row by half its
+    # width moves it to -180°, matching this geotransform
+    lng_shift = 48
+    geotransform = (-181.875, 3.75, 0.0, 91.25, 0.0, -2.5)
+
     def extract_band(self, ncfile, band, outname, projection=None):
         """
         Extract specified band from NetCDF file and convert to GeoTIFF,
-        using a VRT file to swap E-W axis
+        swapping the E-W halves of the image
         :param ncfile: NetCDF input filename, formatted for use in GDAL
         :param band: Band number to process
         :param outname: Output GeoTIFF filename
-        :param projection: Projection to use
+        :param projection: Not used, output is always EPSG:4326
         :return: Full pathname of output GeoTIFF
         """
-        temp_vrt = os.path.join(self.tmp_dir, outname + '.vrt')
-        try:
-            source_xml = """
-            <root>
-                <SimpleSource>
-                  <SourceFilename relativeToVRT="1">{fname}</SourceFilename>
-                  <SourceBand>{band}</SourceBand>
-                  <SrcRect xOff="48" yOff="0" xSize="96" ySize="73"/>
-                  <DstRect xOff="0" yOff="0" xSize="96" ySize="73"/>
-                </SimpleSource>
-                <SimpleSource>
-                  <SourceFilename relativeToVRT="1">{fname}</SourceFilename>
-                  <SourceBand>{band}</SourceBand>
-                  <SrcRect xOff="0" yOff="0" xSize="96" ySize="73"/>
-                  <DstRect xOff="48" yOff="0" xSize="96" ySize="73"/>
-                </SimpleSource>
-            </root>
-            """.format(fname=ncfile, band=band)
-            geotransform = ','.join(['-1.818750000000000000e+02',
-                                     '3.7500000000000000e+00',
-                                     '0.0000000000000000e+00',
-                                     '9.1250000000000000e+01',
-                                     '0.0000000000000000e+00',
-                                     '-2.5000000000000000e+00'])
-            create_band_vrt(ncfile, temp_vrt, [band], source_xml,
-                            projection=projection, geotransform=geotransform)
-            gdal_translate(temp_vrt,
-                           os.path.join(self.tmp_dir, outname),
-                           projection='EPSG:4326',
-                           options=['TILED=YES', 'COMPRESS=LZW'])
-        finally:
-            if os.path.exists(temp_vrt):
-                os.remove(temp_vrt)
+        return self.extract_bands(ncfile, [(band, outname)])[0]
 
-        return os.path.join(self.tmp_dir, outname)
+    def extract_bands(self, ncfile, bands):
+        """
+        Extract many bands from a NetCDF file to GeoTIFFs, opening the file
+        only once
+        :param ncfile: NetCDF input filename, formatted for use in GDAL
+        :param bands: list of (band number, output filename) tuples
+        :return: list of full pathnames of output GeoTIFFs
+        """
+        return export_bands(ncfile, [
+            (band, os.path.join(self.tmp_dir, outname))
+            for band, outname in bands],
+            geotransform=self.geotransform, projection='EPSG:4326',
+            shift=self.lng_shift, processes=self.export_processes)
 
     def get_date(self, days):
         """
@@ -159,7 +143,7 @@ class HadGHCNDProcessor(GeoDataMosaicProcessor):
                         prefix=self.prefix, measure=measure
                     )
                     img_list = self.get_mosaic_filenames(layer_name)
-                    files = []
+                    new_imgs = []
                     for band in range(1, min(11, bands + 1)):
                         days = int(ncds.GetRasterBand(band)
                                    .GetMetadata()['NETCDF_DIM_time'])
@@ -168,22 +152,16 @@ class HadGHCNDProcessor(GeoDataMosaicProcessor):
                         img_name = '{}_{}T000000000Z.tif'.format(layer_name,
                                                                  band_date)
                         if img_name not in img_list:
-                            band_tif = self.extract_band(ncds_gdal_name,
-                                                         band,
-                                                         img_name,
-                                                         projection='WGS84')
-                            dst_file = self.data_dir.format(gsd=GS_DATA_DIR,
-                                                            ws=self.workspace,
-                                                            layer=layer_name,
-                                                            file=img_name)
-                            dst_dir = os.path.dirname(dst_file)
-                            if not os.path.exists(dst_dir):
-                                os.makedirs(dst_dir)
-                            shutil.move(band_tif, dst_file)
-                            files.append(dst_file)
-                    sleep(RSYNC_WAIT_TIME * 2)
-                    for file in files:
-                        self.post_geoserver(file, layer_name, sleeptime=0)
+                            new_imgs.append((band, img_name))
+                    ncds = None
+                    if new_imgs:
+                        harvest_dir = self.get_harvest_dir(layer_name)
+                        for band_tif in self.extract_bands(ncds_gdal_name,
+                                                           new_imgs):
+                            shutil.move(band_tif, os.path.join(
+                                harvest_dir, os.path.basename(band_tif)))
+                        self.harvest_geoserver(harvest_dir, layer_name,
+                                               sleeptime=RSYNC_WAIT_TIME * 2)
                     style = '_'.join(layer_name.split('_')[0:2])
                     if not style_exists(layer_name):
                         with open(os.path.join(script_dir,
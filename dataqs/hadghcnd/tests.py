@@ -18,6 +18,7 @@
 ###############################################################################
 
 import glob
+import hashlib
 import os
 from datetime import date
 
@@ -101,3 +102,43 @@ class HadGHCNDTest(TestCase):
         self.processor.cleanup()
         self.assertEquals([], glob.glob(os.path.join(
             self.processor.tmp_dir, self.processor.prefix + '*')))
+
+    def test_download_resume(self):
+        """
+        Verify that an interrupted download is continued from its .part file
+        and checked against its checksum
+        """
+        body = get_mock_image()
+        ranges = []
+
+        def range_callback(request, uri, headers):
+            start = int(request.headers.get('Range', 'bytes=0-')[6:-1])
+            ranges.append(start)
+            if start:
+                return 206, headers, body[start:]
+            return 200, headers, body
+        httpretty.register_uri(httpretty.GET, self.processor.base_url,
+                               body=range_callback)
+        filename = self.processor.prefix + '_resume.nc'
+        with open(os.path.join(self.processor.tmp_dir,
+                               filename + '.part'), 'wb') as part:
+            part.write(body[:1000])
+        checksum = 'md5:' + hashlib.md5(body).hexdigest()
+        self.processor.download(self.processor.base_url, filename,
+                                checksum=checksum)
+        self.assertEquals([1000], ranges)
+        with open(os.path.join(self.processor.tmp_dir, filename), 'rb') as f:
+            self.assertEquals(body, f.read())
+        self.assertRaises(IOError, self.processor.download,
+                          self.processor.base_url, filename,
+                          checksum='md5:0')
+        self.assertFalse(os.path.exists(os.path.join(
+            self.processor.tmp_dir, filename + '.part')))
+        # Without a checksum or validator, a leftover .part is not trusted
+        with open(os.path.join(self.processor.tmp_dir,
+                               filename + '.part'), 'wb') as part:
+            part.write('stale')
+        self.processor.download(self.processor.base_url, filename)
+        self.assertEquals(0, ranges[-1])
+        with open(os.path.join(self.processor.tmp_dir, filename), 'rb') as f:
+            self.assertEquals(body, f.read())
@@ -20,6 +20,7 @@
 import datetime
 import gzip
 import logging
+import multiprocessing
 import shutil
 import tarfile
 import traceback
@@ -27,22 +28,43 @@ import os
 import subprocess
 import requests
 import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import ThreadedConnectionPool
 import re
 import sys
+import threading
+import time
 import unicodedata
+import numpy
 import ogr2ogr
 import rasterio
-from osgeo import gdal, ogr
+from osgeo import gdal, gdal_array, ogr
 from osr import SpatialReference
 import xml.etree.ElementTree as ET
 from StringIO import StringIO
 from rasterio.warp import RESAMPLING
 from rasterio.warp import calculate_default_transform, reproject
+from django.conf import settings
+from dataqs.http_helpers import get_http_cache
 from geonode.geoserver.helpers import ogc_server_settings
 from geoserver.catalog import Catalog, FailedRequestError
 
 logger = logging.getLogger("dataqs.helpers")
 
+DB_POOL_MIN_CONN = getattr(settings, 'DB_POOL_MIN_CONN', 1)
+DB_POOL_MAX_CONN = getattr(settings, 'DB_POOL_MAX_CONN', 10)
+EXISTS_CACHE_TTL = getattr(settings, 'EXISTS_CACHE_TTL', 300)
+DB_PARTITIONING = getattr(settings, 'DB_PARTITIONING', False)
+BAND_EXPORT_BLOCK_BYTES = getattr(settings, 'BAND_EXPORT_BLOCK_BYTES',
+                                  16 * 1024 * 1024)
+
+# Percentiles reported for each numeric field by get_vector_layer_info
+VECTOR_STAT_QUANTILES = (25, 50, 75)
+NUMERIC_FIELD_TYPES = (ogr.OFTInteger, ogr.OFTReal,
+                       getattr(ogr, 'OFTInteger64', ogr.OFTInteger))
+# Fields reported with their range only, as ISO 8601 strings
+DATE_FIELD_TYPES = (ogr.OFTDate, ogr.OFTTime, ogr.OFTDateTime)
+
 
 class GdalErrorHandler(object):
     """
@@ -169,6 +191,143 @@ def gdal_translate(src_filename, dst_filename, of="GTiff", bands=None,
         band = None
 
 
+def _export_bands(src_filename, band_files, geotransform=None,
+                  projection=None, nodata=None, options=None, shift=0,
+                  block_bytes=BAND_EXPORT_BLOCK_BYTES):
+    src_ds = gdal.Open(src_filename)
+    if src_ds is None:
+        raise IOError("Could not open {}".format(src_filename))
+    try:
+        cols, rows = src_ds.RasterXSize, src_ds.RasterYSize
+        if geotransform is None:
+            geotransform = src_ds.GetGeoTransform()
+        if projection:
+            srs = SpatialReference()
+            srs.SetWellKnownGeogCS(projection)
+            wkt = srs.ExportToWkt()
+        else:
+            wkt = src_ds.GetProjection()
+        metadata = src_ds.GetMetadata()
+        driver = gdal.GetDriverByName('GTiff')
+        for band_num, dst_filename in band_files:
+            src_band = src_ds.GetRasterBand(band_num)
+            itemsize = numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(
+                src_band.DataType)).itemsize
+            # Read whole rows, as many as fit in block_bytes but at least
+            # one source block, so the E-W shift can be applied per strip
+            block_rows = max(src_band.GetBlockSize()[1],
+                             block_bytes // (cols * itemsize), 1)
+            dst_ds = driver.Create(dst_filename, cols, rows, 1,
+                                   src_band.DataType, options)
+            try:
+                dst_ds.SetMetadata(metadata)
+                dst_ds.SetGeoTransform(geotransform)
+                if wkt:
+                    dst_ds.SetProjection(wkt)
+                dst_band = dst_ds.GetRasterBand(1)
+                band_nodata = nodata if nodata is not None \
+                    else src_band.GetNoDataValue()
+                if band_nodata is not None:
+                    dst_band.SetNoDataValue(band_nodata)
+                for yoff in xrange(0, rows, block_rows):
+                    strip = src_band.ReadAsArray(
+                        0, yoff, cols, min(block_rows, rows - yoff))
+                    if shift:
+                        strip = numpy.roll(strip, shift, axis=1)
+                    dst_band.WriteArray(strip, 0, yoff)
+            finally:
+                # Properly close the datasets to flush to disk
+                dst_band = None
+                dst_ds = None
+            src_band = None
+    finally:
+        src_ds = None
+    return [dst_filename for _, dst_filename in band_files]
+
+
+def _export_bands_star(args):
+    return _export_bands(*args[0], **args[1])
+
+
+def export_bands(src_filename, band_files, geotransform=None,
+                 projection=None, nodata=None, options=None, shift=0,
+                 processes=1):
+    """
+    Export many bands of a raster to single-band GeoTIFFs, opening the source
+    dataset only once (per process) and copying each band in strips of rows
+    rather than reading it into memory in full.
+    :param src_filename: Source raster filepath (or GDAL dataset name)
+    :param band_files: list of (band number, output GeoTIFF filepath) tuples
+    :param geotransform: GDAL geotransform of output (default: source's)
+    :param projection: Well-known GCS name of output, i.e. 'EPSG:4326'
+    (default: source's)
+    :param nodata: NoData value for output (default: source band's)
+    :param options: GeoTIFF creation options
+    :param shift: Number of columns to roll each row by, i.e. to move
+    longitudes from 0->360 to -180->180
+    :param processes: Number of processes to split the bands across
+    :return: list of output filepaths
+    """
+    if options is None:
+        options = ['TILED=YES', 'COMPRESS=LZW']
+    kwargs = {
+        'geotransform': geotransform,
+        'projection': projection,
+        'nodata': nodata,
+        'options': options,
+        'shift': shift
+    }
+    band_files = list(band_files)
+    processes = max(1, min(processes, len(band_files)))
+    if processes == 1:
+        return _export_bands(src_filename, band_files, **kwargs)
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Contiguous runs of bands keep each process' reads sequential
+        size = -(-len(band_files) // processes)
+        results = pool.map(_export_bands_star, [
+            ((src_filename, band_files[i:i + size]), kwargs)
+            for i in xrange(0, len(band_files), size)])
+    finally:
+        pool.close()
+        pool.join()
+    return [path for result in results for path in result]
+
+
+def array_to_geotiff(array, dst_filename, geotransform, projection=None,
+                     nodata=None, options=None):
+    """
+    Write a 2D numpy array (or memory-mapped file) to a single-band GeoTIFF
+    :param array: 2D numpy array, first row is the northernmost
+    :param dst_filename: Output GeoTIFF filepath
+    :param geotransform: GDAL geotransform tuple
+    :param projection: Well-known GCS name of the output, i.e. 'EPSG:4326'
+    :param nodata: NoData value for output
+    :param options: GeoTIFF creation options
+    """
+    if options is None:
+        options = ['TILED=YES', 'COMPRESS=LZW']
+    rows, cols = array.shape
+    driver = gdal.GetDriverByName('GTiff')
+    dst_ds = driver.Create(dst_filename, cols, rows, 1,
+                           gdal_array.NumericTypeCodeToGDALTypeCode(
+                               array.dtype.type), options)
+    try:
+        dst_ds.SetGeoTransform(geotransform)
+        if projection:
+            srs = SpatialReference()
+            srs.SetWellKnownGeogCS(projection)
+            dst_ds.SetProjection(srs.ExportToWkt())
+        band = dst_ds.GetRasterBand(1)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        band.WriteArray(array)
+    finally:
+        # Properly close the datasets to flush to disk
+        band = None
+        dst_ds = None
+
+
 def gunzip(filepath):
     """
     Gunzip a file.
@@ -225,20 +384,57 @@ def cdo_invert(filename):
     return output_file
 
 
-def cdo_fixlng(filename, bounds="-180,180,-90,90"):
+def cdo_fixlng(filename, bounds="-180,180,-90,90", timesteps=None):
     """
     Change the longitude coordinates of a NetCDF file from 0->360 to -180->180
     :param filename: Full path * name of NetCDF image to process
     :param bounds: String representation of bounds (minX,maxX,minY,maxY)
+    :param timesteps: Optional (first, last) tuple of timesteps to keep
     :return: output filename
     """
 
     output_file = "{}.lng.nc".format(os.path.splitext(filename)[0])
-    subprocess.check_call(["cdo", "sellonlatbox,{}".format(bounds), "{}".format(
-        filename), output_file])
+    args = ["cdo", "sellonlatbox,{}".format(bounds)]
+    if timesteps:
+        args.append("-seltimestep,{}/{}".format(*timesteps))
+    args.extend(["{}".format(filename), output_file])
+    subprocess.check_call(args)
     return output_file
 
 
+def nc_dimension_size(filename, dimension='time'):
+    """
+    Get the length of a NetCDF dimension from the file header, without
+    reading any data.
+    Requires installation of ncdump (NetCDF tools).
+    :param filename: Full path * name of NetCDF file
+    :param dimension: Name of the dimension
+    :return: length of the dimension
+    """
+    header = subprocess.check_output(["ncdump", "-h", filename])
+    match = re.search(
+        r'^\s*{}\s*=\s*(?:UNLIMITED\s*;\s*//\s*\((\d+)|(\d+))'.format(
+            re.escape(dimension)), header, re.M)
+    if not match:
+        raise ValueError("No {} dimension in {}".format(dimension, filename))
+    return int(match.group(1) or match.group(2))
+
+
+def ftp_signature(ftp, filename):
+    """
+    Identify the current version of a file on an FTP server
+    from its size and modification time (SIZE and MDTM commands)
+    :param ftp: Connected and logged in ftplib.FTP instance
+    :param filename: Name of file in the current FTP directory
+    :return: dict of size and modification time
+    """
+    ftp.voidcmd('TYPE I')
+    return {
+        'size': ftp.size(filename),
+        'mdtm': ftp.sendcmd('MDTM {}'.format(filename)).split()[-1]
+    }
+
+
 def ogr2ogr_exec(argstring):
     """
     Run an ogr2ogr command
@@ -247,6 +443,7 @@ def ogr2ogr_exec(argstring):
     """
     args = ["", ]
     args.extend(split_args(argstring))
+    exists_cache.invalidate('table')
     old_stdout = sys.stdout
     result = StringIO()
     sys.stdout = result
@@ -259,49 +456,595 @@ def ogr2ogr_exec(argstring):
             sys.stdout = old_stdout
 
 
-def postgres_query(query, commit=False, returnable=False, params=None):
+def postgres_dsn():
     """
-    Execute a PostgreSQL query
-    :param query: Query string to execute
-    :param commit: Whether or not to commit the query
-    :param returnable: Whether or not to return results
-    :return: Query result set or None
+    Build a connection string for the GeoNode datastore database
+    :return: DSN string
     """
     db = ogc_server_settings.datastore_db
-    conn_string = (
+    return (
         "dbname={dbname} user={dbuser} host={dbhost} password={dbpass}".format(
             dbname=db["NAME"], dbuser=db["USER"],
             dbhost=db["HOST"], dbpass=db["PASSWORD"]
         )
     )
-    conn = psycopg2.connect(conn_string)
-    cur = conn.cursor()
+
+
+class PostgresPool(object):
+    """
+    Thread-safe pool of datastore connections.  Unlike psycopg2's
+    ThreadedConnectionPool on its own, getconn() blocks until a
+    connection is available instead of raising when the pool is exhausted.
+    """
+    def __init__(self, dsn, minconn=DB_POOL_MIN_CONN,
+                 maxconn=DB_POOL_MAX_CONN):
+        self.pid = os.getpid()
+        self._pool = ThreadedConnectionPool(minconn, maxconn, dsn)
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self):
+        self._slots.acquire()
+        try:
+            return self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        """
+        Return a connection to the pool, discarding any uncommitted work.
+        Broken connections are closed rather than reused.
+        """
+        try:
+            close = bool(conn.closed)
+            if not close and conn.get_transaction_status() != \
+                    extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+            self._pool.putconn(conn, close=close)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_db_local = threading.local()
+
+
+def get_db_pool():
+    """
+    Return the process-wide datastore connection pool, creating a new one
+    after a fork so that celery workers never share connections.
+    :return: PostgresPool
+    """
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool.pid != os.getpid():
+            _db_pool = PostgresPool(postgres_dsn())
+        return _db_pool
+
+
+def current_transaction():
+    """
+    Return the transaction open in the current thread, if any
+    :return: PostgresTransaction or None
+    """
+    return getattr(_db_local, 'transaction', None)
+
+
+class PostgresTransaction(object):
+    """
+    Group many statements into a single commit on one pooled connection.
+    Any postgres_query() call made in the same thread while the transaction
+    is open joins it.  The connection is only checked out of the pool when
+    the first statement runs.  Commits on a clean exit, rolls back if an
+    exception escapes the block.
+
+    If savepoints is True, each statement runs inside its own savepoint so
+    that a failed statement can be caught and skipped without aborting the
+    rest of the transaction.
+
+        with postgres_transaction(savepoints=True):
+            for row in rows:
+                try:
+                    postgres_query(sql, params=row)
+                except Exception:
+                    logger.error(traceback.format_exc())
+    """
+    def __init__(self, savepoints=False):
+        self.savepoints = savepoints
+        self.statements = 0
+        self._conn = None
+        self._cursor = None
+        self._outer = None
+
+    @property
+    def cursor(self):
+        """
+        Cursor of the underlying connection, for bulk operations such as
+        copy_expert or executemany
+        """
+        if self._outer:
+            return self._outer.cursor
+        if self._cursor is None:
+            self._conn = get_db_pool().getconn()
+            self._cursor = self._conn.cursor()
+        return self._cursor
+
+    def execute(self, query, params=None, returnable=False):
+        """
+        Execute a statement within the transaction
+        :param query: Query string to execute
+        :param params: Query parameters
+        :param returnable: Whether or not to return results
+        :return: Query result set or None
+        """
+        invalidate_tables(query)
+        cur = self.cursor
+        if self.savepoints:
+            cur.execute("SAVEPOINT dataqs_statement")
+        try:
+            cur.execute(query, params)
+            result = cur.fetchall() if returnable else None
+        except Exception:
+            if self.savepoints:
+                cur.execute("ROLLBACK TO SAVEPOINT dataqs_statement")
+            raise
+        if self.savepoints:
+            cur.execute("RELEASE SAVEPOINT dataqs_statement")
+        self.statements += 1
+        return result
+
+    def __enter__(self):
+        self._outer = current_transaction()
+        if not self._outer:
+            _db_local.transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._outer:
+            return False
+        _db_local.transaction = None
+        if self._conn is None:
+            return False
+        try:
+            if exc_type is None:
+                self._conn.commit()
+                logger.debug("Committed {} statements".format(
+                    self.statements))
+            else:
+                self._conn.rollback()
+        finally:
+            self._cursor.close()
+            get_db_pool().putconn(self._conn)
+            self._conn = self._cursor = None
+        return False
+
+
+def postgres_transaction(savepoints=False):
+    """
+    Open a transaction that postgres_query() calls in this thread will join
+    :param savepoints: Isolate each statement in its own savepoint
+    :return: PostgresTransaction context manager
+    """
+    return PostgresTransaction(savepoints=savepoints)
+
+
+def postgres_query(query, commit=False, returnable=False, params=None):
+    """
+    Execute a PostgreSQL query on a pooled connection.  Inside a
+    postgres_transaction() block the query joins that transaction and
+    is committed when the block exits.
+    :param query: Query string to execute
+    :param commit: Whether or not to commit the query
+    :param returnable: Whether or not to return results
+    :return: Query result set or None
+    """
+    transaction = current_transaction()
     try:
-        cur.execute(query, params)
-        if returnable:
-            return cur.fetchall()
-        if commit:
-            conn.commit()
-        return None
+        if transaction:
+            return transaction.execute(query, params, returnable=returnable)
+        invalidate_tables(query)
+        pool = get_db_pool()
+        conn = pool.getconn()
+        cur = conn.cursor()
+        try:
+            cur.execute(query, params)
+            result = cur.fetchall() if returnable else None
+            if commit:
+                conn.commit()
+            return result
+        finally:
+            cur.close()
+            pool.putconn(conn)
     except Exception as e:
         logger.error(traceback.format_exc())
         logger.error(query)
         logger.error(params)
         raise e
-    finally:
-        cur.close()
-        conn.close()
 
 
 def purge_old_data(table, datefield, days):
     """
     Remove data older than x days from a table
     """
-    today = datetime.date.today()
-    cutoff = (today - datetime.timedelta(days=days)).strftime(
-        "%Y-%m-%d 00:00:00")
-    postgres_query('DELETE FROM {} where CAST("{}" as timestamp) < %s;'.format(
-        table, datefield), commit=True, params=(cutoff,))
+    RetentionPolicy(table, datefield, days, partitioned=False).enforce()
+
+
+def relation_kind(table):
+    """
+    :param table: Table, view or index name
+    :return: 'r' for a table, 'p' for a partitioned table, 'v' for a view,
+    'i' for an index, None if it does not exist
+    """
+    result = postgres_query(
+        "SELECT c.relkind FROM pg_class c JOIN pg_namespace n "
+        "ON n.oid = c.relnamespace WHERE c.relname = %s "
+        "AND n.nspname = current_schema();",
+        returnable=True, params=(table,))
+    return result[0][0] if result else None
+
+
+class RetentionPolicy(object):
+    """
+    Declares that the rows of a table are kept for 'days' days, based on a
+    time column.
+
+    With partitioned=True the table is range partitioned on the time column
+    (PostgreSQL 11+), with one partition per day or month and a default
+    partition for rows outside of them.  prepare() creates the partitions
+    covering the retention window before new rows are inserted, so
+    PostgreSQL routes rows straight to them, and enforce() drops (or
+    detaches) whole partitions once they fall out of the window.  Without
+    partitioning, enforce() deletes old rows.
+
+    PostgreSQL only allows primary keys and unique indexes on a partitioned
+    table if they include the time column, so a key such as an identifier
+    becomes unique per time value.  Declare it in 'unique' to keep it
+    enforced once the table is partitioned.
+
+        policy = RetentionPolicy('wqp_ph', 'ActivityStartDate', 90)
+        policy.prepare()
+        ... insert rows ...
+        policy.enforce()
+    """
+
+    formats = {'day': '%Y%m%d', 'month': '%Y%m'}
+
+    def __init__(self, table, column, days=None, interval='month',
+                 partitioned=DB_PARTITIONING, indexes=None, unique=None,
+                 detach=False):
+        """
+        :param table: Table name
+        :param column: Time column name
+        :param days: Number of days of data to keep (None = keep all)
+        :param interval: Partition size, 'day' or 'month'
+        :param partitioned: Use partitions instead of row deletes
+        :param indexes: dict of index name suffix: index definition, created
+        on the partitioned table and so on every partition
+        :param unique: dict of index name suffix: column list of a unique
+        index, which must include the time column
+        :param detach: Detach old partitions instead of dropping them
+        """
+        self.table = table
+        self.column = column
+        self.days = days
+        self.interval = interval
+        self.partitioned = partitioned
+        self.indexes = indexes or {}
+        self.unique = unique or {}
+        self.detach = detach
+
+    @property
+    def cutoff(self):
+        """
+        Start of the oldest day to keep, or None
+        """
+        if not self.days:
+            return None
+        return datetime.datetime.combine(
+            datetime.date.today() - datetime.timedelta(days=self.days),
+            datetime.time())
+
+    @property
+    def default_partition(self):
+        return '{}_default'.format(self.table)
+
+    def partition_start(self, value):
+        """
+        :param value: date or datetime
+        :return: Start of the partition the value belongs to
+        """
+        start = datetime.datetime(value.year, value.month, value.day)
+        return start.replace(day=1) if self.interval == 'month' else start
+
+    def next_start(self, start):
+        if self.interval == 'month':
+            return (start + datetime.timedelta(days=32)).replace(day=1)
+        return start + datetime.timedelta(days=1)
+
+    def partition_name(self, start):
+        return '{}_{}'.format(self.table,
+                              start.strftime(self.formats[self.interval]))
+
+    def partitions(self):
+        """
+        :return: list of (partition name, start) tuples, oldest first,
+        not including the default partition
+        """
+        rows = postgres_query(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c "
+            "ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass;",
+            returnable=True, params=(self.table,)) or []
+        partitions = []
+        for name, in rows:
+            try:
+                start = datetime.datetime.strptime(
+                    name[len(self.table) + 1:], self.formats[self.interval])
+            except ValueError:
+                continue
+            partitions.append((name, start))
+        return sorted(partitions, key=lambda p: p[1])
+
+    def create(self, columns):
+        """
+        Create the table as a partitioned table
+        :param columns: list of column definitions
+        """
+        with postgres_transaction():
+            postgres_query(
+                'CREATE TABLE {} ({}) PARTITION BY RANGE ("{}");'.format(
+                    self.table, ', '.join(columns), self.column))
+            self.create_defaults()
+
+    def create_defaults(self):
+        """
+        Create the default partition and the indexes of the table
+        """
+        postgres_query('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} '
+                       'DEFAULT;'.format(self.default_partition, self.table))
+        for unique, indexes in (('', self.indexes), ('UNIQUE ', self.unique)):
+            for suffix, definition in indexes.items():
+                postgres_query('CREATE {unique}INDEX IF NOT EXISTS '
+                               '{tb}_{suffix} ON {tb} {definition};'.format(
+                                   unique=unique, tb=self.table,
+                                   suffix=suffix, definition=definition))
+
+    def convert(self):
+        """
+        Replace an existing unpartitioned table with a partitioned one
+        holding the same rows (those still within the retention window).
+        The time column must be a date or timestamp.  Columns and defaults
+        are copied, but not constraints: the primary key and other unique
+        constraints are replaced by the 'unique' indexes of the policy.
+        Views that depend on the table are dropped and must be recreated.
+        """
+        old_table = '{}_unpartitioned'.format(self.table)
+        logger.info("Partitioning {}".format(self.table))
+        postgres_query('ALTER TABLE {} RENAME TO {};'.format(
+            self.table, old_table))
+        postgres_query(
+            'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) '
+            'PARTITION BY RANGE ("{}");'.format(
+                self.table, old_table, self.column))
+        self.create_defaults()
+        query = 'SELECT min("{col}"), max("{col}") FROM {tb}'.format(
+            col=self.column, tb=old_table)
+        if self.cutoff:
+            query += ' WHERE "{}" >= %s'.format(self.column)
+        oldest, newest = postgres_query(
+            query + ';', returnable=True,
+            params=(self.cutoff,) if self.cutoff else None)[0]
+        if oldest:
+            self.create_partitions(oldest, newest)
+        query = 'INSERT INTO {} SELECT * FROM {}'.format(self.table, old_table)
+        if self.cutoff:
+            query += ' WHERE "{}" >= %s'.format(self.column)
+        postgres_query(query + ';',
+                       params=(self.cutoff,) if self.cutoff else None)
+        postgres_query('DROP TABLE {} CASCADE;'.format(old_table))
+
+    def create_partition(self, start, existing=None):
+        """
+        Create the partition starting at 'start' if it does not exist,
+        moving any of its rows out of the default partition first
+        :param start: Start of the partition
+        :param existing: Optional set of existing partition names
+        """
+        name = self.partition_name(start)
+        if existing is None:
+            existing = set([name]) if relation_kind(name) else set()
+        if name in existing:
+            return
+        end = self.next_start(start)
+        in_range = '"{}" >= %s AND "{}" < %s'.format(self.column, self.column)
+        moved = table_exists(self.default_partition) and postgres_query(
+            'SELECT EXISTS (SELECT 1 FROM {} WHERE {});'.format(
+                self.default_partition, in_range),
+            returnable=True, params=(start, end))[0][0]
+        if moved:
+            postgres_query(
+                'CREATE TEMP TABLE {name}_moved ON COMMIT DROP AS SELECT * '
+                'FROM {default} WHERE {cond};'.format(
+                    name=name, default=self.default_partition, cond=in_range),
+                params=(start, end))
+            postgres_query('DELETE FROM {} WHERE {};'.format(
+                self.default_partition, in_range), params=(start, end))
+        postgres_query(
+            'CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s);'
+            .format(name, self.table), params=(start, end))
+        if moved:
+            postgres_query('INSERT INTO {} SELECT * FROM {}_moved;'.format(
+                self.table, name))
+            postgres_query('DROP TABLE {}_moved;'.format(name))
+        existing.add(name)
+
+    def create_partitions(self, oldest, newest):
+        """
+        Create all partitions between two dates
+        :param oldest: date or datetime
+        :param newest: date or datetime
+        """
+        existing = set(name for name, _ in self.partitions())
+        start = self.partition_start(oldest)
+        while start <= newest:
+            self.create_partition(start, existing)
+            start = self.next_start(start)
+
+    def prepare(self, source=None, expression=None):
+        """
+        Make sure the table is partitioned and that partitions exist for the
+        retention window through the next day/month, so inserted rows are
+        routed to them.  Does nothing if partitioned is False.
+        :param source: Optional table of rows about to be inserted; a
+        partition is also created for each of their days/months
+        :param expression: SQL expression for the time of a source row
+        (default is the time column)
+        """
+        if not self.partitioned:
+            return
+        with postgres_transaction():
+            kind = relation_kind(self.table)
+            if kind == 'r':
+                self.convert()
+            elif kind == 'p':
+                # Adds indexes declared since the table was partitioned
+                self.create_defaults()
+            else:
+                raise ValueError("{} does not exist".format(self.table))
+            now = datetime.datetime.utcnow()
+            self.create_partitions(self.cutoff or now, self.next_start(
+                self.partition_start(now)))
+            if not source:
+                return
+            oldest = self.partition_start(self.cutoff) if self.cutoff \
+                else None
+            existing = set(name for name, _ in self.partitions())
+            rows = postgres_query(
+                "SELECT DISTINCT date_trunc('{}', {}) FROM {};".format(
+                    self.interval, expression or '"{}"'.format(self.column),
+                    source), returnable=True) or []
+            for value, in rows:
+                start = self.partition_start(value) if value else None
+                if start and (not oldest or start >= oldest):
+                    self.create_partition(start, existing)
+
+    def enforce(self):
+        """
+        Remove data older than the retention window: drop or detach old
+        partitions of a partitioned table, delete rows otherwise
+        """
+        cutoff = self.cutoff
+        if not cutoff:
+            return
+        if self.partitioned and relation_kind(self.table) == 'p':
+            for name, start in self.partitions():
+                if self.next_start(start) > cutoff:
+                    break
+                if self.detach:
+                    logger.info("Detaching {}".format(name))
+                    postgres_query('ALTER TABLE {} DETACH PARTITION {};'.format(
+                        self.table, name), commit=True)
+                else:
+                    logger.info("Dropping {}".format(name))
+                    postgres_query('DROP TABLE {};'.format(name), commit=True)
+            table = self.default_partition
+        else:
+            table = self.table
+        data_type = postgres_query(
+            'SELECT data_type FROM information_schema.columns '
+            'WHERE table_name = %s AND column_name = %s;',
+            returnable=True, params=(self.table, self.column))
+        column = '"{}"'.format(self.column)
+        if not data_type or not data_type[0][0].startswith(
+                ('timestamp', 'date')):
+            # Casting prevents the use of an index, only do it for text
+            column = 'CAST({} as timestamp)'.format(column)
+        postgres_query('DELETE FROM {} WHERE {} < %s;'.format(table, column),
+                       commit=True, params=(cutoff,))
+
+
+class ExistsCache(object):
+    """
+    Thread-safe record of whether tables, layers and styles exist,
+    so repeated checks within a worker skip the SQL/REST round trip.
+    Entries expire after 'ttl' seconds; anything created or dropped by
+    dataqs itself is invalidated straight away.
+    """
+
+    def __init__(self, ttl=EXISTS_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: tuple of (kind, name, ...)
+        :return: True/False if known and not expired, otherwise None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                return None
+            return entry[0]
+
+    def set(self, key, exists):
+        with self._lock:
+            self._entries[key] = (exists, time.time())
+
+    def invalidate(self, kind=None, name=None):
+        """
+        Forget entries of the given kind and/or name (default is all)
+        :param kind: 'table', 'layer' or 'style'
+        :param name: table, layer or style name
+        """
+        with self._lock:
+            for key in self._entries.keys():
+                if (kind is None or key[0] == kind) and \
+                        (name is None or key[1] == name):
+                    del self._entries[key]
+
+
+exists_cache = ExistsCache()
+
+# Statements that can change which tables/views exist
+DDL_REGEX = re.compile(r'\b(CREATE|DROP|ALTER)\s', re.IGNORECASE)
+
+
+def invalidate_tables(query):
+    """
+    Forget cached table existence if a query might create or drop tables
+    :param query: Query string about to be executed
+    """
+    if DDL_REGEX.search(query):
+        exists_cache.invalidate('table')
+
+
+_gs_catalog = None
+_gs_catalog_pid = None
+_gs_catalog_lock = threading.Lock()
+
+
+def get_gs_catalog():
+    """
+    Return the process-wide gsconfig Catalog for the GeoNode GeoServer
+    :return: Catalog
+    """
+    global _gs_catalog, _gs_catalog_pid
+    with _gs_catalog_lock:
+        if _gs_catalog is None or _gs_catalog_pid != os.getpid():
+            _user, _password = ogc_server_settings.credentials
+            _gs_catalog = Catalog(ogc_server_settings.rest, _user, _password)
+            _gs_catalog_pid = os.getpid()
+        return _gs_catalog
 
 
 def table_exists(tablename):
@@ -310,33 +1053,39 @@ def table_exists(tablename):
     :param tablename:
     :return:
     """
-    db_query = postgres_query("SELECT EXISTS " +
-                              "(SELECT 1 FROM information_schema.tables " +
-                              "WHERE table_name = '{}');".format(tablename),
-                              returnable=True)
-    if db_query and db_query[0][0]:
-        return True
-    return False
+    key = ('table', tablename)
+    exists = exists_cache.get(key)
+    if exists is None:
+        db_query = postgres_query("SELECT EXISTS " +
+                                  "(SELECT 1 FROM information_schema.tables " +
+                                  "WHERE table_name = %s);",
+                                  returnable=True, params=(tablename,))
+        exists = bool(db_query and db_query[0][0])
+        exists_cache.set(key, exists)
+    return exists
 
 
 def layer_exists(layer_name, store, workspace):
-    _user, _password = ogc_server_settings.credentials
-    url = ogc_server_settings.rest
-    gs_catalog = Catalog(url, _user, _password)
-    try:
-        layer = gs_catalog.get_resource(layer_name, store=store,
-                                        workspace=workspace)
-        return layer is not None
-    except FailedRequestError:
-        return False
+    key = ('layer', layer_name, store, workspace)
+    exists = exists_cache.get(key)
+    if exists is None:
+        try:
+            layer = get_gs_catalog().get_resource(layer_name, store=store,
+                                                  workspace=workspace)
+            exists = layer is not None
+        except FailedRequestError:
+            exists = False
+        exists_cache.set(key, exists)
+    return exists
 
 
 def style_exists(style_name):
-    _user, _password = ogc_server_settings.credentials
-    url = ogc_server_settings.rest
-    gs_catalog = Catalog(url, _user, _password)
-    style = gs_catalog.get_style(style_name)
-    return style is not None
+    key = ('style', style_name)
+    exists = exists_cache.get(key)
+    if exists is None:
+        exists = get_gs_catalog().get_style(style_name) is not None
+        exists_cache.set(key, exists)
+    return exists
 
 
 def gdal_band_subset(infile, bands, dst_filename, dst_format="GTiff"):
@@ -413,12 +1162,15 @@ def warp_image(infile, outfile, dst_crs="EPSG:3857", dst_driver='GTiff'):
                         num_threads=1)
 
 
-def get_html(url=None):
+def get_html(url=None, cache=True):
     """
     Make a standard GET request and return the response content
     :param url: URL to get
+    :param cache: Use the on-disk HTTP cache (see http_helpers.HTTPCache)
     :return: Response content
     """
+    if cache:
+        return get_http_cache().get(url, timeout=60).content
     r = requests.get(url, timeout=60)
     r.raise_for_status()
     return r.content
@@ -459,37 +1211,89 @@ def add_keywords(keyword_list, extra_keywords):
     return filtered_keywords + extra_keywords
 
 
-def _getMinMax(layer, field):
-    min_value, max_value = float('inf'), float('-inf')
-    for f in layer:
-        value = f.GetField(field)
-        if value < min_value:
-            min_value = value
-        if value > max_value:
-            max_value = value
+def _isFieldSetAndNotNull(feature, index):
+    """
+    GeoJSON nulls are set-but-null fields since GDAL 2.2, unset before
+    """
+    if hasattr(feature, 'IsFieldSetAndNotNull'):
+        return feature.IsFieldSetAndNotNull(index)
+    return feature.IsFieldSet(index)
+
+
+def _getFieldStats(values, count):
+    """
+    Summary statistics for the values of one numeric field
+    :param values: numpy array of the field values (NaN where null)
+    :param count: Number of features in the layer
+    :return: dict of field statistics
+    """
+    valid = values[~numpy.isnan(values)]
+    stats = {'count': count, 'nulls': count - len(valid)}
+    if len(valid):
+        quantiles = numpy.percentile(valid, VECTOR_STAT_QUANTILES)
+        stats.update({
+            'min': float(valid.min()),
+            'max': float(valid.max()),
+            'mean': float(valid.mean()),
+            'quantiles': dict((str(q), float(value)) for q, value in zip(
+                VECTOR_STAT_QUANTILES, quantiles))
+        })
+    else:
+        stats.update({'min': None, 'max': None, 'mean': None,
+                      'quantiles': {}})
+    return {'properties': stats, 'type': 'numeric'}
+
+
+def _getDateStats(values, count):
+    """
+    Range of the values of one date, time or datetime field
+    :param values: list of ISO 8601 strings (None where null)
+    :param count: Number of features in the layer
+    :return: dict of field statistics
+    """
+    valid = [value for value in values if value is not None]
+    return {'properties': {'count': count,
+                           'nulls': count - len(valid),
+                           'min': min(valid) if valid else None,
+                           'max': max(valid) if valid else None},
+            'type': 'date'}
+
 
-    return {'properties': {'min': min_value, 'max': max_value},
-            'type': 'numeric'}
+def _getFieldAsISO(feature, index, fieldType):
+    """
+    Value of a date, time or datetime field as an ISO 8601 string
+    """
+    year, month, day, hour, minute, second = \
+        feature.GetFieldAsDateTime(index)[:6]
+    if fieldType == ogr.OFTDate:
+        return datetime.date(year, month, day).isoformat()
+    value = datetime.datetime(year or 1, month or 1, day or 1, hour, minute,
+                              int(second))
+    if fieldType == ogr.OFTTime:
+        return value.time().isoformat()
+    return value.isoformat()
 
 
-def _getNumericFields(layer):
-    """ Gets only the numeric fields from layer"""
+def _getNumericFields(layer, types=NUMERIC_FIELD_TYPES):
+    """ Gets only the numeric (or other given types of) fields from layer"""
 
     layerDefinition = layer.GetLayerDefn()
     numFields = []
     for i in xrange(layerDefinition.GetFieldCount()):
-        fieldName = layerDefinition.GetFieldDefn(i).GetName()
-        fieldTypeCode = layerDefinition.GetFieldDefn(i).GetType()
         fieldDef = layerDefinition.GetFieldDefn(i)
-        fieldType = fieldDef.GetFieldTypeName(fieldTypeCode)
-        if fieldType != 'String':
-            numFields.append(fieldName)
+        if fieldDef.GetType() in types:
+            numFields.append((i, fieldDef.GetName()))
 
     return numFields
 
 
 def get_vector_layer_info(geojson):
-    """ Gets information about a given geojson file """
+    """
+    Gets information about a given geojson file.  The layer is read once,
+    collecting every numeric field into a numpy array, and the statistics
+    of all fields are computed from those arrays.  Date fields are
+    collected as ISO strings for their range.
+    """
 
     dataSource = ogr.Open(geojson)
     layer = dataSource.GetLayer()
@@ -498,15 +1302,49 @@ def get_vector_layer_info(geojson):
             6: 'polygon', -2147483647: 'point'}
 
     subType = geom[layer.GetGeomType()]
-    count = layer.GetFeatureCount()
     numFields = _getNumericFields(layer)
+    dateFields = _getNumericFields(layer, DATE_FIELD_TYPES)
+    layerDefinition = layer.GetLayerDefn()
+    dateTypes = [layerDefinition.GetFieldDefn(i).GetType()
+                 for i, _ in dateFields]
+    columns = [[] for _ in numFields]
+    dateColumns = [[] for _ in dateFields]
+    count = 0
+    for feature in layer:
+        count += 1
+        for (i, _), column in zip(numFields, columns):
+            if _isFieldSetAndNotNull(feature, i):
+                column.append(feature.GetFieldAsDouble(i))
+            else:
+                column.append(numpy.nan)
+        for (i, _), fieldType, column in zip(dateFields, dateTypes,
+                                             dateColumns):
+            if _isFieldSetAndNotNull(feature, i):
+                column.append(_getFieldAsISO(feature, i, fieldType))
+            else:
+                column.append(None)
+    dataSource = None
+    return get_vector_info(subType, dict(
+        (f, column) for (_, f), column in zip(numFields, columns)), count,
+        dict((f, column) for (_, f), column in zip(dateFields, dateColumns)))
+
+
+def get_vector_info(subType, columns, count, date_columns=None):
+    """
+    Build the layer_info of a vector layer from its field values
+    :param subType: 'point', 'line' or 'polygon'
+    :param columns: dict of field name: list of values (NaN where null)
+    :param count: Number of features
+    :param date_columns: dict of field name: list of ISO 8601 strings
+    (None where null)
+    :return: dict of layer information
+    """
     info = {'layerType': 'vector', 'subType': subType}
     attr = {}
-    for f in numFields:
-        prop = _getMinMax(layer, f)
-        prop['properties']['count'] = count
-        attr[f.lower()] = prop
-        layer.ResetReading()
-    dataSource = None
+    for f, column in columns.items():
+        attr[f.lower()] = _getFieldStats(
+            numpy.array(column, dtype=numpy.float64), count)
+    for f, column in (date_columns or {}).items():
+        attr[f.lower()] = _getDateStats(column, count)
     info['attributes'] = attr
     return info
@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc. and Epidemico Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import mktime_tz, parsedate_tz
+from urlparse import urlparse
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from geonode.geoserver.helpers import ogc_server_settings
+
+logger = logging.getLogger("dataqs.http_helpers")
+
+GS_HTTP_POOL_SIZE = getattr(settings, 'GS_HTTP_POOL_SIZE', 10)
+GS_HTTP_MAX_RETRIES = getattr(settings, 'GS_HTTP_MAX_RETRIES', 3)
+GS_HTTP_BACKOFF_FACTOR = getattr(settings, 'GS_HTTP_BACKOFF_FACTOR', 0.5)
+GS_HTTP_TIMEOUT = getattr(settings, 'GS_HTTP_TIMEOUT', 120)
+DOWNLOAD_CHUNK_SIZE = getattr(settings, 'DOWNLOAD_CHUNK_SIZE', 1024 * 1024)
+DOWNLOAD_ATTEMPTS = getattr(settings, 'DOWNLOAD_ATTEMPTS', 3)
+HTTP_CACHE_DIR = getattr(settings, 'HTTP_CACHE_DIR', os.path.join(
+    getattr(settings, 'GS_TMP_DIR', '/tmp'), 'dataqs_http_cache'))
+HTTP_CACHE_MAX_BYTES = getattr(settings, 'HTTP_CACHE_MAX_BYTES',
+                               100 * 1024 * 1024)
+
+# Errors after which a partial download can be resumed
+RESUMABLE_ERRORS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout)
+
+# Only retry on responses that indicate a busy or restarting GeoServer
+RETRY_STATUSES = (502, 503, 504)
+
+
+class PooledSession(requests.Session):
+    """
+    requests.Session with a keep-alive connection pool, automatic retries
+    with exponential backoff, a default timeout, and per-host request
+    counts and latency.
+    """
+
+    def __init__(self, pool_size=GS_HTTP_POOL_SIZE,
+                 max_retries=GS_HTTP_MAX_RETRIES,
+                 backoff_factor=GS_HTTP_BACKOFF_FACTOR,
+                 timeout=GS_HTTP_TIMEOUT, auth=None):
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+        self.auth = auth
+        retries = Retry(total=max_retries,
+                        backoff_factor=backoff_factor,
+                        status_forcelist=RETRY_STATUSES,
+                        raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retries)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request, applying the default timeout and recording
+        the elapsed time against the request's host.
+        """
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        start = time.time()
+        failed = True
+        try:
+            response = super(PooledSession, self).request(
+                method, url, **kwargs)
+            failed = response.status_code >= 400
+            return response
+        finally:
+            self._record(urlparse(url).netloc, time.time() - start, failed)
+
+    def _record(self, host, elapsed, failed):
+        with self._stats_lock:
+            host_stats = self._stats.setdefault(host, {
+                'requests': 0,
+                'errors': 0,
+                'total_time': 0.0,
+                'max_time': 0.0
+            })
+            host_stats['requests'] += 1
+            host_stats['total_time'] += elapsed
+            host_stats['max_time'] = max(host_stats['max_time'], elapsed)
+            if failed:
+                host_stats['errors'] += 1
+
+    def stats(self):
+        """
+        Return request counts and latency (in seconds) per host
+        :return: dict of host: statistics
+        """
+        with self._stats_lock:
+            host_stats = {}
+            for host, values in self._stats.items():
+                host_stats[host] = dict(values)
+                host_stats[host]['avg_time'] = (
+                    values['total_time'] / values['requests'])
+            return host_stats
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats.clear()
+
+
+class TokenBucket(object):
+    """
+    Allow on average 'rate' acquisitions per second, with bursts of up to
+    'capacity', blocking the caller until a token is available.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostLimiter(object):
+    """
+    Politeness limits for scraping: per host, at most 'max_concurrent'
+    requests in flight and 'rate' new requests per second.
+    """
+
+    def __init__(self, rate=1.0, max_concurrent=4, burst=1):
+        self.rate = rate
+        self.max_concurrent = max_concurrent
+        self.burst = burst
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def limit(self, url):
+        """
+        Hold a request slot for the host of a URL for the
+        duration of a with block
+        :param url: URL about to be requested
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = (
+                    threading.BoundedSemaphore(self.max_concurrent),
+                    TokenBucket(self.rate, self.burst))
+            semaphore, bucket = self._hosts[host]
+        with semaphore:
+            bucket.acquire()
+            yield
+
+
+_gs_session = None
+_gs_session_pid = None
+_gs_session_lock = threading.Lock()
+
+
+def get_gs_session():
+    """
+    Return the process-wide session used for GeoServer REST requests,
+    authenticated with the GeoNode OGC server credentials.  A new session
+    is created after a fork so celery workers never share sockets.
+    :return: PooledSession
+    """
+    global _gs_session, _gs_session_pid
+    with _gs_session_lock:
+        if _gs_session is None or _gs_session_pid != os.getpid():
+            _gs_session = PooledSession(
+                auth=tuple(ogc_server_settings.credentials))
+            _gs_session_pid = os.getpid()
+        return _gs_session
+
+
+def log_gs_stats():
+    """
+    Log per-host GeoServer request counts and latency for this process
+    """
+    for host, host_stats in get_gs_session().stats().items():
+        logger.info(
+            "{host}: {requests} requests, {errors} errors, "
+            "avg {avg_time:.3f}s, max {max_time:.3f}s".format(
+                host=host, **host_stats))
+
+
+def file_digest(path, algorithm, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Return a hashlib object updated with the contents of a file
+    :param path: Full path of the file
+    :param algorithm: hashlib algorithm name (md5, sha1, sha256...)
+    :param chunk_size: Size in bytes of each read
+    :return: hashlib object
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest
+
+
+def stream_download(url, path, chunk_size=DOWNLOAD_CHUNK_SIZE, resume=False,
+                    attempts=1, session=None, checksum=None, **kwargs):
+    """
+    Stream a URL to disk in fixed-size chunks, so memory use stays the same
+    no matter how large the response is.  Data is written to <path>.part and
+    renamed to path once complete.  If the connection drops, up to
+    'attempts' tries are made, continuing the .part file with an HTTP Range
+    request when the server supports it.  The ETag/Last-Modified of the
+    response is kept in <path>.part.validator and sent as If-Range, so a
+    .part file is only continued if the remote file has not changed.
+    :param url: URL to download
+    :param path: Full path of the output file
+    :param chunk_size: Size in bytes of each read/write
+    :param resume: Continue a .part file left over from an earlier call, if
+    its validator was saved or a checksum is given
+    :param attempts: Number of tries before giving up
+    :param session: Optional requests session to use
+    :param checksum: Optional expected digest as '<algorithm>:<hexdigest>',
+    e.g. 'md5:9e107d9d372bb6826bd81d3542a419d6'
+    :param kwargs: Additional arguments for the GET request
+    :return: path
+    """
+    algorithm, expected = checksum.split(':', 1) if checksum else (None, None)
+    part = path + '.part'
+    validator_file = part + '.validator'
+    # Without a validator or checksum there is no way to tell whether a
+    # .part file from an earlier call still matches the remote file
+    if not resume or not (checksum or os.path.exists(validator_file)):
+        for stale in (part, validator_file):
+            if os.path.exists(stale):
+                os.remove(stale)
+    get = session.get if session else requests.get
+    headers = dict(kwargs.pop('headers', None) or {})
+    start = time.time()
+    received = 0
+    digest = None
+    for attempt in range(1, attempts + 1):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset:
+            # Byte ranges refer to the encoded body, so ask for it unencoded
+            headers.update({'Range': 'bytes={}-'.format(offset),
+                            'Accept-Encoding': 'identity'})
+            if os.path.exists(validator_file):
+                with open(validator_file) as infile:
+                    headers['If-Range'] = infile.read()
+        else:
+            headers.pop('Range', None)
+            headers.pop('If-Range', None)
+        try:
+            r = get(url, stream=True, headers=headers, **kwargs)
+            try:
+                if offset and r.status_code == 416:
+                    # Range not satisfiable, start over
+                    os.remove(part)
+                    continue
+                r.raise_for_status()
+                resumed = offset and r.status_code == 206
+                if algorithm:
+                    # Hash the data already on disk, the rest as it arrives
+                    digest = file_digest(part, algorithm, chunk_size) \
+                        if resumed else hashlib.new(algorithm)
+                total = int(r.headers.get('Content-Length') or 0)
+                if total and resumed:
+                    total += offset
+                written = offset if resumed else 0
+                validator = r.headers.get('ETag') or \
+                    r.headers.get('Last-Modified')
+                if not resumed and validator:
+                    with open(validator_file, 'w') as outfile:
+                        outfile.write(validator)
+                elif not resumed and os.path.exists(validator_file):
+                    os.remove(validator_file)
+                next_report = 0.1
+                with open(part, 'ab' if resumed else 'wb') as outfile:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            outfile.write(chunk)
+                            received += len(chunk)
+                            written += len(chunk)
+                            if digest:
+                                digest.update(chunk)
+                            if total and written >= total * next_report:
+                                logger.debug("{}: {:.0%} of {} bytes".format(
+                                    url, float(written) / total, total))
+                                next_report = float(written) / total + 0.1
+            finally:
+                r.close()
+            break
+        except RESUMABLE_ERRORS:
+            if attempt == attempts:
+                raise
+            logger.warn("Download of {} interrupted, retrying ({}/{})".format(
+                url, attempt, attempts))
+    else:
+        raise requests.exceptions.RetryError(
+            "Could not download {}".format(url))
+    if digest and digest.hexdigest() != expected.lower():
+        for stale in (part, validator_file):
+            if os.path.exists(stale):
+                os.remove(stale)
+        raise IOError("Checksum mismatch for {}: expected {}, got {}".format(
+            url, expected, digest.hexdigest()))
+    os.rename(part, path)
+    if os.path.exists(validator_file):
+        os.remove(validator_file)
+    elapsed = max(time.time() - start, 0.001)
+    logger.info("Downloaded {} ({} bytes in {:.1f}s, {:.2f} MB/s)".format(
+        url, received, elapsed, received / elapsed / 1048576))
+    return path
+
+
+def http_signature(url, session=None, **kwargs):
+    """
+    Identify the current version of a remote file from the ETag,
+    Last-Modified and Content-Length headers of a HEAD request
+    :param url: URL of the file
+    :param session: Optional requests session to use
+    :param kwargs: Additional arguments for the HEAD request
+    :return: dict of header values, or None if the server sends none
+    """
+    head = session.head if session else requests.head
+    kwargs.setdefault('timeout', 60)
+    r = head(url, allow_redirects=True, **kwargs)
+    r.raise_for_status()
+    signature = {}
+    for header in ('ETag', 'Last-Modified', 'Content-Length'):
+        if r.headers.get(header):
+            signature[header.lower()] = r.headers[header]
+    if 'etag' in signature or 'last-modified' in signature:
+        return signature
+    return None
+
+
+def parse_http_date(value):
+    """
+    :param value: HTTP date string, i.e. from an Expires header
+    :return: seconds since the epoch, or None if not a valid date
+    """
+    parsed = parsedate_tz(value) if value else None
+    return mktime_tz(parsed) if parsed else None
+
+
+class CachedResponse(object):
+    """
+    Body and headers of a GET request served through HTTPCache
+    """
+
+    def __init__(self, url, content, headers, from_cache, unchanged):
+        self.url = url
+        self.content = content
+        self.headers = headers
+        # Served without contacting the server (still fresh)
+        # or after a 304 Not Modified response
+        self.from_cache = from_cache
+        # Content is the same as the last time the URL was retrieved
+        self.unchanged = unchanged
+
+
+class HTTPCache(object):
+    """
+    On-disk cache for GET requests, keyed by URL.  Responses are reused
+    while fresh according to Cache-Control/Expires, then revalidated with
+    If-None-Match/If-Modified-Since so unchanged pages are not downloaded
+    again.  The least recently used entries are removed once the cache
+    exceeds max_bytes.
+    """
+
+    def __init__(self, cache_dir=HTTP_CACHE_DIR,
+                 max_bytes=HTTP_CACHE_MAX_BYTES, session=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.session = session or PooledSession(timeout=60)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _paths(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        key = os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+        return key + '.json', key + '.body'
+
+    def _load(self, url):
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            with open(body_path, 'rb') as body_file:
+                content = body_file.read()
+        except (IOError, ValueError):
+            return None, None
+        # Record the access for LRU eviction
+        os.utime(body_path, None)
+        return meta, content
+
+    def _store(self, url, meta, content=None):
+        meta_path, body_path = self._paths(url)
+        files = [(meta_path, json.dumps(meta), 'w')]
+        if content is not None:
+            # Body first, so a reader never finds metadata without it
+            files.insert(0, (body_path, content, 'wb'))
+        for path, data, mode in files:
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, mode) as outfile:
+                outfile.write(data)
+            os.rename(tmp_path, path)
+        self.evict()
+
+    @staticmethod
+    def expiry(headers, now):
+        """
+        :param headers: Response headers
+        :param now: Time of the response
+        :return: Time until which the response is fresh (None = revalidate)
+        """
+        cache_control = headers.get('Cache-Control', '').lower()
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return None
+        max_age = re.search(r'max-age=(\d+)', cache_control)
+        if max_age:
+            return now + int(max_age.group(1))
+        return parse_http_date(headers.get('Expires'))
+
+    def get(self, url, **kwargs):
+        """
+        GET a URL through the cache
+        :param url: URL to retrieve
+        :param kwargs: Additional arguments for the GET request
+        :return: CachedResponse
+        """
+        meta, content = self._load(url)
+        now = time.time()
+        if meta and meta.get('expires') and now < meta['expires']:
+            return CachedResponse(url, content, meta['headers'], True, True)
+        headers = dict(kwargs.pop('headers', None) or {})
+        if meta:
+            if meta['headers'].get('ETag'):
+                headers['If-None-Match'] = meta['headers']['ETag']
+            if meta['headers'].get('Last-Modified'):
+                headers['If-Modified-Since'] = \
+                    meta['headers']['Last-Modified']
+        r = self.session.get(url, headers=headers, **kwargs)
+        if r.status_code == 304 and meta:
+            meta['expires'] = self.expiry(r.headers, now)
+            self._store(url, meta)
+            return CachedResponse(url, content, meta['headers'], True, True)
+        r.raise_for_status()
+        checksum = hashlib.sha1(r.content).hexdigest()
+        unchanged = meta is not None and meta.get('sha1') == checksum
+        response_headers = dict((key, r.headers[key]) for key in (
+            'ETag', 'Last-Modified', 'Content-Type') if key in r.headers)
+        if 'no-store' not in r.headers.get('Cache-Control', '').lower():
+            self._store(url, {
+                'url': url,
+                'headers': response_headers,
+                'expires': self.expiry(r.headers, now),
+                'sha1': checksum
+            }, r.content)
+        return CachedResponse(url, r.content, response_headers, False,
+                              unchanged)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.body'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for stale in (path, path[:-len('.body')] + '.json'):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir, name))
+
+
+_http_cache = None
+_http_cache_pid = None
+_http_cache_lock = threading.Lock()
+
+
+def get_http_cache():
+    """
+    Return the process-wide HTTPCache
+    :return: HTTPCache
+    """
+    global _http_cache, _http_cache_pid
+    with _http_cache_lock:
+        if _http_cache is None or _http_cache_pid != os.getpid():
+            _http_cache = HTTPCache()
+            _http_cache_pid = os.getpid()
+        return _http_cache
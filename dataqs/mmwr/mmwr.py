@@ -22,10 +22,12 @@ import logging
 import os
 from datetime import datetime, date, timedelta
 import re
+import StringIO
+from multiprocessing.pool import ThreadPool
 from requests import HTTPError
 import unicodecsv as csv
-from dataqs.helpers import ogr2ogr_exec, layer_exists, style_exists, \
-    postgres_query
+from dataqs.helpers import layer_exists, style_exists, postgres_query, \
+    postgres_transaction
 from dataqs.processor_base import GeoDataProcessor, DEFAULT_WORKSPACE
 from geonode.geoserver.helpers import ogc_server_settings
 
@@ -33,20 +35,48 @@ script_dir = os.path.dirname(os.path.realpath(__file__))
 
 logger = logging.getLogger("dataqs.processors")
 
-# Indicate what columns in csv are latitude, longitude
-vrt_content = ("""<OGRVRTDataSource>
-    <OGRVRTLayer name="{name}">
-        <SrcDataSource>{csv}</SrcDataSource>
-        <GeometryType>wkbPoint</GeometryType>
-        <LayerSRS>WGS84</LayerSRS>
-        <GeometryField encoding="PointFromColumns" x="lng" y="lat"/>
-    </OGRVRTLayer>
-</OGRVRTDataSource>
-""")
+# Columns of the weekly and archive tables, in the order of parsed rows
+MMWR_COLUMNS = ('place', 'lng', 'lat', 'all', 'a65', 'a45_64', 'a25_44',
+                'a01_24', 'a01', 'flu', 'report_date')
 
-# Column types for csv file
-csvt_content = '"String","Real","Real","Integer","Integer","Integer",' \
-               '"Integer","Integer","Integer","Integer","Date"'
+# Death counts, reported as e.g. '1,045', or 'U'/'-' when unavailable
+MMWR_COUNTS = ('all', 'a65', 'a45_64', 'a25_44', 'a01_24', 'a01', 'flu')
+
+MMWR_TYPES = {'lng': 'float8', 'lat': 'float8', 'report_date': 'date'}
+
+MMWR_TABLE_SQL = u"""
+CREATE TABLE IF NOT EXISTS {table}
+(
+  ogc_fid serial NOT NULL,
+  place character varying,
+  lng double precision,
+  lat double precision,
+  "all" integer,
+  a65 integer,
+  a45_64 integer,
+  a25_44 integer,
+  a01_24 integer,
+  a01 integer,
+  flu integer,
+  report_date date,
+  wkb_geometry geometry(Point, 4326),
+  CONSTRAINT {table}_pkey PRIMARY KEY (ogc_fid),
+  CONSTRAINT {table}_unique UNIQUE (place, report_date)
+);
+CREATE INDEX IF NOT EXISTS {table}_wkb_geometry_geom_idx
+ ON {table} USING gist (wkb_geometry);
+"""
+
+MMWR_STAGING_SQL = u"""
+CREATE TEMPORARY TABLE {staging} ({columns}) ON COMMIT DROP;
+"""
+
+MMWR_INSERT_SQL = u"""
+INSERT INTO {table} ({columns}, wkb_geometry)
+ SELECT {values}, ST_SetSRID(ST_MakePoint(lng::float8, lat::float8), 4326)
+ FROM {staging}
+ {conflict};
+"""
 
 
 class MortalityProcessor(GeoDataProcessor):
@@ -61,6 +91,8 @@ class MortalityProcessor(GeoDataProcessor):
                '&mmwr_location=Click+here+for+all+Locations&mmwr_table=4A' \
                '&mmwr_year={year}&mmwr_week={week:02d}'
     params = {}
+    pool_size = 4
+    _places = None
     description = """Mortality data voluntarily reported from 122 cities in the
 United States, most of which have populations of 100,000 or more. A death is
 reported by the place of its occurrence and by the week that the death
@@ -78,6 +110,9 @@ departments.\n\nSource: http://wonder.cdc.gov/mmwr/mmwr_2015.asp"""
         for key in kwargs.keys():
             self.params[key] = kwargs.get(key)
 
+        if 'pool_size' in kwargs.keys():
+            self.pool_size = kwargs['pool_size']
+
         if 'sdate' not in self.params:
             today = date.today()
             self.params['sdate'] = today.strftime("%Y-%m-%d")
@@ -88,17 +123,28 @@ departments.\n\nSource: http://wonder.cdc.gov/mmwr/mmwr_2015.asp"""
 
         super(MortalityProcessor, self).__init__(*args)
 
-    def generate_csv(self, report_date):
+    def get_report(self, report_date):
         """
-        Create a csv file from MWWR text reports
+        Download and parse the MMWR text report for a week
         :param report_date: Date of report
-        :return: None
+        :return: list of rows in the order of MMWR_COLUMNS
+        """
+        exportfile = self.fetch_report(report_date)
+        return self.parse_report(exportfile) if exportfile else []
+
+    def fetch_report(self, report_date, exportfile=None):
+        """
+        Download the report for the week of report_date, falling back to
+        up to three earlier weeks if it is not available yet.
+        :param report_date: Date of report
+        :param exportfile: Name of the downloaded file
+        :return: Name of the downloaded file, or None if no report was found
         """
-        csvfile = "{}.csv".format(self.prefix)
         week = report_date.isocalendar()[1]
         year = report_date.year
         logger.debug('Year {}, week {}'.format(year, week))
-        exportfile = '{}.txt'.format(self.prefix)
+        if not exportfile:
+            exportfile = '{}.txt'.format(self.prefix)
         for x in range(4):
             try:
                 exportfile = self.download(
@@ -109,7 +155,7 @@ departments.\n\nSource: http://wonder.cdc.gov/mmwr/mmwr_2015.asp"""
                     content = testfile.read().strip()
                     if content.startswith('<'):
                         raise HTTPError
-                    break
+                    return exportfile
             except HTTPError:
                 if x < 3:
                     year = year - 1 if week == 1 else year
@@ -119,74 +165,147 @@ departments.\n\nSource: http://wonder.cdc.gov/mmwr/mmwr_2015.asp"""
                     logger.error("Could not get year {} week {}".format(
                         year, week
                     ))
-                    return
 
-        with open(os.path.join(script_dir, 'resources/mmwr.json')) as jsonfile:
-            places = json.load(jsonfile)
+    @property
+    def places(self):
+        """
+        Coordinates of each reporting city, read once per process
+        :return: dict of place name: [lat, lng]
+        """
+        if MortalityProcessor._places is None:
+            with open(os.path.join(
+                    script_dir, 'resources/mmwr.json')) as jsonfile:
+                MortalityProcessor._places = json.load(jsonfile)
+        return MortalityProcessor._places
 
+    def parse_report(self, exportfile):
+        """
+        Read the city rows of a downloaded report
+        :param exportfile: Name of the downloaded file
+        :return: list of rows in the order of MMWR_COLUMNS
+        """
+        places = self.places
+        rows = []
         with open(os.path.join(self.tmp_dir, exportfile)) as openfile:
             reader = csv.reader(openfile, delimiter='\t')
+            report_date = None
+            for row in reader:
+                if len(row) == 1 and not report_date:
+                    datematch = re.search('week ending (.+)', row[0])
+                    if datematch:
+                        report_date = datetime.strptime(
+                            datematch.group(1), '%B %d, %Y')
+                        report_date = report_date.strftime('%Y-%m-%d')
+                if len(row) > 2:
+                    place = row[0]
+                    if place in places:
+                        match = places[place]
+                        row.insert(1, match[0])
+                        row.insert(1, match[1])
+                        row.insert(10, report_date)
+                        rows.append(row)
+                    elif place != 'TOTAL':
+                        raise Exception(
+                            'Could not find matching city: {}'.format(
+                                place))
+        return rows
+
+    def fetch_week(self, report_date):
+        """
+        Download and parse the report for one week of a backfill
+        :param report_date: Date of report
+        :return: list of rows
+        """
+        exportfile = self.fetch_report(
+            report_date, exportfile='{}_{}.txt'.format(
+                self.prefix, report_date.strftime('%Y%m%d')))
+        return self.parse_report(exportfile) if exportfile else []
+
+    def backfill(self, report_dates):
+        """
+        Download the reports for several weeks concurrently, merge them
+        and add them to the archive layer in one load.
+        :param report_dates: list of report dates
+        :return: None
+        """
+        pool = ThreadPool(max(1, min(self.pool_size, len(report_dates))))
+        try:
+            weeks = pool.map(self.fetch_week, report_dates)
+        finally:
+            pool.close()
+            pool.join()
+        # A missing week falls back to an earlier one that may also be
+        # requested on its own, so keep one row per place and date
+        rows = []
+        loaded = set()
+        for week in weeks:
+            for row in week:
+                if (row[0], row[10]) not in loaded:
+                    loaded.add((row[0], row[10]))
+                    rows.append(row)
+        if not rows:
+            logger.error("No MMWR reports found for backfill")
+            return
+        logger.info("Loading {} rows from {} weeks into the archive".format(
+            len(rows), len(report_dates)))
+        self.update_layer(self.titles[1], rows)
+
+    def load_rows(self, table, rows, replace=False):
+        """
+        COPY report rows into a temporary staging table, then insert them
+        into the layer table, building point geometries from lng/lat.
+        When appending, rows already in the table for the same place and
+        date are skipped.
+        :param table: Layer table name
+        :param rows: list of rows in the order of MMWR_COLUMNS
+        :param replace: Empty the table first
+        :return: number of rows inserted
+        """
+        staging = '{}_staging'.format(table)
+        buffer = StringIO.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        columns = ','.join('"{}"'.format(x) for x in MMWR_COLUMNS)
+        values = ','.join(
+            'CASE WHEN "{0}" ~ \'^[0-9,]+$\' '
+            'THEN replace("{0}", \',\', \'\')::integer END'.format(x)
+            if x in MMWR_COUNTS else '"{}"::{}'.format(
+                x, MMWR_TYPES.get(x, 'text'))
+            for x in MMWR_COLUMNS)
+        with postgres_transaction() as transaction:
+            postgres_query(MMWR_TABLE_SQL.format(table=table))
+            if replace:
+                postgres_query('TRUNCATE TABLE {};'.format(table))
+            postgres_query(MMWR_STAGING_SQL.format(
+                staging=staging,
+                columns=','.join('"{}" text'.format(x) for x in MMWR_COLUMNS)))
+            transaction.cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN WITH CSV;'.format(staging, columns),
+                buffer)
+            postgres_query(MMWR_INSERT_SQL.format(
+                table=table, staging=staging, columns=columns, values=values,
+                conflict='' if replace else
+                'ON CONFLICT (place, report_date) DO NOTHING'))
+            inserted = transaction.cursor.rowcount
+        logger.debug("Inserted {} of {} rows into {}".format(
+            inserted, len(rows), table))
+        return inserted
 
-            with open(os.path.join(self.tmp_dir, csvfile), 'w') as outfile:
-                writer = csv.writer(outfile)
-                headers = ['place', 'lng', 'lat', 'all', 'a65', 'a45_64',
-                           'a25_44', 'a01-24', 'a01', 'flu', 'report_date']
-                writer.writerow(headers)
-                report_date = None
-                for row in reader:
-                    if len(row) == 1 and not report_date:
-                        datematch = re.search('week ending (.+)', row[0])
-                        if datematch:
-                            report_date = datetime.strptime(
-                                datematch.group(1), '%B %d, %Y')
-                            report_date = report_date.strftime('%Y-%m-%d')
-                    if len(row) > 2:
-                        place = row[0]
-                        if place in places:
-                            match = places[place]
-                            row.insert(1, match[0])
-                            row.insert(1, match[1])
-                            row.insert(10, report_date)
-                            writer.writerow(row)
-                        elif place != 'TOTAL':
-                            raise Exception(
-                                'Could not find matching city: {}'.format(
-                                    place))
-
-    def update_layer(self, layer):
+    def update_layer(self, layer, rows):
         """
         Create or update the MMWR layer in GeoNode
         :param layer: Layer to update (weekly or archive)
+        :param rows: list of rows in the order of MMWR_COLUMNS
         :return: None
         """
-        csvfile = "{}.csv".format(self.prefix)
-        vrt_file = os.path.join(self.tmp_dir, '{}.vrt'.format(self.prefix))
-        csvt_file = os.path.join(self.tmp_dir, '{}.csvt'.format(self.prefix))
-        if not os.path.exists(vrt_file):
-            with open(vrt_file, 'w') as vrt:
-                vrt.write(vrt_content.format(
-                    name=csvfile.replace('.csv', ''),
-                    csv=os.path.join(self.tmp_dir, csvfile)))
-        if not os.path.exists(csvt_file):
-            with open(csvt_file, 'w') as csvt:
-                csvt.write(csvt_content)
-
-        db = ogc_server_settings.datastore_db
         table = '{}_{}'.format(self.prefix, layer).lower()
-        option = 'overwrite' if layer.lower() == 'weekly' else 'append'
-        ogr2ogr_exec("-{option} -skipfailures -f PostgreSQL \
-            \"PG:host={db_host} user={db_user} password={db_pass} \
-            dbname={db_name}\" {vrt} -nln {table}".format(
-            db_host=db["HOST"], db_user=db["USER"],
-            db_pass=db["PASSWORD"], db_name=db["NAME"],
-            vrt="{}".format(vrt_file), option=option, table=table))
+        if not rows:
+            logger.warn("No MMWR rows to load into {}".format(table))
+            return
+        self.load_rows(table, rows, replace=layer.lower() == 'weekly')
         if not layer_exists(table,
                             ogc_server_settings.server.get('DATASTORE'),
                             DEFAULT_WORKSPACE):
-            constraint = 'ALTER TABLE {table} ADD CONSTRAINT ' \
-                         '{table}_unique UNIQUE (place, report_date)'\
-                .format(table=table)
-            postgres_query(constraint, commit=True)
             self.post_geoserver_vector(table)
         if not style_exists(table):
             with open(os.path.join(
@@ -208,13 +327,13 @@ departments.\n\nSource: http://wonder.cdc.gov/mmwr/mmwr_2015.asp"""
         cur_date = datetime.strptime(self.params['edate'], '%Y-%m-%d')
         earliest_date = datetime.strptime(self.params['sdate'], '%Y-%m-%d')
 
-        self.generate_csv(cur_date)
-        self.update_layer(self.titles[0])
+        self.update_layer(self.titles[0], self.get_report(cur_date))
 
+        report_dates = []
         while cur_date >= earliest_date:
             cur_date = cur_date - timedelta(days=7)
-            self.generate_csv(cur_date)
-            self.update_layer(self.titles[1])
+            report_dates.append(cur_date)
+        self.backfill(report_dates)
         self.cleanup()
 
 if __name__ == '__main__':
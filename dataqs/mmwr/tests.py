@@ -22,9 +22,9 @@ import json
 import httpretty
 import os
 import datetime
+import mock
 from django.test import TestCase
-from dataqs.mmwr.mmwr import MortalityProcessor
-import unicodecsv as csv
+from dataqs.mmwr.mmwr import MortalityProcessor, MMWR_COLUMNS
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -58,16 +58,16 @@ class MMWRTest(TestCase):
             httpretty.GET,
             self.processor.base_url.format(week=2, year=2016),
             body=test_data())
-        self.processor.generate_csv(report_date)
+        self.processor.get_report(report_date)
         output = os.path.join(
             self.processor.tmp_dir, '{}.txt'.format(self.processor.prefix))
         self.assertTrue(os.path.exists(output))
         with open(output) as ofile:
             self.assertEquals(ofile.read(), test_data())
 
-    def test_generate_csv(self):
+    def test_get_report(self):
         """
-        Verify that a correct csv file is generated
+        Verify that report rows are matched to city coordinates
         :return:
         """
         report_date = datetime.date(2016, 1, 15)
@@ -75,23 +75,36 @@ class MMWRTest(TestCase):
             httpretty.GET,
             self.processor.base_url.format(week=2, year=2016),
             body=test_data())
-        self.processor.generate_csv(report_date)
-        output = os.path.join(
-            self.processor.tmp_dir, '{}.csv'.format(self.processor.prefix))
-        self.assertTrue(os.path.exists(output))
-        with open(output) as ofile:
-            reader = csv.reader(ofile)
-            headers = reader.next()
-            with open(os.path.join(script_dir, 'resources/mmwr.json')) as locs:
-                locations = json.load(locs)
-            self.assertEquals(
-                headers, ['place', 'lng', 'lat', 'all', 'a65',
-                          'a45_64', 'a25_44', 'a01-24', 'a01', 'flu',
-                          'report_date'])
-            for row in reader:
-                self.assertIn(row[0], locations)
-                self.assertEquals(float(row[1]), locations[row[0]][1])
-                self.assertEquals(float(row[2]), locations[row[0]][0])
+        rows = self.processor.get_report(report_date)
+        self.assertTrue(rows)
+        with open(os.path.join(script_dir, 'resources/mmwr.json')) as locs:
+            locations = json.load(locs)
+        for row in rows:
+            self.assertEquals(len(MMWR_COLUMNS), len(row))
+            self.assertIn(row[0], locations)
+            self.assertEquals(float(row[1]), locations[row[0]][1])
+            self.assertEquals(float(row[2]), locations[row[0]][0])
+            self.assertEquals('2016-01-16', row[10])
+
+    @mock.patch('dataqs.mmwr.mmwr.postgres_query')
+    @mock.patch('dataqs.mmwr.mmwr.postgres_transaction')
+    def test_load_rows(self, transaction_mock, query_mock):
+        """
+        Verify that rows are copied into staging and merged in one query
+        """
+        transaction = transaction_mock.return_value.__enter__.return_value
+        transaction.cursor.rowcount = 1
+        self.processor.load_rows('mmwr_archive', [
+            [u'Boston, Mass.', -71.05888, 42.360083, u'1,045', u'U', u'-',
+             u'10', u'4', u'5', u'7', u'2016-01-16']])
+        copy_sql, copied = transaction.cursor.copy_expert.call_args[0]
+        self.assertIn('mmwr_archive_staging', copy_sql)
+        self.assertEquals(u'"Boston, Mass.",-71.05888,42.360083,"1,045",U,-,'
+                          u'10,4,5,7,2016-01-16\r\n', copied.getvalue())
+        queries = [call[0][0] for call in query_mock.call_args_list]
+        self.assertFalse([x for x in queries if 'TRUNCATE' in x])
+        self.assertIn('ON CONFLICT (place, report_date) DO NOTHING',
+                      queries[-1])
 
     def test_cleanup(self):
         report_date = datetime.date(2016, 1, 15)
@@ -99,9 +112,26 @@ class MMWRTest(TestCase):
             httpretty.GET,
             self.processor.base_url.format(week=2, year=2016),
             body=test_data())
-        self.processor.generate_csv(report_date)
+        self.processor.get_report(report_date)
         self.assertNotEqual([], glob.glob(os.path.join(
             self.processor.tmp_dir, self.processor.prefix + '*')))
         self.processor.cleanup()
         self.assertEquals([], glob.glob(os.path.join(
             self.processor.tmp_dir, self.processor.prefix + '*')))
+
+    @mock.patch('dataqs.mmwr.mmwr.MortalityProcessor.update_layer')
+    def test_backfill(self, update_mock):
+        """
+        Verify that all weeks are merged into one archive load, without
+        duplicating a week returned for more than one date
+        """
+        for week in (1, 2):
+            httpretty.register_uri(
+                httpretty.GET,
+                self.processor.base_url.format(week=week, year=2016),
+                body=test_data())
+        single_week = self.processor.get_report(datetime.date(2016, 1, 15))
+        self.processor.backfill([datetime.date(2016, 1, 8),
+                                 datetime.date(2016, 1, 15)])
+        update_mock.assert_called_once_with(
+            self.processor.titles[1], single_week)
@@ -20,13 +20,13 @@
 from __future__ import absolute_import
 
 import glob
-from ftplib import FTP
 import logging
 import os
 import datetime
 import re
 import shutil
 from django.conf import settings
+from dataqs.ftp_helpers import get_ftp_client
 from dataqs.processor_base import GeoDataMosaicProcessor
 from dataqs.helpers import gdal_translate, style_exists
 
@@ -47,6 +47,7 @@ class GPMProcessor(GeoDataMosaicProcessor):
     """
 
     base_url = "jsimpson.pps.eosdis.nasa.gov"
+    base_path = "/NRTPUB/imerg/gis/early"
     layername_prefix = 'nasa_gpm_'
     prefix = '3B-HHR-E.MS.MRG.3IMERG.'
     layer_name = 'nasa_gpm_24hr'
@@ -64,20 +65,17 @@ successively providing better estimates as more data arrive.
 \n\nSource: http://pmm.nasa.gov/data-access/downloads/gpm"""
 
     def download(self, auth_account=GPM_ACCOUNT, tmp_dir=GS_TMP_DIR, days=1):
-        ftp = FTP(self.base_url)
-        ftp.login(auth_account, auth_account)
-        ftp.cwd('/NRTPUB/imerg/gis/early')
-        file_list = ftp.nlst()
+        client = get_ftp_client(self.base_url, auth_account, auth_account)
+        file_list = client.nlst(self.base_path)
         pattern = '.+\.1day\.tif' if days == 1 else '.+\-S120000\-.+\.1day\.tif'
         re_1day = re.compile(pattern)
         files = sorted([x for x in file_list if re_1day.search(x)])[-days:]
+        dl_files = []
         for file_1day in files:
-            with open(os.path.join(self.tmp_dir, file_1day), 'wb') as outfile:
-                ftp.retrbinary('RETR %s' % file_1day, outfile.write)
-
-            tfw_file = file_1day.replace('.tif', '.tfw')
-            with open(os.path.join(self.tmp_dir, tfw_file), 'wb') as outfile:
-                ftp.retrbinary('RETR %s' % tfw_file, outfile.write)
+            for filename in (file_1day, file_1day.replace('.tif', '.tfw')):
+                dl_files.append(
+                    (filename, os.path.join(self.tmp_dir, filename)))
+        client.retrieve_many(self.base_path, dl_files)
         return files
 
     def parse_name(self, tifname):
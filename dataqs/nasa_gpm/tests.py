@@ -28,7 +28,7 @@ from mock import patch
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
 
-def mock_retrbinary(self, name, writer):
+def mock_retrbinary(self, name, writer, *args):
     """
     Mocks the ftplib.FTP.retrbinary method, writes test image to disk.
     """
@@ -79,6 +79,7 @@ class NasaGpmTest(TestCase):
     @patch('ftplib.FTP.nlst', mock_nlst)
     @patch('ftplib.FTP.connect', mock_none)
     @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
     @patch('ftplib.FTP.cwd', mock_none)
     def test_download(self, mock_ftp):
         """
@@ -106,6 +107,7 @@ class NasaGpmTest(TestCase):
     @patch('ftplib.FTP.nlst', mock_nlst)
     @patch('ftplib.FTP.connect', mock_none)
     @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
     @patch('ftplib.FTP.cwd', mock_none)
     def test_convert_image(self, mock_ftp):
         """
@@ -122,6 +124,7 @@ class NasaGpmTest(TestCase):
     @patch('ftplib.FTP.nlst', mock_nlst)
     @patch('ftplib.FTP.connect', mock_none)
     @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
     @patch('ftplib.FTP.cwd', mock_none)
     def test_cleanup(self, mock_ftp):
         """
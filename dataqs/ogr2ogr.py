@@ -143,6 +143,12 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
     global bPreserveFID
     global nFIDToFetch
 
+    #/* Reset options left over from a previous call in this process */
+    bSkipFailures = False
+    nGroupTransactions = 200
+    bPreserveFID = False
+    nFIDToFetch = ogr.NullFID
+
     pszFormat = "ESRI Shapefile"
     pszDataSource = None
     pszDestDataSource = None
@@ -223,7 +229,6 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
 
         elif len(args[iArg]) >= 5 and EQUAL(args[iArg][0:5], "-skip"):
             bSkipFailures = True
-            nGroupTransactions = 1 # /* #2409 */
 
         elif EQUAL(args[iArg],"-append"):
             bAppend = True
@@ -1490,6 +1495,47 @@ def SetupTargetLayer( poSrcDS, poSrcLayer, poDstDS, papszLCO, pszNewLayerName, \
 
     return psInfo
 
+#/************************************************************************/
+#/*                            ReplayGroup()                             */
+#/*                                                                      */
+#/*      Re-create the features of a group transaction that was rolled   */
+#/*      back because another feature failed.  They are retried in a new */
+#/*      transaction, which is left open, and if that fails as well one  */
+#/*      by one so that only the bad features are skipped.  Returns the  */
+#/*      features pending in the open transaction.                       */
+#/************************************************************************/
+
+def ReplayGroup(poDstLayer, apsPending):
+
+    poDstLayer.StartTransaction()
+    for poDstFeature, nDstFID in apsPending:
+        poDstFeature.SetFID(nDstFID)
+        gdal.ErrorReset()
+        if poDstLayer.CreateFeature( poDstFeature ) != 0:
+            poDstLayer.RollbackTransaction()
+            ReplayFeatures(poDstLayer, apsPending)
+            poDstLayer.StartTransaction()
+            return []
+
+    return apsPending
+
+#/************************************************************************/
+#/*                           ReplayFeatures()                           */
+#/*                                                                      */
+#/*      Re-create features one per transaction, skipping failures.      */
+#/************************************************************************/
+
+def ReplayFeatures(poDstLayer, apsPending):
+
+    for poDstFeature, nDstFID in apsPending:
+        poDstFeature.SetFID(nDstFID)
+        poDstLayer.StartTransaction()
+        gdal.ErrorReset()
+        if poDstLayer.CreateFeature( poDstFeature ) != 0:
+            poDstLayer.RollbackTransaction()
+        elif poDstLayer.CommitTransaction() != 0:
+            print("Failed to commit feature, skipping it.")
+
 #/************************************************************************/
 #/*                           TranslateLayer()                           */
 #/************************************************************************/
@@ -1527,7 +1573,17 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
     nFeaturesInTransaction = 0
     nCount = 0
 
-    if nGroupTransactions > 0:
+    #/* With -skipfailures, features are still committed in groups: a group */
+    #/* with a failed feature is rolled back and replayed without it.  This */
+    #/* needs real transactions, otherwise commit feature by feature (#2409) */
+    nGroupSize = nGroupTransactions
+    if bSkipFailures and nGroupSize > 1 and \
+            not poDstLayer.TestCapability(ogr.OLCTransactions):
+        nGroupSize = 1
+    bReplayFailures = bSkipFailures and nGroupSize > 1
+    apsPending = []
+
+    if nGroupSize > 0:
         poDstLayer.StartTransaction()
 
     while True:
@@ -1536,7 +1592,7 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
         if nFIDToFetch != ogr.NullFID:
 
             #// Only fetch feature on first pass.
-            if nFeaturesInTransaction == 0:
+            if nCount == 0:
                 poFeature = poSrcLayer.GetFeature(nFIDToFetch)
             else:
                 poFeature = None
@@ -1563,9 +1619,10 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
                             nIters = 1
 
         for iPart in range(nIters):
-            nFeaturesInTransaction = nFeaturesInTransaction + 1
-            if nFeaturesInTransaction == nGroupTransactions:
-                poDstLayer.CommitTransaction()
+            if nGroupSize > 0 and nFeaturesInTransaction == nGroupSize:
+                if poDstLayer.CommitTransaction() != 0 and bReplayFailures:
+                    ReplayFeatures(poDstLayer, apsPending)
+                apsPending = []
                 poDstLayer.StartTransaction()
                 nFeaturesInTransaction = 0
 
@@ -1574,7 +1631,7 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
 
             if poDstFeature.SetFromWithMap( poFeature, 1, panMap ) != 0:
 
-                if nGroupTransactions > 0:
+                if nGroupSize > 0:
                     poDstLayer.CommitTransaction()
 
                 print("Unable to translate feature %d from layer %s" % (poFeature.GetFID() , poSrcLayer.GetName() ))
@@ -1629,12 +1686,12 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
                 if poCT is not None:
                     eErr = poDstGeometry.Transform( poCT )
                     if eErr != 0:
-                        if nGroupTransactions > 0:
-                            poDstLayer.CommitTransaction()
-
                         print("Failed to reproject feature %d (geometry probably out of source or destination SRS)." % poFeature.GetFID())
                         if not bSkipFailures:
+                            if nGroupSize > 0:
+                                poDstLayer.CommitTransaction()
                             return False
+                        continue
 
                 elif poOutputSRS is not None:
                     poDstGeometry.AssignSpatialReference(poOutputSRS)
@@ -1659,11 +1716,21 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
                     poDstFeature.SetGeometryDirectly(ogr.ForceToMultiLineString(poDstGeometry))
 
             gdal.ErrorReset()
-            if poDstLayer.CreateFeature( poDstFeature ) != 0 and not bSkipFailures:
-                if nGroupTransactions > 0:
+            nDstFID = poDstFeature.GetFID()
+            if poDstLayer.CreateFeature( poDstFeature ) != 0:
+                if bReplayFailures:
                     poDstLayer.RollbackTransaction()
+                    apsPending = ReplayGroup(poDstLayer, apsPending)
+                    nFeaturesInTransaction = len(apsPending)
+                elif not bSkipFailures:
+                    if nGroupSize > 0:
+                        poDstLayer.RollbackTransaction()
 
-                return False
+                    return False
+            else:
+                nFeaturesInTransaction = nFeaturesInTransaction + 1
+                if bReplayFailures:
+                    apsPending.append((poDstFeature, nDstFID))
 
         #/* Report progress */
         nCount = nCount  + 1
@@ -1684,8 +1751,9 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
         if pnReadFeatureCount is not None:
             pnReadFeatureCount[0] = nCount
 
-    if nGroupTransactions > 0:
-        poDstLayer.CommitTransaction()
+    if nGroupSize > 0:
+        if poDstLayer.CommitTransaction() != 0 and bReplayFailures:
+            ReplayFeatures(poDstLayer, apsPending)
 
     return True
 
@@ -25,13 +25,15 @@ import logging
 from time import sleep
 from urlparse import urljoin
 from zipfile import ZipFile
-from geoserver.catalog import Catalog, FailedRequestError
+from geoserver.catalog import FailedRequestError
 import os
 import datetime
-import requests
 from django.conf import settings
 import shutil
-from dataqs.helpers import get_html, add_keywords
+from dataqs.helpers import get_html, add_keywords, exists_cache, \
+    get_gs_catalog
+from dataqs.http_helpers import get_gs_session, stream_download, \
+    DOWNLOAD_ATTEMPTS, DOWNLOAD_CHUNK_SIZE
 from geonode.geoserver.helpers import ogc_server_settings, gs_catalog, get_store
 from geonode.geoserver.management.commands.updatelayers import Command \
     as UpdateLayersCommand
@@ -42,6 +44,9 @@ DEFAULT_WORKSPACE = getattr(settings, 'DEFAULT_WORKSPACE', 'geonode')
 GS_DATA_DIR = getattr(settings, 'GS_DATA_DIR', '/data/geodata')
 GS_TMP_DIR = getattr(settings, 'GS_TMP_DIR', '/tmp')
 RSYNC_WAIT_TIME = getattr(settings, 'RSYNC_WAIT_TIME', 0)
+BAND_EXPORT_PROCESSES = getattr(settings, 'BAND_EXPORT_PROCESSES', 1)
+SOURCE_STATE_DIR = getattr(settings, 'SOURCE_STATE_DIR',
+                           os.path.join(GS_TMP_DIR, 'dataqs_state'))
 
 GPMOSAIC_COVERAGE_JSON = """{
     "coverage": {
@@ -96,6 +101,8 @@ class GeoDataProcessor(object):
     gs_url = base_url + "{}/coveragestores/{}/file.geotiff"
     gs_vec_url = base_url + "{}/datastores/{}/featuretypes"
     gs_style_url = "http://{}:8080/geoserver/rest/styles/"
+    chunk_size = DOWNLOAD_CHUNK_SIZE
+    download_attempts = DOWNLOAD_ATTEMPTS
 
     def __init__(self, workspace=DEFAULT_WORKSPACE, tmp_dir=None,
                  **kwargs):
@@ -107,28 +114,36 @@ class GeoDataProcessor(object):
         if 'days' in kwargs.keys():
             self.days = kwargs['days']
 
-    def download(self, url, filename=None, html=False):
+    @property
+    def gs_session(self):
         """
-        Download a file from the specified URL
+        Shared, authenticated connection pool for GeoServer REST requests
+        """
+        return get_gs_session()
+
+    def download(self, url, filename=None, html=False, checksum=None):
+        """
+        Download a file from the specified URL.  The file is streamed to
+        <filename>.part, which is resumed with an HTTP Range request if the
+        connection drops or a previous download was interrupted, and renamed
+        to filename once complete.
         :param url: The URL to download from
         :param filename: Optional name of the downloaded file.
+        :param html: Return the content of the URL instead of saving it
+        :param checksum: Optional expected digest, '<algorithm>:<hexdigest>'
         :return: Name of the downloaded file (not including path).
         """
         if not filename:
             filename = url.rsplit('/')[-1]
         if html:
             return get_html(url)
-        r = requests.get(url, stream=True)
-        with open(os.path.join(self.tmp_dir, filename), 'wb') as out_file:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
-                    out_file.write(chunk)
-                    out_file.flush()
-        r.raise_for_status()
+        stream_download(url, os.path.join(self.tmp_dir, filename),
+                        chunk_size=self.chunk_size, resume=True,
+                        attempts=self.download_attempts, checksum=checksum,
+                        timeout=120)
         return filename
 
     def truncate_gs_cache(self, layer_name):
-        _user, _password = ogc_server_settings.credentials
         gwc_url = "{base_url}gwc/rest/seed/{ws}:{layer}.json".format(
             base_url=ogc_server_settings.LOCATION,
             ws=self.workspace,
@@ -145,9 +160,9 @@ class GeoDataProcessor(object):
                 'threadCount': 4
             }
         })
-        res = requests.post(url=gwc_url, data=truncate_json,
-                            auth=(_user, _password),
-                            headers={"Content-type": "application/json"})
+        res = self.gs_session.post(
+            url=gwc_url, data=truncate_json,
+            headers={"Content-type": "application/json"})
         res.raise_for_status()
 
     def post_geoserver(self, tif_file, layer_name):
@@ -162,13 +177,12 @@ class GeoDataProcessor(object):
         data = None
         with open(os.path.join(self.tmp_dir, tif_file), 'rb') as tif_binary:
             data = tif_binary.read()
-        _user, _password = ogc_server_settings.credentials
-        res = requests.put(url=gs_url,
-                           data=data,
-                           auth=(_user, _password),
-                           headers={'Content-Type': 'image/tif'})
+        res = self.gs_session.put(url=gs_url,
+                                  data=data,
+                                  headers={'Content-Type': 'image/tif'})
 
         res.raise_for_status()
+        exists_cache.invalidate('layer', layer_name)
         return res.content
 
     def verify_store(self, store, workspace=DEFAULT_WORKSPACE):
@@ -202,13 +216,12 @@ class GeoDataProcessor(object):
         gs_url = self.gs_vec_url.format(ogc_server_settings.hostname,
                                         self.workspace, store)
         data = "<featureType><name>{}</name></featureType>".format(layer_name)
-        _user, _password = ogc_server_settings.credentials
-        res = requests.post(url=gs_url,
-                            data=data,
-                            auth=(_user, _password),
-                            headers={'Content-Type': 'text/xml'})
+        res = self.gs_session.post(url=gs_url,
+                                   data=data,
+                                   headers={'Content-Type': 'text/xml'})
 
         res.raise_for_status()
+        exists_cache.invalidate('layer', layer_name)
         return res.content
 
     def update_gs_metadata(self, layer_name, json_data, vector=False,
@@ -230,9 +243,9 @@ class GeoDataProcessor(object):
                                         self.workspace, store).replace(
                 'file.geotiff', '')
             gs_url += "/{lyr}.json".format(lyr=layer_name)
-        _user, _password = ogc_server_settings.credentials
-        res = requests.put(url=gs_url, data=json_data, auth=(_user, _password),
-                           headers={'Content-Type': 'application/json'})
+        res = self.gs_session.put(
+            url=gs_url, data=json_data,
+            headers={'Content-Type': 'application/json'})
         res.raise_for_status()
         return res.content
 
@@ -264,10 +277,7 @@ class GeoDataProcessor(object):
                 from geonode.layers.models import Layer
                 res = lyr.gs_resource
                 res.native_bbox = bounds
-                _user, _password = ogc_server_settings.credentials
-                url = ogc_server_settings.rest
-                gs_catalog = Catalog(url, _user, _password)
-                gs_catalog.save(res)
+                get_gs_catalog().save(res)
             if extra_keywords:
                 assert isinstance(extra_keywords, list)
                 now = datetime.datetime.now().isoformat()
@@ -276,10 +286,7 @@ class GeoDataProcessor(object):
                 res = lyr.gs_resource
                 keywords = add_keywords(res.keywords, extra_keywords)
                 res.keywords = keywords
-                _user, _password = ogc_server_settings.credentials
-                url = ogc_server_settings.rest
-                gs_catalog = Catalog(url, _user, _password)
-                gs_catalog.save(res)
+                get_gs_catalog().save(res)
 
     def set_default_style(self, layer_name, sld_name, sld_content,
                           create=True):
@@ -293,16 +300,14 @@ class GeoDataProcessor(object):
         """
 
         gs_url = self.gs_style_url.format(ogc_server_settings.hostname)
-        _user, _password = ogc_server_settings.credentials
 
         if create:
             # Create the style
             s = "<style><name>{n}</name><filename>{n}.sld</filename></style>"
             data = s.format(n=sld_name)
-            res = requests.post(url=gs_url,
-                                data=data,
-                                auth=(_user, _password),
-                                headers={'Content-Type': 'text/xml'})
+            res = self.gs_session.post(url=gs_url,
+                                       data=data,
+                                       headers={'Content-Type': 'text/xml'})
 
             res.raise_for_status()
 
@@ -310,14 +315,13 @@ class GeoDataProcessor(object):
             data = sld_content
             url = urljoin(gs_url, sld_name)
             logger.debug(url)
-            res = requests.put(url=url,
-                               data=data,
-                               auth=(_user, _password),
-                               headers={
-                                   'Content-Type': 'application/vnd.ogc.sld+xml'
-                               })
+            res = self.gs_session.put(
+                url=url,
+                data=data,
+                headers={'Content-Type': 'application/vnd.ogc.sld+xml'})
 
             res.raise_for_status()
+            exists_cache.invalidate('style', sld_name)
 
         # Assign to the layer
         layer_typename = "{}%3A{}".format(DEFAULT_WORKSPACE, layer_name)
@@ -326,14 +330,49 @@ class GeoDataProcessor(object):
             sld_name)
         url = urljoin(gs_url.replace("styles", "layers"), layer_typename)
         logger.debug(url)
-        res = requests.put(
+        res = self.gs_session.put(
             url=url,
             data=data,
-            auth=(_user, _password),
             headers={'Content-Type': 'text/xml'})
 
         res.raise_for_status()
 
+    def source_changed(self, key, signature):
+        """
+        Determine if an upstream source has changed since the last time
+        it was successfully processed
+        :param key: Unique name for the source
+        :param signature: Current signature (size, modification time, etc)
+        of the source, or None if unknown
+        :return: False if the signature matches the recorded one
+        """
+        if not signature:
+            return True
+        state_file = os.path.join(SOURCE_STATE_DIR, '{}.json'.format(key))
+        if not os.path.exists(state_file):
+            return True
+        with open(state_file) as state:
+            try:
+                return json.load(state) != signature
+            except ValueError:
+                return True
+
+    def save_source_signature(self, key, signature):
+        """
+        Record the signature of a successfully processed upstream source
+        :param key: Unique name for the source
+        :param signature: Signature of the source
+        :return: None
+        """
+        if not signature:
+            return
+        if not os.path.exists(SOURCE_STATE_DIR):
+            os.makedirs(SOURCE_STATE_DIR)
+        state_file = os.path.join(SOURCE_STATE_DIR, '{}.json'.format(key))
+        with open(state_file + '.tmp', 'w') as state:
+            json.dump(signature, state)
+        os.rename(state_file + '.tmp', state_file)
+
     def cleanup(self):
         """
         Remove any files in the temp directory matching
@@ -360,6 +399,9 @@ class GeoDataMosaicProcessor(GeoDataProcessor):
                                 'coverages/{}/index/granules')
     create_url = gs_url.replace('external.imagemosaic', 'file.imagemosaic')
 
+    # Number of processes used to extract bands from multi-band sources
+    export_processes = BAND_EXPORT_PROCESSES
+
     archive_hours = ("T12:00:00.000Z",)
     days_to_keep = 30
     data_dir = "{gsd}/data/{ws}/{layer}/{file}"
@@ -371,8 +413,7 @@ class GeoDataMosaicProcessor(GeoDataProcessor):
         :param url: URL indicating which image from which mosaic to delete
         :return: response status and content
         """
-        _user, _password = ogc_server_settings.credentials
-        r = requests.delete(url, auth=(_user, _password))
+        r = self.gs_session.delete(url)
         r.raise_for_status()
         return r.status_code, r.content
 
@@ -386,17 +427,64 @@ class GeoDataMosaicProcessor(GeoDataProcessor):
         gs_url = self.gs_url.format(ogc_server_settings.hostname,
                                     self.workspace, layer_name)
         data = "file://{}".format(filepath)
-        _user, _password = ogc_server_settings.credentials
-        res = requests.post(url=gs_url,
-                            data=data,
-                            auth=(_user, _password),
-                            headers={'Content-Type': 'text/plain'})
+        res = self.gs_session.post(url=gs_url,
+                                   data=data,
+                                   headers={'Content-Type': 'text/plain'})
         if res.status_code == 405:
             logger.warn("Mosaic may not exist, try to create it")
             self.create_mosaic(layer_name, filepath)
         else:
             res.raise_for_status()
 
+    def get_harvest_dir(self, layer_name):
+        """
+        Create a new, empty directory within a mosaic's data directory,
+        to collect images for harvest_geoserver
+        :param layer_name: Name of the layer & store (assumed to be same)
+        :return: Full path of the directory
+        """
+        harvest_dir = self.data_dir.format(
+            gsd=GS_DATA_DIR, ws=self.workspace, layer=layer_name,
+            file='harvest_{}_{}'.format(
+                datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'),
+                os.getpid()))
+        if not os.path.exists(harvest_dir):
+            os.makedirs(harvest_dir)
+        return harvest_dir
+
+    def harvest_geoserver(self, harvest_dir, layer_name,
+                          sleeptime=RSYNC_WAIT_TIME):
+        """
+        Add all the images in a directory to a mosaic datastore with a
+        single harvest request, waiting for rsync only once.  If the store
+        rejects the harvest, the images are added one at a time.
+        :param harvest_dir: Directory containing only images not yet
+        in the mosaic (see get_harvest_dir)
+        :param layer_name: Name of the layer & store (assumed to be same)
+        :return: None
+        """
+        filepaths = sorted(glob.glob(os.path.join(harvest_dir, '*.tif')))
+        if not filepaths:
+            return
+        sleep(sleeptime)
+        gs_url = self.gs_url.format(ogc_server_settings.hostname,
+                                    self.workspace, layer_name)
+        res = self.gs_session.post(url=gs_url,
+                                   data="file://{}".format(harvest_dir),
+                                   headers={'Content-Type': 'text/plain'})
+        if res.status_code == 405:
+            logger.warn("Mosaic may not exist, try to create it")
+            self.create_mosaic(layer_name, filepaths[0])
+            filepaths = filepaths[1:]
+        elif res.status_code >= 400:
+            logger.warn("Harvest of {} failed ({}), adding {} images "
+                        "individually".format(harvest_dir, res.status_code,
+                                              len(filepaths)))
+        else:
+            return
+        for filepath in filepaths:
+            self.post_geoserver(filepath, layer_name, sleeptime=0)
+
     def remove_mosaic_granules(self, mosaic_url, mosaic_query, layer_name):
         """
         Remove granules from an image mosaic based on query parameters
@@ -405,10 +493,8 @@ class GeoDataMosaicProcessor(GeoDataProcessor):
         :param layer_name: The name of the image mosaic layer
         :return: None
         """
-        _user, _password = ogc_server_settings.credentials
-        r = requests.get("{url}.json?filter={query}".format(
-            url=mosaic_url, query=mosaic_query),
-            auth=(_user, _password))
+        r = self.gs_session.get("{url}.json?filter={query}".format(
+            url=mosaic_url, query=mosaic_query))
         r.raise_for_status()
         fc = json.loads(r.content)
         for feature in fc['features']:
@@ -463,7 +549,6 @@ class GeoDataMosaicProcessor(GeoDataProcessor):
         :param nowtime: Current date/time
         :param layer_name: Geoserver mosaic store/layer name
         """
-        _user, _password = ogc_server_settings.credentials
         month_cutoff = (nowtime - datetime.timedelta(
             days=self.days_to_keep)).strftime("%Y-%m-%dT00:00:00.000Z")
         mosaic_index_url = self.mosaic_url.format(ogc_server_settings.hostname,
@@ -475,11 +560,10 @@ class GeoDataMosaicProcessor(GeoDataProcessor):
 
     def get_mosaic_filenames(self, layer_name):
         """
-        Return a list of filenames in a mosaic
+        Return a list of filenames (without directories) in a mosaic
         :param layer_name:
         :return:
         """
-        _user, _password = ogc_server_settings.credentials
         mosaic_index_url = '{}.json'.format(
             self.mosaic_url.format(ogc_server_settings.hostname,
                                    self.workspace,
@@ -488,10 +572,10 @@ class GeoDataMosaicProcessor(GeoDataProcessor):
         )
         files = []
         try:
-            r = requests.get(
-                mosaic_index_url, timeout=30, auth=(_user, _password))
+            r = self.gs_session.get(mosaic_index_url, timeout=30)
             for feature in r.json()['features']:
-                files.append(feature['properties']['location'])
+                files.append(os.path.basename(
+                    feature['properties']['location']))
         finally:
             return files
 
@@ -551,24 +635,20 @@ class GeoDataMosaicProcessor(GeoDataProcessor):
         try:
             with open(ziploc, 'rb') as zipdata:
                 data = zipdata.read()
-                _user, _password = ogc_server_settings.credentials
-                res = requests.put(url=gs_url,
-                                   data=data,
-                                   auth=(_user, _password),
-                                   headers={
-                                       'Content-Type': 'application/zip'}
-                                   )
+                res = self.gs_session.put(
+                    url=gs_url,
+                    data=data,
+                    headers={'Content-Type': 'application/zip'})
                 res.raise_for_status()
                 gs_url = gs_url.replace(
                     'file.imagemosaic',
                     'coverages/{}.json'.format(layer_name))
-                res = requests.put(url=gs_url,
-                                   data=GPMOSAIC_COVERAGE_JSON,
-                                   auth=(_user, _password),
-                                   headers={
-                                       'Content-Type': 'application/json'
-                                   })
+                res = self.gs_session.put(
+                    url=gs_url,
+                    data=GPMOSAIC_COVERAGE_JSON,
+                    headers={'Content-Type': 'application/json'})
                 res.raise_for_status()
+                exists_cache.invalidate('layer', layer_name)
         finally:
             if os.path.exists(ziploc):
                 shutil.rmtree(os.path.dirname(ziploc))
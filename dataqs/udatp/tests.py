@@ -19,6 +19,8 @@
 
 import glob
 import os
+import shutil
+import tempfile
 import unittest
 from datetime import date
 from django.test import TestCase
@@ -28,7 +30,7 @@ from mock import patch
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
 
-def mock_retrbinary_nc(self, name, writer):
+def mock_retrbinary_nc(self, name, writer, *args):
     """
     Mocks the ftplib.FTP.retrbinary method, writes test image to disk.
     """
@@ -37,7 +39,7 @@ def mock_retrbinary_nc(self, name, writer):
     return None
 
 
-def mock_retrbinary_tif(self, name, writer):
+def mock_retrbinary_tif(self, name, writer, *args):
     """
     Mocks the ftplib.FTP.retrbinary method, writes test image to disk.
     """
@@ -70,6 +72,7 @@ class UoDAirTempPrecipTest(TestCase):
     @patch('ftplib.FTP.retrbinary', mock_retrbinary_nc)
     @patch('ftplib.FTP.connect', mock_none)
     @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
     @patch('ftplib.FTP.cwd', mock_none)
     def test_download(self, ftp_mock):
         """
@@ -83,6 +86,7 @@ class UoDAirTempPrecipTest(TestCase):
     @patch('ftplib.FTP.retrbinary', mock_retrbinary_nc)
     @patch('ftplib.FTP.connect', mock_none)
     @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
     @patch('ftplib.FTP.cwd', mock_none)
     def test_cleanup(self, ftp_mock):
         self.processor.download()
@@ -92,6 +96,39 @@ class UoDAirTempPrecipTest(TestCase):
         self.assertEquals([], glob.glob(os.path.join(
             self.processor.tmp_dir, self.processor.prefix + '*')))
 
+    @patch('ftplib.FTP', autospec=True)
+    @patch('ftplib.FTP.retrbinary', mock_retrbinary_nc)
+    @patch('ftplib.FTP.connect', mock_none)
+    @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
+    @patch('ftplib.FTP.cwd', mock_none)
+    def test_download_files(self, ftp_mock):
+        """
+        Verify that only the requested files are downloaded
+        """
+        cdf_files = self.processor.download(files=['air.mon.mean.v401.nc'])
+        self.assertEquals(1, len(cdf_files))
+        self.assertTrue(cdf_files[0].endswith('air.mon.mean.v401.nc'))
+
+    def test_source_changed(self):
+        """
+        Verify that a recorded upstream signature is detected as unchanged
+        """
+        signature = {'size': 1024, 'mdtm': '20160801120000'}
+        state_dir = tempfile.mkdtemp()
+        try:
+            with patch('dataqs.processor_base.SOURCE_STATE_DIR', state_dir):
+                self.assertTrue(
+                    self.processor.source_changed('uod_test', signature))
+                self.processor.save_source_signature('uod_test', signature)
+                self.assertFalse(
+                    self.processor.source_changed('uod_test', signature))
+                signature['size'] = 2048
+                self.assertTrue(
+                    self.processor.source_changed('uod_test', signature))
+        finally:
+            shutil.rmtree(state_dir)
+
     def test_date(self):
         last_date = self.processor.get_date(1380)
         self.assertEquals(last_date, date(2015, 12, 1))
@@ -100,6 +137,7 @@ class UoDAirTempPrecipTest(TestCase):
     @patch('ftplib.FTP.retrbinary', mock_retrbinary_nc)
     @patch('ftplib.FTP.connect', mock_none)
     @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
     @patch('ftplib.FTP.cwd', mock_none)
     def test_convert(self, ftp_mock):
         cdf_files = self.processor.download()
@@ -116,6 +154,7 @@ class UoDAirTempPrecipTest(TestCase):
     @patch('ftplib.FTP.retrbinary', mock_retrbinary_tif)
     @patch('ftplib.FTP.connect', mock_none)
     @patch('ftplib.FTP.login', mock_none)
+    @patch('ftplib.FTP.pwd', mock_none)
     @patch('ftplib.FTP.cwd', mock_none)
     def test_extract_band(self, ftp_mock):
         cdf = self.processor.download()[0]
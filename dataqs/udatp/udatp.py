@@ -23,13 +23,12 @@ import os
 import re
 import shutil
 from datetime import date
-from ftplib import FTP
 
 from dateutil.relativedelta import relativedelta
-from dataqs.processor_base import GeoDataMosaicProcessor, GS_DATA_DIR, \
-    GS_TMP_DIR
-from dataqs.helpers import get_band_count, gdal_translate, \
-    nc_convert, style_exists, cdo_fixlng
+from dataqs.ftp_helpers import get_ftp_client
+from dataqs.processor_base import GeoDataMosaicProcessor, GS_TMP_DIR
+from dataqs.helpers import export_bands, nc_convert, style_exists, \
+    cdo_fixlng, ftp_signature, nc_dimension_size
 
 logger = logging.getLogger("dataqs.processors")
 script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -44,6 +43,7 @@ class UoDAirTempPrecipProcessor(GeoDataMosaicProcessor):
     """
     prefix = "uod_"
     base_url = "ftp.cdc.noaa.gov"
+    base_path = "/Datasets/udel.airt.precip/"
 
     layers = {
         'air.mon.mean.v401.nc': {
@@ -81,68 +81,88 @@ Citations:
     Colorado, USA, from their Web site at http://www.esrl.noaa.gov/psd/
  """
 
-    def download(self, tmp_dir=GS_TMP_DIR):
+    def remote_signatures(self):
+        """
+        Get the size and modification time of each NetCDF file on the server
+        :return: dict of filename: signature
+        """
+        with get_ftp_client(self.base_url).session(self.base_path) as ftp:
+            return {file: ftp_signature(ftp, file)
+                    for file in self.layers.keys()}
+
+    def download(self, tmp_dir=GS_TMP_DIR, files=None):
         """
         Retrieve NetCDF files via FTP
         :param tmp_dir: Temp directory to store files
+        :param files: Files to retrieve (default is all layers)
         :return: list of saved output files
         """
-        ftp = FTP(self.base_url)
-        ftp.login('anonymous', 'anonymous')
-        ftp.cwd('/Datasets/udel.airt.precip/')
-        outfiles = []
-        for file in self.layers.keys():
-            outfile = os.path.join(tmp_dir, '{}{}'.format(self.prefix, file))
-            with open(outfile, 'wb') as output:
-                ftp.retrbinary('RETR %s' % file, output.write)
-            outfiles.append(outfile)
-        return outfiles
-
-    def convert(self, nc_file):
+        return get_ftp_client(self.base_url).retrieve_many(
+            self.base_path,
+            [(file, os.path.join(tmp_dir, '{}{}'.format(self.prefix, file)))
+             for file in files or self.layers.keys()])
+
+    def convert(self, nc_file, timesteps=None):
         nc_transform = nc_convert(nc_file)
-        cdo_transform = cdo_fixlng(nc_transform)
+        cdo_transform = cdo_fixlng(nc_transform, timesteps=timesteps)
         return cdo_transform
 
     def extract_band(self, tif, band, outname):
-        outfile = os.path.join(self.tmp_dir, outname)
-        gdal_translate(tif, outfile, bands=[band],
-                       projection='EPSG:4326',
-                       options=['TILED=YES', 'COMPRESS=LZW'])
-        return outfile
+        return self.extract_bands(tif, [(band, outname)])[0]
+
+    def extract_bands(self, tif, bands):
+        """
+        Extract many bands to GeoTIFFs, reading the NetCDF file only once
+        :param tif: NetCDF file
+        :param bands: list of (band number, output filename) tuples
+        :return: list of output filepaths
+        """
+        return export_bands(tif, [
+            (band, os.path.join(self.tmp_dir, outname))
+            for band, outname in bands],
+            projection='EPSG:4326', processes=self.export_processes)
 
     def get_date(self, months):
         start_month = date(1901, 1, 1)
         return start_month + relativedelta(months=months - 1)
 
+    def get_img_name(self, layer_name, band):
+        band_date = re.sub('[\-\.]+', '', self.get_date(band).isoformat())
+        return '{}_{}T000000000Z.tif'.format(layer_name, band_date)
+
     def run(self):
         """
-        Retrieve and process the latest NetCDF file.
+        Retrieve and process the NetCDF files that have changed since the
+        last run.  Only months missing from each mosaic are converted.
         """
-        cdf_files = self.download()
+        signatures = self.remote_signatures()
+        changed = [file for file in self.layers.keys() if self.source_changed(
+            self.layers[file]['name'], signatures[file])]
+        if not changed:
+            logger.info("UDel files are unchanged, skipping")
+            return
+        cdf_files = self.download(files=changed)
         for cdf in cdf_files:
-            cdf_file = self.convert(cdf)
-            bands = get_band_count(cdf_file)
+            bands = nc_dimension_size(cdf)
             key = os.path.basename(cdf).lstrip(self.prefix)
             print(key)
             layer_name = self.layers[key]['name']
             img_list = self.get_mosaic_filenames(layer_name)
-            for band in range(1, bands + 1):
-                band_date = re.sub('[\-\.]+', '',
-                                   self.get_date(band).isoformat())
-                img_name = '{}_{}T000000000Z.tif'.format(layer_name, band_date)
-                if img_name not in img_list:
-                    band_tif = self.extract_band(cdf_file, band, img_name)
-                    dst_file = self.data_dir.format(gsd=GS_DATA_DIR,
-                                                    ws=self.workspace,
-                                                    layer=layer_name,
-                                                    file=img_name)
-                    dst_dir = os.path.dirname(dst_file)
-                    if not os.path.exists(dst_dir):
-                        os.makedirs(dst_dir)
-                    if dst_file.endswith('.tif'):
-                        shutil.move(os.path.join(self.tmp_dir, band_tif),
-                                    dst_file)
-                        self.post_geoserver(dst_file, layer_name)
+            img_names = [(band, self.get_img_name(layer_name, band))
+                         for band in range(1, bands + 1)]
+            new_imgs = [(band, img_name) for band, img_name in img_names
+                        if img_name not in img_list]
+            if new_imgs:
+                first_band = new_imgs[0][0]
+                cdf_file = self.convert(cdf, timesteps=(first_band, bands))
+                band_tifs = self.extract_bands(cdf_file, [
+                    (band - first_band + 1, img_name)
+                    for band, img_name in new_imgs])
+                harvest_dir = self.get_harvest_dir(layer_name)
+                for band_tif in band_tifs:
+                    shutil.move(band_tif, os.path.join(
+                        harvest_dir, os.path.basename(band_tif)))
+                self.harvest_geoserver(harvest_dir, layer_name)
 
             if not style_exists(layer_name):
                 with open(os.path.join(script_dir, 'resources/{}.sld'.format(
@@ -158,6 +178,7 @@ Citations:
                                 bounds=('-180.0', '180.0', '-90.0', '90.0',
                                         'EPSG:4326'))
             self.truncate_gs_cache(layer_name)
+            self.save_source_signature(layer_name, signatures[key])
         self.cleanup()
 
 
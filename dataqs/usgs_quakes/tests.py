@@ -21,13 +21,67 @@ import glob
 import json
 import os
 import datetime
+from collections import Counter
 from django.test import TestCase
+from osgeo import ogr
+from dataqs import ogr2ogr
 from dataqs.usgs_quakes.usgs_quakes import USGSQuakeProcessor
+from dataqs.helpers import get_vector_layer_info
 import httpretty
+import mock
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
 
+class FakeTransactionLayer(object):
+    """
+    Destination layer for ogr2ogr that records committed transactions.
+    CreateFeature fails for ids in 'fail_create', and a commit fails if
+    the transaction holds an id in 'fail_commit'.
+    """
+
+    def __init__(self, defn, fail_create=(), fail_commit=(),
+                 transactions=True):
+        self.defn = defn
+        self.fail_create = fail_create
+        self.fail_commit = fail_commit
+        self.transactions = transactions
+        self.pending = None
+        self.committed = []
+        self.created = Counter()
+
+    def GetLayerDefn(self):
+        return self.defn
+
+    def TestCapability(self, capability):
+        return capability == ogr.OLCTransactions and self.transactions
+
+    def StartTransaction(self):
+        assert self.pending is None
+        self.pending = []
+        return 0
+
+    def CreateFeature(self, feature):
+        fid = feature.GetField('id')
+        self.created[fid] += 1
+        if fid in self.fail_create:
+            return 1
+        self.pending.append(fid)
+        return 0
+
+    def CommitTransaction(self):
+        pending, self.pending = self.pending, None
+        if set(pending) & set(self.fail_commit):
+            return 1
+        if pending:
+            self.committed.append(pending)
+        return 0
+
+    def RollbackTransaction(self):
+        self.pending = None
+        return 0
+
+
 class UsgsQuakesTest(TestCase):
     """
     Tests the dataqs.usgs_quakes module.  Since each processor is highly
@@ -83,3 +137,131 @@ class UsgsQuakesTest(TestCase):
         self.processor.cleanup()
         self.assertEquals([], glob.glob(os.path.join(
             self.processor.tmp_dir, self.processor.prefix + '*')))
+
+    def test_vector_layer_info(self):
+        """
+        Verify the statistics of numeric and date fields, ignoring nulls
+        """
+        quakefile = os.path.join(script_dir, 'resources/test_quakes.json')
+        with open(quakefile) as inf:
+            features = json.load(inf)['features']
+        mags = [f['properties']['mag'] for f in features]
+        info = get_vector_layer_info(quakefile)
+        self.assertEquals('point', info['subType'])
+        mag = info['attributes']['mag']['properties']
+        self.assertEquals(len(features), mag['count'])
+        self.assertEquals(0, mag['nulls'])
+        self.assertAlmostEqual(min(mags), mag['min'])
+        self.assertAlmostEqual(max(mags), mag['max'])
+        self.assertAlmostEqual(sum(mags) / len(mags), mag['mean'])
+        self.assertAlmostEqual(sorted(mags)[len(mags) / 2],
+                               mag['quantiles']['50'])
+        cdi = info['attributes']['cdi']['properties']
+        self.assertEquals(3, cdi['nulls'])
+        self.assertAlmostEqual(1, cdi['min'])
+        self.assertFalse('place' in info['attributes'])
+        # Timestamps are reported with their range only
+        outfile = os.path.join(self.processor.tmp_dir,
+                               self.processor.prefix + '.json')
+        self.processor.transform(quakefile, outfile)
+        time = get_vector_layer_info(outfile)['attributes']['time']
+        self.assertEquals('date', time['type'])
+        self.assertEquals('2016-01-01T00:11:16', time['properties']['min'])
+        self.assertEquals('2016-01-01T23:52:04', time['properties']['max'])
+
+    def test_transform(self):
+        """
+        Verify that times are converted while streaming the feed
+        """
+        quakefile = os.path.join(script_dir, 'resources/test_quakes.json')
+        outfile = os.path.join(self.processor.tmp_dir,
+                               self.processor.prefix + '.json')
+        info = self.processor.transform(quakefile, outfile)
+        with open(outfile) as inf:
+            features = json.load(inf)['features']
+        self.assertEquals(5, len(features))
+        self.assertEquals('2016-01-01 23:52:04',
+                          features[0]['properties']['time'])
+        self.assertEquals(3, info['attributes']['gap']['properties']['nulls'])
+        self.assertAlmostEqual(
+            5.0, info['attributes']['mag']['properties']['max'])
+        time = info['attributes']['time']['properties']
+        self.assertEquals(5, time['count'])
+        self.assertEquals('2016-01-01T00:11:16', time['min'])
+        self.assertEquals('2016-01-01T23:52:04', time['max'])
+        self.assertEquals('2016-01-05T23:28:55',
+                          info['attributes']['updated']['properties']['max'])
+
+    def translate(self, dst_layer, count=10):
+        """
+        Load 'count' features into a destination layer with ogr2ogr
+        """
+        src_layer = ogr.GetDriverByName('Memory').CreateDataSource(
+            'src').CreateLayer('src', geom_type=ogr.wkbNone)
+        src_layer.CreateField(ogr.FieldDefn('id', ogr.OFTInteger))
+        for fid in range(count):
+            feature = ogr.Feature(src_layer.GetLayerDefn())
+            feature.SetField('id', fid)
+            src_layer.CreateFeature(feature)
+        info = ogr2ogr.TargetLayerInfo()
+        info.poDstLayer = dst_layer
+        info.panMap = [0]
+        info.iSrcZField = -1
+        self.assertTrue(ogr2ogr.TranslateLayer(
+            info, None, src_layer, None, None, True, -2, False, -1,
+            ogr2ogr.GeomOperation.NONE, 0, count, None, None, False, 0,
+            None, None, None))
+
+    @mock.patch('dataqs.ogr2ogr.nGroupTransactions', 3)
+    @mock.patch('dataqs.ogr2ogr.bSkipFailures', True)
+    def test_skip_failures(self):
+        """
+        Verify that with -skipfailures features are committed in groups,
+        and that a failing feature is skipped without losing or duplicating
+        the rest of its group
+        """
+        defn = ogr.FeatureDefn()
+        defn.AddFieldDefn(ogr.FieldDefn('id', ogr.OFTInteger))
+        layer = FakeTransactionLayer(defn, fail_create=(4,),
+                                     fail_commit=(7,))
+        self.translate(layer)
+        self.assertEquals([[0, 1, 2], [3, 5, 6], [8], [9]], layer.committed)
+        # Features of a failed group are replayed once
+        self.assertEquals({3: 2, 7: 2, 8: 2, 9: 2},
+                          {fid: n for fid, n in layer.created.items()
+                           if n > 1})
+        # Without transactions every feature is committed on its own
+        layer = FakeTransactionLayer(defn, fail_create=(4,),
+                                     transactions=False)
+        self.translate(layer)
+        self.assertEquals([[0], [1], [2], [3], [5], [6], [7], [8], [9]],
+                          layer.committed)
+        self.assertEquals(1, max(layer.created.values()))
+
+    @mock.patch('dataqs.helpers.postgres_query')
+    def test_drop_old_partitions(self, query_mock):
+        """
+        Verify that only archive partitions older than archive_days are
+        dropped in partitioned storage mode
+        """
+        self.processor.storage = 'partitioned'
+        self.processor.archive_days = 365
+        policy = self.processor.archive_policy()
+        today = datetime.datetime.today()
+        old = policy.partition_name(today.replace(year=today.year - 2))
+        current = policy.partition_name(today)
+
+        def query_result(query, **kwargs):
+            if 'pg_inherits' in query:
+                return [(old,), (current,), (policy.default_partition,)]
+            if 'relkind' in query:
+                return [('p',)]
+            if 'data_type' in query:
+                return [('timestamp without time zone',)]
+        query_mock.side_effect = query_result
+        self.processor.purge_old_data()
+        queries = [call[0][0] for call in query_mock.call_args_list]
+        self.assertTrue('DROP TABLE {};'.format(old) in queries)
+        self.assertFalse('DROP TABLE {};'.format(current) in queries)
+        self.assertTrue('DELETE FROM {} WHERE "time" < %s;'.format(
+            policy.default_partition) in queries)
@@ -22,15 +22,27 @@ import json
 import os
 import datetime
 import logging
-from django.db import connections
+from decimal import Decimal
+import ijson
+from django.conf import settings
 from dataqs.processor_base import GeoDataProcessor, DEFAULT_WORKSPACE
-from dataqs.helpers import postgres_query, ogr2ogr_exec, layer_exists, \
-    style_exists, get_vector_layer_info
+from dataqs.helpers import postgres_query, postgres_transaction, \
+    ogr2ogr_exec, layer_exists, style_exists, table_exists, get_vector_info, \
+    relation_kind, RetentionPolicy
 from geonode.geoserver.helpers import ogc_server_settings
 
 logger = logging.getLogger("dataqs.processors")
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
+# 'tables': a table per time window, each holding a copy of its quakes
+# 'partitioned': an archive partitioned by month, with views for the windows
+USGS_QUAKES_STORAGE = getattr(settings, 'USGS_QUAKES_STORAGE', 'tables')
+# Days of archive to keep in 'partitioned' mode (None = all)
+USGS_QUAKES_ARCHIVE_DAYS = getattr(settings, 'USGS_QUAKES_ARCHIVE_DAYS', None)
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+NUMBER_TYPES = (int, long, float, Decimal)
+
 
 class USGSQuakeProcessor(GeoDataProcessor):
     """
@@ -38,11 +50,20 @@ class USGSQuakeProcessor(GeoDataProcessor):
     4 layers are created/updated with the same data (last 7 days by default),
     then any old data beyond the layer's time window (7 days, 30 days, etc)
     are removed.
+
+    With storage='partitioned', quakes are only written to the archive,
+    which is partitioned by month.  The weekly, monthly and yearly layers are
+    views of the archive, and old data is removed by dropping partitions.
     """
     prefix = 'usgs_quakes'
     tables = ("quakes_weekly", "quakes_monthly",
               "quakes_yearly", "quakes_archive")
     titles = ("Last 7 Days", "Last 30 Days", "Last 365 Days", "Archive")
+    windows = (7, 30, 365, None)
+    staging_table = "quakes_staging"
+    storage = USGS_QUAKES_STORAGE
+    archive_days = USGS_QUAKES_ARCHIVE_DAYS
+    geom_column = 'wkb_geometry'
     base_url = "http://earthquake.usgs.gov/fdsnws/event/1/query?" \
                "format=geojson&starttime={}&endtime={}"
     params = {}
@@ -63,27 +84,227 @@ class USGSQuakeProcessor(GeoDataProcessor):
             today = datetime.date.today()
             self.params['edate'] = today.strftime("%Y-%m-%d")
 
+        if 'storage' in kwargs.keys():
+            self.storage = kwargs['storage']
+        if 'archive_days' in kwargs.keys():
+            self.archive_days = kwargs['archive_days']
+
         super(USGSQuakeProcessor, self).__init__(*args)
 
+    @property
+    def archive_table(self):
+        return self.tables[-1]
+
     def purge_old_data(self):
         """
         Remove old data from weekly, monthly, and yearly PostGIS tables
         """
-        today = datetime.date.today()
-        last_week = (today - datetime.timedelta(days=7)).strftime("%Y-%m-%d")
-        last_month = (today - datetime.timedelta(days=30)).strftime("%Y-%m-%d")
-        last_year = (today - datetime.timedelta(days=365)).strftime("%Y-%m-%d")
+        if self.storage == 'partitioned':
+            self.archive_policy().enforce()
+            return
+        for table, days in zip(self.tables, self.windows):
+            RetentionPolicy(table, 'time', days, partitioned=False).enforce()
+
+    def archive_policy(self):
+        """
+        Archive partitioned by month, kept for archive_days days
+        :return: RetentionPolicy
+        """
+        return RetentionPolicy(
+            self.archive_table, 'time', self.archive_days, interval='month',
+            partitioned=True, indexes={
+                'time': '(time)',
+                'geom': 'USING GIST ("{}")'.format(self.geom_column)},
+            unique={'ids_key': '(ids, time)'})
+
+    def transform(self, rss_file, geojson):
+        """
+        Stream the features of a USGS feed into a new GeoJSON file, one
+        feature at a time, converting 'time' and 'updated' from epoch
+        milliseconds to timestamps.  The numeric properties and timestamps
+        are collected on the way for the layer_info keyword.
+        :param rss_file: Full path of the USGS GeoJSON feed
+        :param geojson: Full path of the output GeoJSON file
+        :return: layer_info dict
+        """
+        columns = {}
+        times = {'time': [], 'updated': []}
+        not_numeric = set()
+        count = 0
+        with open(rss_file, 'rb') as infile, open(geojson, 'w') as outfile:
+            outfile.write('{"type": "FeatureCollection", "features": [\n')
+            for feature in ijson.items(infile, 'features.item'):
+                props = feature['properties']
+                for key, values in times.items():
+                    value = datetime.datetime.utcfromtimestamp(
+                        int(props[key]) / 1000)
+                    props[key] = value.strftime(TIME_FORMAT)
+                    values.append(value.isoformat())
+                for key, value in props.items():
+                    if value is None or key in not_numeric:
+                        continue
+                    if isinstance(value, bool) or not isinstance(
+                            value, NUMBER_TYPES):
+                        not_numeric.add(key)
+                        columns.pop(key, None)
+                        continue
+                    columns.setdefault(key, [float('nan')] * count).append(
+                        float(value))
+                count += 1
+                for column in columns.values():
+                    if len(column) < count:
+                        column.append(float('nan'))
+                if count > 1:
+                    outfile.write(',\n')
+                json.dump(feature, outfile, default=float)
+            outfile.write('\n]}\n')
+        logger.info("Transformed {} earthquakes".format(count))
+        return get_vector_info('point', columns, count, times)
+
+    def load_staging(self, geojson):
+        """
+        Load transformed features into the staging table, replacing its
+        previous contents
+        :param geojson: Full path of the transformed GeoJSON file
+        """
+        db = ogc_server_settings.datastore_db
+        ogr2ogr_exec("-overwrite -skipfailures -f PostgreSQL \
+            \"PG:host={db_host} user={db_user} password={db_pass} \
+            dbname={db_name}\" {geojson} -nln {table}".format(
+            db_host=db["HOST"], db_user=db["USER"], db_pass=db["PASSWORD"],
+            db_name=db["NAME"], geojson=geojson, table=self.staging_table))
 
-        for interval, table in zip([last_week, last_month, last_year],
-                                   self.tables):
+    @staticmethod
+    def table_columns(table):
+        """
+        :param table: Table name
+        :return: list of the table's (column name, column type) tuples
+        """
+        return [tuple(row) for row in postgres_query(
+            "SELECT attname, format_type(atttypid, atttypmod) "
+            "FROM pg_attribute WHERE attrelid = %s::regclass "
+            "AND attnum > 0 AND NOT attisdropped ORDER BY attnum;",
+            returnable=True, params=(table,)) or []]
+
+    def create_table(self, table):
+        """
+        Create an earthquake table with the same columns as the staging
+        table, its own ogc_fid sequence and a unique constraint on ids
+        :param table: Table name
+        """
+        for query in (
+            'CREATE TABLE {tb} (LIKE {staging} INCLUDING INDEXES);',
+            'ALTER TABLE {tb} DROP COLUMN ogc_fid;',
+            'ALTER TABLE {tb} ADD COLUMN ogc_fid SERIAL PRIMARY KEY;',
+            'ALTER TABLE {tb} ADD CONSTRAINT {tb}_ids UNIQUE (ids);'
+        ):
+            postgres_query(query.format(tb=table, staging=self.staging_table))
+
+    def insert_from_staging(self, table, days=None):
+        """
+        Copy earthquakes not already present in a table from the staging
+        table, optionally only those of the last x days
+        :param table: Table name
+        :param days: Time window of the table (None for no limit)
+        """
+        staging_columns = dict(self.table_columns(self.staging_table))
+        columns = [(col, col_type) for col, col_type in self.table_columns(
+            table) if col != 'ogc_fid' and col in staging_columns]
+        query = ('INSERT INTO {tb} ({cols}) SELECT DISTINCT ON (ids) {vals} '
+                 'FROM {staging} s WHERE NOT EXISTS '
+                 '(SELECT 1 FROM {tb} t WHERE t.ids = s.ids)').format(
+            tb=table, staging=self.staging_table,
+            cols=', '.join('"{}"'.format(col) for col, _ in columns),
+            vals=', '.join('CAST(s."{}" AS {})'.format(col, col_type)
+                           for col, col_type in columns))
+        params = None
+        if days:
+            since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+            query += ' AND CAST(time as timestamp) >= %s'
+            params = (since.strftime(TIME_FORMAT),)
+        postgres_query(query + ';', params=params)
+
+    def create_partitioned_archive(self):
+        """
+        Create the archive as a table partitioned by month of 'time', with
+        the columns of the staging table.  The primary key and the unique
+        ids index include 'time', as PostgreSQL requires on partitioned
+        tables.
+        """
+        columns = ['"{}" {}'.format(
+            col, 'timestamp' if col == 'time' else col_type)
+            for col, col_type in self.table_columns(self.staging_table)
+            if col != 'ogc_fid']
+        self.archive_policy().create(
+            ['ogc_fid SERIAL'] + columns + ['PRIMARY KEY (ogc_fid, time)'])
+
+    def migrate_archive(self):
+        """
+        Move the quakes of an unpartitioned archive table into a new
+        partitioned archive, converting 'time' to a timestamp
+        """
+        old_archive = self.archive_table + '_unpartitioned'
+        logger.info("Partitioning {}".format(self.archive_table))
+        postgres_query('ALTER TABLE {} RENAME TO {};'.format(
+            self.archive_table, old_archive))
+        self.create_partitioned_archive()
+        self.archive_policy().prepare(
+            old_archive, expression='CAST(time AS timestamp)')
+        columns = [(col, col_type) for col, col_type in self.table_columns(
+            self.archive_table) if col != 'ogc_fid']
+        postgres_query(
+            'INSERT INTO {tb} ({cols}) SELECT {vals} FROM {old};'.format(
+                tb=self.archive_table, old=old_archive,
+                cols=', '.join('"{}"'.format(col) for col, _ in columns),
+                vals=', '.join('CAST("{}" AS {})'.format(col, col_type)
+                               for col, col_type in columns)))
+        postgres_query('DROP TABLE {};'.format(old_archive))
+
+    def create_views(self):
+        """
+        Replace the weekly, monthly and yearly tables with views of the
+        archive restricted to their time windows
+        """
+        for table, days in zip(self.tables, self.windows):
+            kind = relation_kind(table)
+            if not days or kind == 'v':
+                continue
+            if kind == 'r':
+                postgres_query('DROP TABLE {};'.format(table))
             postgres_query(
-                "DELETE FROM {} where CAST(time as timestamp) < '{}';".format(
-                    table, interval), commit=True)
+                "CREATE VIEW {view} AS SELECT * FROM {tb} WHERE time >= "
+                "(now() AT TIME ZONE 'UTC') - interval '{days} days';".format(
+                    view=table, tb=self.archive_table, days=days))
+
+    def update_partitioned(self):
+        """
+        Append the staged quakes to the partitioned archive, creating it and
+        the window views if needed
+        """
+        kind = relation_kind(self.archive_table)
+        if kind is None:
+            self.create_partitioned_archive()
+        elif kind == 'r':
+            self.migrate_archive()
+        self.archive_policy().prepare(
+            self.staging_table, expression='CAST(time AS timestamp)')
+        self.insert_from_staging(self.archive_table)
+        self.create_views()
+
+    def update_tables(self):
+        """
+        Append the staged quakes to each table, restricted to its window
+        """
+        for table, days in zip(self.tables, self.windows):
+            if not table_exists(table):
+                self.create_table(table)
+            self.insert_from_staging(table, days)
 
     def run(self, rss_file=None):
         """
-        Retrieve the latest USGS earthquake data and append to all PostGIS
-        earthquake tables, then remove old data
+        Retrieve the latest USGS earthquake data, load it once into a
+        staging table and append it from there to all PostGIS earthquake
+        tables, then remove old data
         :return:
         """
         if not rss_file:
@@ -92,37 +313,20 @@ class USGSQuakeProcessor(GeoDataProcessor):
                                 filename=self.prefix + '.rss')
             rss_file = os.path.join(self.tmp_dir, rss)
 
-        json_data = None
-        with open(rss_file) as json_file:
-            json_data = json.load(json_file)
-            for feature in json_data['features']:
-                time_original = datetime.datetime.utcfromtimestamp(
-                    feature['properties']['time']/1000)
-                updated_original = datetime.datetime.utcfromtimestamp(
-                    feature['properties']['updated']/1000)
-                feature['properties']['time'] = time_original.strftime(
-                    "%Y-%m-%d %H:%M:%S")
-                feature['properties']['updated'] = updated_original.strftime(
-                    "%Y-%m-%d %H:%M:%S")
-        with open(rss_file, 'w') as modified_file:
-            json.dump(json_data, modified_file)
-        info = get_vector_layer_info(rss_file)
+        geojson = os.path.join(self.tmp_dir, self.prefix + '.json')
+        info = self.transform(rss_file, geojson)
         layer_info = 'layer_info:{}'.format(json.dumps(info))
-        db = ogc_server_settings.datastore_db
+        self.load_staging(geojson)
+        with postgres_transaction():
+            if self.storage == 'partitioned':
+                self.update_partitioned()
+            else:
+                self.update_tables()
+        postgres_query('DROP TABLE IF EXISTS {};'.format(self.staging_table),
+                       commit=True)
+        datastore = ogc_server_settings.server.get('DATASTORE')
         for table, title in zip(self.tables, self.titles):
-            ogr2ogr_exec("-append -skipfailures -f PostgreSQL \
-                \"PG:host={db_host} user={db_user} password={db_pass} \
-                dbname={db_name}\" {rss} -nln {table}".format(
-                db_host=db["HOST"], db_user=db["USER"], db_pass=db["PASSWORD"],
-                db_name=db["NAME"], rss="{}".format(rss_file), table=table))
-            datastore = ogc_server_settings.server.get('DATASTORE')
             if not layer_exists(table, datastore, DEFAULT_WORKSPACE):
-                c = connections[datastore].cursor()
-                q = 'ALTER TABLE {tb} ADD CONSTRAINT {tb}_ids UNIQUE (ids);'
-                try:
-                    c.execute(q.format(tb=table))
-                except Exception:
-                    c.close()
                 self.post_geoserver_vector(table)
             if not style_exists(table):
                 with open(os.path.join(
@@ -17,12 +17,18 @@
 #  limitations under the License.
 ###############################################################################
 
+import base64
+import bs4
 import glob
 import json
 import httpretty
 import os
+import shutil
+import tempfile
 from django.test import TestCase
-from dataqs.whisp.whisp import WhispProcessor
+from dataqs.whisp.whisp import WhispProcessor, WHISP_UNIQUE_SQL
+from dataqs.helpers import exists_cache, table_exists
+from dataqs.http_helpers import HTTPCache
 import mock
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -33,10 +39,10 @@ def test_data():
         return html.read()
 
 
-def mock_insert_row(self, data):
+def mock_insert_rows(self, rows):
     with open(os.path.join(
             self.tmp_dir, '().json'.format(self.prefix)), 'w') as testfile:
-        json.dump(data, testfile)
+        json.dump(rows, testfile)
 
 
 class WhispTest(TestCase):
@@ -54,7 +60,8 @@ class WhispTest(TestCase):
         httpretty.disable()
         self.processor.cleanup()
 
-    @mock.patch('dataqs.whisp.whisp.WhispProcessor.insert_row', mock_insert_row)
+    @mock.patch('dataqs.whisp.whisp.WhispProcessor.insert_rows',
+                mock_insert_rows)
     def test_scrape(self):
         """
         Verify that the correct records can be read from html
@@ -71,11 +78,12 @@ class WhispTest(TestCase):
         self.assertTrue(os.path.exists(testfile))
         with open(testfile) as test:
             test_json = json.load(test)
-            self.assertTrue(test_json['eventtype'])
-            self.assertTrue(test_json['the_geom'])
+            self.assertTrue(test_json[0]['eventtype'])
+            self.assertTrue(test_json[0]['latlng'])
         self.processor.cleanup()
 
-    @mock.patch('dataqs.whisp.whisp.WhispProcessor.insert_row', mock_insert_row)
+    @mock.patch('dataqs.whisp.whisp.WhispProcessor.insert_rows',
+                mock_insert_rows)
     def test_archive_import(self):
         """
         Verify that the correct records can be read from archive
@@ -87,11 +95,45 @@ class WhispTest(TestCase):
         self.assertTrue(os.path.exists(testfile))
         with open(testfile) as test:
             test_json = json.load(test)
-            self.assertTrue(test_json['eventtype'])
-            self.assertTrue(test_json['the_geom'])
+            self.assertTrue(test_json[0]['eventtype'])
+            self.assertTrue(test_json[0]['latlng'])
         self.processor.cleanup()
 
-    @mock.patch('dataqs.whisp.whisp.WhispProcessor.insert_row', mock_insert_row)
+    def test_parse_coordinates(self):
+        """
+        Verify that coordinates are indexed by event name, and that an
+        event without coordinates does not take those of the next event
+        """
+        rawdata = base64.b64decode(bs4.BeautifulSoup(test_data()).find(
+            'form', action='/whispers/events/export').find(
+            'input', type='hidden').get('value'))
+        coordinates = self.processor.parse_coordinates(rawdata)
+        self.assertEquals(99, len(coordinates))
+        self.assertEquals('38.4787,-98.7572', coordinates['2015-291'])
+        self.assertNotIn('2015-193', coordinates)
+
+    @mock.patch('dataqs.whisp.whisp.postgres_query')
+    @mock.patch('dataqs.whisp.whisp.postgres_transaction')
+    def test_insert_rows(self, transaction_mock, query_mock):
+        """
+        Verify that events are copied into staging and merged in one query
+        """
+        transaction = transaction_mock.return_value.__enter__.return_value
+        transaction.cursor.rowcount = 1
+        self.assertEquals(1, self.processor.insert_rows([
+            {'eventtype': u'Mortality', 'eventname': u'2015-291',
+             'startdate': u'2015-12-05', 'counties': u'Barton, KS',
+             'latlng': u'38.4787,-98.7572;38.5,-98.7'}]))
+        copy_sql, copied = transaction.cursor.copy_expert.call_args[0]
+        self.assertIn('whisp_staging', copy_sql)
+        self.assertEquals(
+            u'Mortality,2015-291,2015-12-05,,,,"Barton, KS",,,,'
+            u'"38.4787,-98.7572;38.5,-98.7"\r\n', copied.getvalue())
+        self.assertIn('ON CONFLICT (eventname) DO NOTHING',
+                      query_mock.call_args_list[-1][0][0])
+
+    @mock.patch('dataqs.whisp.whisp.WhispProcessor.insert_rows',
+                mock_insert_rows)
     def test_cleanup(self):
         httpretty.register_uri(
             httpretty.GET,
@@ -102,3 +144,80 @@ class WhispTest(TestCase):
         self.processor.cleanup()
         self.assertEquals([], glob.glob(os.path.join(
             self.processor.tmp_dir, self.processor.prefix + '*')))
+
+    @mock.patch('dataqs.helpers.postgres_query', return_value=[(True,)])
+    def test_table_exists_cache(self, query_mock):
+        """
+        Verify that table lookups are cached until invalidated
+        """
+        exists_cache.invalidate()
+        self.assertTrue(table_exists(self.processor.prefix))
+        self.assertTrue(table_exists(self.processor.prefix))
+        self.assertEquals(1, query_mock.call_count)
+        exists_cache.invalidate('table', self.processor.prefix)
+        self.assertTrue(table_exists(self.processor.prefix))
+        self.assertEquals(2, query_mock.call_count)
+
+    def test_update_events(self):
+        """
+        Verify that the page is scraped again if loading it failed
+        """
+        httpretty.register_uri(
+            httpretty.GET,
+            self.processor.base_url,
+            body=test_data(),
+            content_type='text/html')
+        state_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch('dataqs.processor_base.SOURCE_STATE_DIR',
+                            state_dir), \
+                    mock.patch('dataqs.whisp.whisp.get_http_cache',
+                               return_value=HTTPCache(state_dir)), \
+                    mock.patch('dataqs.whisp.whisp.WhispProcessor.scrape',
+                               side_effect=[IOError, None]) as scrape_mock:
+                self.assertRaises(IOError, self.processor.update_events)
+                self.processor.update_events()
+                self.processor.update_events()
+                self.assertEquals(2, scrape_mock.call_count)
+        finally:
+            shutil.rmtree(state_dir)
+
+    def test_add_unique_index(self):
+        """
+        Verify that duplicates are only removed if the unique index is missing
+        """
+        with mock.patch('dataqs.whisp.whisp.relation_kind',
+                        side_effect=['i', None]), \
+                mock.patch('dataqs.whisp.whisp.postgres_query') as query_mock:
+            self.processor.add_unique_index()
+            self.assertFalse(query_mock.called)
+            self.processor.add_unique_index()
+            query_mock.assert_called_once_with(
+                WHISP_UNIQUE_SQL.format(table=self.processor.prefix),
+                commit=True)
+
+    def test_conditional_get(self):
+        """
+        Verify that cached pages are revalidated with their ETag
+        """
+        cache = HTTPCache(os.path.join(
+            self.processor.tmp_dir, self.processor.prefix + '_http_cache'))
+        httpretty.register_uri(
+            httpretty.GET,
+            self.processor.base_url,
+            responses=[
+                httpretty.Response(body=test_data(), content_type='text/html',
+                                   adding_headers={'ETag': '"v1"'}),
+                httpretty.Response(body='', status=304)
+            ])
+        try:
+            page = cache.get(self.processor.base_url)
+            self.assertFalse(page.unchanged)
+            page = cache.get(self.processor.base_url)
+            self.assertTrue(page.unchanged)
+            self.assertEquals(test_data(), page.content)
+            self.assertEquals('"v1"', httpretty.last_request().headers.get(
+                'If-None-Match'))
+        finally:
+            cache.clear()
+            os.rmdir(cache.cache_dir)
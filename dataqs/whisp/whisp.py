@@ -18,20 +18,23 @@
 ###############################################################################
 
 import base64
+import hashlib
+import logging
 import os
 import zipfile
 import StringIO
 import bs4
 from dataqs.helpers import table_exists, postgres_query, layer_exists, \
-    style_exists
+    style_exists, postgres_transaction, relation_kind
 from dateutil.parser import parse
 import re
-import requests
 import unicodecsv as csv
+from dataqs.http_helpers import get_http_cache
 from dataqs.processor_base import GeoDataProcessor
 from geonode.geoserver.helpers import ogc_server_settings
 from geonode.settings import DEFAULT_WORKSPACE
 
+logger = logging.getLogger("dataqs.processors")
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
 WHISP_TABLE = u"""
@@ -53,23 +56,63 @@ CREATE TABLE IF NOT EXISTS {table}
 WITH (
   OIDS=FALSE
 );
-CREATE INDEX {table}_eventname_idx ON {table} (eventname);
+CREATE UNIQUE INDEX {table}_eventname_key ON {table} (eventname);
 CREATE INDEX {table}_startdate_idx ON {table} (startdate);
 SELECT AddGeometryColumn ('public','{table}' ,'the_geom',4326,'MULTIPOINT',2);
 CREATE INDEX {table}_the_geom ON {table} USING gist (the_geom);
 """
 
 
-WHISP_SQL = u"""
+WHISP_UNIQUE_SQL = u"""
+DELETE FROM {table} a USING {table} b
+ WHERE a.eventname = b.eventname AND a.id > b.id;
+DROP INDEX IF EXISTS {table}_eventname_idx;
+CREATE UNIQUE INDEX IF NOT EXISTS {table}_eventname_key ON {table} (eventname);
+"""
+
+WHISP_STAGING_SQL = u"""
+CREATE TEMPORARY TABLE {staging}
+(
+  eventtype text,
+  eventname text,
+  startdate text,
+  enddate text,
+  affected text,
+  states text,
+  counties text,
+  species text,
+  diagnosis text,
+  coords text,
+  latlng text
+) ON COMMIT DROP;
+"""
+
+WHISP_MERGE_SQL = u"""
 INSERT INTO {table}
 (eventtype, eventname, startdate, enddate, affected, states, counties,
 species, diagnosis, coords, the_geom)
- SELECT %(eventtype)s, %(eventname)s, %(startdate)s, %(enddate)s, %(affected)s,
- %(states)s, %(counties)s, %(species)s, %(diagnosis)s, %(coords)s,
- ST_GeomFromText('{geom}', 4326)
- WHERE NOT EXISTS (SELECT 1 from {table} WHERE eventname = %(eventname)s);
+ SELECT DISTINCT ON (s.eventname)
+ s.eventtype, s.eventname, s.startdate::timestamp, s.enddate::timestamp,
+ s.affected::integer, s.states, s.counties, s.species, s.diagnosis, s.coords,
+ (SELECT ST_SetSRID(ST_Multi(ST_Collect(ST_MakePoint(
+    split_part(point, ',', 2)::float8, split_part(point, ',', 1)::float8))),
+    4326)
+  FROM unnest(string_to_array(s.latlng, ';')) AS point)
+ FROM {staging} s
+ WHERE s.eventname IS NOT NULL AND s.latlng IS NOT NULL
+ ORDER BY s.eventname
+ ON CONFLICT (eventname) DO NOTHING;
 """
 
+WHISP_COLUMNS = ('eventtype', 'eventname', 'startdate', 'enddate', 'affected',
+                 'states', 'counties', 'species', 'diagnosis', 'coords',
+                 'latlng')
+
+# Event name and coordinate attributes of the PHP-serialized search results
+# embedded in the export form
+WHISP_EXPORT_RE = re.compile(
+    r's:4:"Name";s:\d+:"([^"]*)"|s:6:"LatLng";s:\d+:"([0-9\.\-\,\;]+)"')
+
 
 class WhispProcessor(GeoDataProcessor):
     """
@@ -105,12 +148,11 @@ diagnostic laboratories; and published reports in journals, newspapers, or other
     def download(self, url=None, filename=None):
         if not url:
             url = self.base_url
-            req = requests.get(url)
-            req.raise_for_status()
-            return req.content
+            return get_http_cache().get(url).content
 
-    def scrape(self):
-        html = self.download()
+    def scrape(self, html=None):
+        if html is None:
+            html = self.download()
         soup = bs4.BeautifulSoup(html)
         form = soup.find('form', action='/whispers/events/export')
         input = form.find('input', type='hidden')
@@ -118,50 +160,116 @@ diagnostic laboratories; and published reports in journals, newspapers, or other
         table = soup.find('table', class_='items')
         headers = [tr.text.replace(' ', '').lower().replace('name', 'eventname')
                    for tr in table.find('thead').findAll('th')]
-        headers.extend(['coords', 'the_geom'])
+        headers.extend(['coords', 'latlng'])
         data = [[td.text.strip() for td in tr if td != '\n'] for tr in
                 table.find('tbody').findAll('tr')]
+        coordinates = self.parse_coordinates(rawdata)
+        dates = {}
+        rows = []
         for row in data:
-            id = row[1]
-            latlng = re.search('"LatLng";s:\d+:"([0-9\.\-\,\;]+)"',
-                               rawdata[rawdata.index(id):]).group(1)
+            latlng = coordinates.get(row[1])
+            if not latlng:
+                logger.warn("No coordinates for WHISPers event {}".format(
+                    row[1]))
+                continue
             coords = [tuple([float(a) for a in b.split(',')])
                       for b in latlng.split(';')]
-            if len(coords) > 2:
-                geom = re.sub(r'(\d),', r'\1', "MULTIPOINT {}".format(
-                    tuple([coord[::-1] for coord in coords])))
-            else:
-                geom = re.sub(r',', r'',
-                              "MULTIPOINT ({})".format((coords[0][::-1])))
-            row.extend([coords, geom])
-            row[2] = parse(row[2]).strftime('%Y-%m-%d')
-            if row[3] and row[3] != u'\xa0':
-                row[3] = parse(row[3]).strftime('%Y-%m-%d')
-            else:
-                row[3] = None
-
-            self.insert_row(dict(zip(headers, row)))
-
-    def insert_row(self, data):
-        postgres_query(WHISP_SQL.format(
-            table=self.prefix, geom=data['the_geom']), params=data, commit=True)
+            row.extend([str(coords), latlng])
+            for i in (2, 3):
+                if row[i] and row[i] != u'\xa0':
+                    if row[i] not in dates:
+                        dates[row[i]] = parse(row[i]).strftime('%Y-%m-%d')
+                    row[i] = dates[row[i]]
+                else:
+                    row[i] = None
+            rows.append(dict(zip(headers, row)))
+        self.insert_rows(rows)
+
+    @staticmethod
+    def parse_coordinates(rawdata):
+        """
+        Index the serialized export data in one pass
+        :param rawdata: base64-decoded value of the export form
+        :return: dict of event name: 'lat,lng;lat,lng' coordinate string
+        """
+        coordinates = {}
+        name = None
+        for match in WHISP_EXPORT_RE.finditer(rawdata):
+            if match.group(1) is not None:
+                name = match.group(1)
+            elif name is not None:
+                coordinates.setdefault(name, match.group(2))
+                name = None
+        return coordinates
+
+    def insert_rows(self, rows):
+        """
+        COPY events into a temporary staging table and add those not
+        already in the table with one INSERT, building the MULTIPOINT
+        geometries from the staged 'lat,lng;lat,lng' strings.
+        :param rows: list of dicts keyed by WHISP_COLUMNS
+        :return: number of rows inserted
+        """
+        staging = '{}_staging'.format(self.prefix)
+        buffer = StringIO.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row.get(column) for column in WHISP_COLUMNS])
+        buffer.seek(0)
+        with postgres_transaction() as transaction:
+            postgres_query(WHISP_STAGING_SQL.format(staging=staging))
+            transaction.cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN WITH CSV;'.format(
+                    staging, ','.join(WHISP_COLUMNS)), buffer)
+            postgres_query(WHISP_MERGE_SQL.format(
+                table=self.prefix, staging=staging))
+            inserted = transaction.cursor.rowcount
+        logger.debug("Inserted {} of {} events".format(inserted, len(rows)))
+        return inserted
 
     def import_archive(self):
         zf = zipfile.ZipFile(os.path.join(script_dir,
                                           'resources/whispers_archive.zip'))
         reader = csv.DictReader(
             StringIO.StringIO(zf.read('whispers_archive.csv')))
+        rows = []
         for row in reader:
-            for key in row.keys():
-                if not row[key]:
-                    row[key] = None
-            self.insert_row(row)
+            row['latlng'] = ';'.join(
+                '{},{}'.format(lat, lng) for lat, lng in
+                re.findall(r'\(([0-9\.\-]+), ([0-9\.\-]+)\)', row['coords']))
+            rows.append(row)
+        self.insert_rows(rows)
+
+    def add_unique_index(self):
+        """
+        Remove duplicate events from a table created without a unique
+        eventname index, then add the index
+        """
+        if relation_kind('{}_eventname_key'.format(self.prefix)) is None:
+            postgres_query(WHISP_UNIQUE_SQL.format(table=self.prefix),
+                           commit=True)
+
+    def update_events(self):
+        """
+        Scrape the recent events page if it has changed since it was last
+        successfully loaded
+        :return: None
+        """
+        page = get_http_cache().get(self.base_url)
+        signature = {'sha1': hashlib.sha1(page.content).hexdigest()}
+        if not self.source_changed(self.prefix, signature):
+            logger.info("No new WHISPers events")
+            return
+        self.scrape(page.content)
+        self.save_source_signature(self.prefix, signature)
 
     def run(self):
         if not table_exists(self.prefix):
             postgres_query(WHISP_TABLE.format(table=self.prefix), commit=True)
             self.import_archive()
-        self.scrape()
+        else:
+            self.add_unique_index()
+        self.update_events()
         if not layer_exists(self.prefix,
                             ogc_server_settings.server.get('DATASTORE'),
                             DEFAULT_WORKSPACE):
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc. and Epidemico Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Compare the COPY-based bulk loader of WaterQualityPortalProcessor with the
+row-by-row loader on a synthetic Result csv file.  Requires a configured
+GeoNode datastore; creates and drops its own tables.
+
+    python -m dataqs.wqp.benchmark --rows 1000000
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import datetime
+import os
+import random
+import re
+import time
+
+import unicodecsv as csv
+from dataqs.helpers import postgres_query
+from dataqs.wqp.wqp import WaterQualityPortalProcessor, script_dir
+
+BENCHMARK_PREFIX = 'wqp_benchmark'
+
+
+def table_columns():
+    """
+    Read column names and types from the indicator table definition
+    :return: list of (name, type) tuples
+    """
+    with open(os.path.join(script_dir, 'resources/create_table.sql')) as sql:
+        return re.findall(r'^"([^"]+)" ([a-z ]+),?$', sql.read(), re.M)
+
+
+def synthetic_value(name, col_type, row_num):
+    if name == 'ActivityIdentifier':
+        return 'BENCH-{}'.format(row_num)
+    if name == 'MonitoringLocationIdentifier':
+        return 'BENCH-SITE-{}'.format(row_num % 5000)
+    if name.endswith('Date') and col_type.startswith('timestamp'):
+        day = datetime.date.today() - datetime.timedelta(days=row_num % 30)
+        return day.strftime('%Y-%m-%d')
+    if name.endswith('_Time'):
+        return '{:02d}:{:02d}:00'.format(row_num % 24, row_num % 60)
+    if name.endswith('_TimeZoneCode'):
+        return ('EST', 'CST', 'MST', 'PST')[row_num % 4]
+    if col_type == 'float':
+        return '' if row_num % 17 == 0 else '{:.3f}'.format(random.random())
+    return 'value {}'.format(row_num % 100)
+
+
+def generate_csv(path, rows):
+    """
+    Write a synthetic WQP Result csv file
+    :param path: output file path
+    :param rows: number of data rows
+    :return: None
+    """
+    columns = table_columns()
+    with open(path, 'wb') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow([name.replace('_', '/', 1) if name.endswith(
+            ('_MeasureValue', '_MeasureUnitCode', '_Time', '_TimeZoneCode'))
+            else name for name, _ in columns])
+        for row_num in xrange(rows):
+            writer.writerow([synthetic_value(name, col_type, row_num)
+                             for name, col_type in columns])
+
+
+def time_load(processor, method, csvfile):
+    table = '{}_{}'.format(BENCHMARK_PREFIX, method)
+    postgres_query('DROP TABLE IF EXISTS {};'.format(table), commit=True)
+    processor.create_indicator_table(table)
+    try:
+        start = time.time()
+        getattr(processor, method)(table, csvfile)
+        elapsed = time.time() - start
+        count = postgres_query('SELECT COUNT(*) FROM {};'.format(table),
+                               returnable=True)[0][0]
+    finally:
+        postgres_query('DROP TABLE IF EXISTS {};'.format(table), commit=True)
+    return elapsed, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='Number of synthetic rows to load')
+    parser.add_argument('--skip-rows', action='store_true',
+                        help='Only time the bulk loader')
+    args = parser.parse_args()
+
+    processor = WaterQualityPortalProcessor()
+    csvfile = '{}_Result.csv'.format(BENCHMARK_PREFIX)
+    csvpath = os.path.join(processor.tmp_dir, csvfile)
+    start = time.time()
+    generate_csv(csvpath, args.rows)
+    print('Generated {} rows ({:.1f} MB) in {:.1f}s'.format(
+        args.rows, os.path.getsize(csvpath) / 1048576.0, time.time() - start))
+
+    methods = ['copy_indicator_rows']
+    if not args.skip_rows:
+        methods.append('insert_indicator_rows')
+    try:
+        for method in methods:
+            elapsed, count = time_load(processor, method, csvfile)
+            print('{}: {} rows in {:.1f}s ({:.0f} rows/s)'.format(
+                method, count, elapsed, count / max(elapsed, 0.001)))
+    finally:
+        os.remove(csvpath)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,11 +17,15 @@
 #  limitations under the License.
 ###############################################################################
 
+import datetime
 import glob
+import mock
+import StringIO
 import zipfile
 import httpretty
 import os
 from django.test import TestCase
+from dataqs.helpers import exists_cache
 from dataqs.wqp.wqp import WaterQualityPortalProcessor
 import unicodecsv as csv
 
@@ -87,6 +91,28 @@ class WaterQualityTest(TestCase):
                 self.assertEquals(row['CharacteristicName'], 'pH')
                 self.assertTrue(row['MonitoringLocationIdentifier'] in stations)
 
+    def test_download_zip(self):
+        """
+        Verify that zipped responses are extracted to csv files.
+        """
+        for qtype in ('Result', 'Station'):
+            zipped = StringIO.StringIO()
+            with zipfile.ZipFile(zipped, 'w') as zf:
+                zf.writestr('{}.csv'.format(qtype), get_mock_response(
+                    'test_wqp_ph_{}.csv'.format(qtype)))
+            url = ('http://www.waterqualitydata.us/{}/search?'.format(qtype) +
+                   'countrycode=US&zip=yes')
+            httpretty.register_uri(httpretty.GET, url, body=zipped.getvalue())
+
+        self.processor.zip_download = True
+        files = self.processor.download('pH')
+        for qtype in ('Result', 'Station'):
+            csvfile = os.path.join(self.processor.tmp_dir, files[qtype])
+            with open(csvfile) as inputfile:
+                self.assertEquals(inputfile.read(), get_mock_response(
+                    'test_wqp_ph_{}.csv'.format(qtype)))
+            self.assertFalse(os.path.exists(csvfile.replace('.csv', '.zip')))
+
     def test_safe_name(self):
         """
         Verify that the correct safe name is returned for indicators
@@ -98,6 +124,22 @@ class WaterQualityTest(TestCase):
                           self.processor.safe_name(
                               'Temperature, water'))
 
+    def test_staging_value(self):
+        """
+        Verify that staging columns are normalized and cast for the bulk load
+        """
+        headers = ['ActivityStartDate', 'ActivityStartTime_Time',
+                   'ActivityStartTime_TimeZoneCode', 'ResultMeasureValue']
+        date_expr = self.processor.staging_value(
+            'ActivityStartDate', headers, 'timestamp with time zone')
+        self.assertIn('concat_ws', date_expr)
+        self.assertIn('s."ActivityStartTime_TimeZoneCode"', date_expr)
+        self.assertTrue(date_expr.endswith('::timestamp with time zone'))
+        value_expr = self.processor.staging_value(
+            'ResultMeasureValue', headers, 'double precision')
+        self.assertIn("'None'", value_expr)
+        self.assertTrue(value_expr.endswith('::double precision'))
+
     def test_cleanup(self):
         """
         Verify that no stray files exist after cleanup
@@ -105,3 +147,103 @@ class WaterQualityTest(TestCase):
         self.processor.cleanup()
         self.assertEquals([], glob.glob(os.path.join(
             self.processor.tmp_dir, self.processor.prefix + '*')))
+
+    def mock_database(self, query_mock, relkind, partitions=(),
+                      default_rows=False):
+        """
+        Answer the catalog queries of RetentionPolicy for the pH table
+        """
+        exists_cache.invalidate()
+
+        def query_result(query, **kwargs):
+            if 'relkind' in query:
+                return [(relkind,)]
+            if 'pg_inherits' in query:
+                return [(name,) for name in partitions]
+            if 'information_schema.tables' in query:
+                return [(True,)]
+            if query.startswith('SELECT EXISTS'):
+                return [(default_rows,)]
+            if query.startswith('SELECT min('):
+                return [(datetime.datetime(2016, 1, 15),
+                         datetime.datetime(2016, 2, 10))]
+        query_mock.side_effect = query_result
+
+    @mock.patch('dataqs.helpers.postgres_query')
+    def test_retention_convert(self, query_mock):
+        """
+        Verify that an unpartitioned indicator table is converted, keeping
+        ActivityIdentifier unique per start date
+        """
+        policy = self.processor.retention_policy('ph')
+        policy.partitioned = True
+        policy.days = None
+        self.mock_database(query_mock, 'r')
+        policy.prepare()
+        queries = [call[0][0] for call in query_mock.call_args_list]
+        self.assertIn('ALTER TABLE ph RENAME TO ph_unpartitioned;', queries)
+        self.assertIn('CREATE TABLE ph (LIKE ph_unpartitioned INCLUDING '
+                      'DEFAULTS) PARTITION BY RANGE ("ActivityStartDate");',
+                      queries)
+        self.assertIn('CREATE UNIQUE INDEX IF NOT EXISTS ph_activity_key ON '
+                      'ph ("ActivityIdentifier", "ActivityStartDate");',
+                      queries)
+        partitions = [x for x in queries
+                      if x.startswith('CREATE TABLE ph_2016')]
+        self.assertEquals(2, len(partitions))
+        copied = queries.index(
+            'INSERT INTO ph SELECT * FROM ph_unpartitioned;')
+        self.assertTrue(queries.index(partitions[-1]) < copied < queries.index(
+            'DROP TABLE ph_unpartitioned CASCADE;'))
+
+    @mock.patch('dataqs.helpers.postgres_query')
+    def test_retention_create_partition(self, query_mock):
+        """
+        Verify that rows already in the default partition are moved into
+        a new partition for their month
+        """
+        policy = self.processor.retention_policy('ph')
+        policy.partitioned = True
+        self.mock_database(query_mock, 'p', default_rows=True)
+        start = datetime.datetime(2016, 1, 1)
+        policy.create_partition(start, set())
+        queries = [call[0][0] for call in query_mock.call_args_list]
+        create = queries.index('CREATE TABLE ph_201601 PARTITION OF ph '
+                               'FOR VALUES FROM (%s) TO (%s);')
+        moved = queries.index(
+            'CREATE TEMP TABLE ph_201601_moved ON COMMIT DROP AS SELECT * '
+            'FROM ph_default WHERE "ActivityStartDate" >= %s AND '
+            '"ActivityStartDate" < %s;')
+        deleted = queries.index(
+            'DELETE FROM ph_default WHERE "ActivityStartDate" >= %s AND '
+            '"ActivityStartDate" < %s;')
+        inserted = queries.index(
+            'INSERT INTO ph SELECT * FROM ph_201601_moved;')
+        self.assertTrue(moved < deleted < create < inserted)
+        self.assertEquals(
+            (start, datetime.datetime(2016, 2, 1)),
+            query_mock.call_args_list[create][1]['params'])
+
+    @mock.patch('dataqs.helpers.postgres_query')
+    def test_retention_prepare(self, query_mock):
+        """
+        Verify that prepare() adds missing indexes and partitions through
+        next month to a partitioned table, skipping existing ones
+        """
+        policy = self.processor.retention_policy('ph')
+        policy.partitioned = True
+        now = datetime.datetime.utcnow()
+        current = policy.partition_name(policy.partition_start(now))
+        self.mock_database(query_mock, 'p', partitions=[current])
+        policy.prepare()
+        queries = [call[0][0] for call in query_mock.call_args_list]
+        self.assertIn('CREATE UNIQUE INDEX IF NOT EXISTS ph_activity_key ON '
+                      'ph ("ActivityIdentifier", "ActivityStartDate");',
+                      queries)
+        created = [x.split()[2] for x in queries
+                   if x.startswith('CREATE TABLE ph_') and
+                   'PARTITION OF ph FOR VALUES' in x]
+        self.assertNotIn(current, created)
+        self.assertIn(policy.partition_name(policy.next_start(
+            policy.partition_start(now))), created)
+        self.assertFalse([x for x in queries if 'RENAME' in x])
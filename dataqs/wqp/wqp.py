@@ -23,11 +23,15 @@ import logging
 import os
 import datetime
 import re
+import shutil
 import traceback
+from multiprocessing.pool import ThreadPool
+from zipfile import ZipFile
 
-import requests
 from dataqs.helpers import postgres_query, ogr2ogr_exec, \
-    table_exists, purge_old_data, layer_exists, style_exists
+    table_exists, RetentionPolicy, layer_exists, style_exists, \
+    postgres_transaction
+from dataqs.http_helpers import stream_download
 from dataqs.processor_base import GeoDataProcessor, DEFAULT_WORKSPACE
 import unicodecsv as csv
 from geonode.geoserver.helpers import ogc_server_settings
@@ -35,6 +39,26 @@ from geonode.geoserver.helpers import ogc_server_settings
 logger = logging.getLogger("dataqs.processors")
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
+WQP_STAGING_SQL = u"""
+CREATE TEMPORARY TABLE "{staging}"
+(
+  dataqs_row serial,
+  {columns}
+)
+ON COMMIT DROP;
+"""
+
+WQP_MERGE_SQL = u"""
+INSERT INTO "{table}" ({columns})
+SELECT {values} FROM (
+  SELECT DISTINCT ON ("ActivityIdentifier") * FROM "{staging}"
+  WHERE COALESCE("ActivityIdentifier", '') <> ''
+  ORDER BY "ActivityIdentifier", dataqs_row
+) s
+LEFT JOIN "{table}" i ON i."ActivityIdentifier" = s."ActivityIdentifier"
+WHERE i."ActivityIdentifier" IS NULL;
+"""
+
 
 class WaterQualityPortalProcessor(GeoDataProcessor):
     """
@@ -69,6 +93,11 @@ Commonwealth of the Northern Mariana Islands.\n\nUSEPA STORET - A data warehouse
 agencies, EPA, other federal agencies, universities, private citizens, and
 others.\n\nSource: http://www.waterqualitydata.us"""
     skip_errors = True
+    bulk_load = True
+    zip_download = False
+    pool_size = 4
+    date_cols = ("ActivityStartDate", "ActivityEndDate")
+    partition_interval = 'month'
 
     def __init__(self, *args, **kwargs):
         super(WaterQualityPortalProcessor, self).__init__(*args, **kwargs)
@@ -76,6 +105,12 @@ others.\n\nSource: http://www.waterqualitydata.us"""
             self.indicators = kwargs['indicators']
         if 'days_to_keep' in kwargs.keys():
             self.days_to_keep = kwargs['days_to_keep']
+        if 'bulk_load' in kwargs.keys():
+            self.bulk_load = kwargs['bulk_load']
+        if 'zip_download' in kwargs.keys():
+            self.zip_download = kwargs['zip_download']
+        if 'pool_size' in kwargs.keys():
+            self.pool_size = kwargs['pool_size']
 
     def update_station_table(self, csvfile):
         """
@@ -134,11 +169,102 @@ others.\n\nSource: http://www.waterqualitydata.us"""
         :param csvfile: CSV file containing measurement data
         :return: None
         """
-        date_cols = ("ActivityStartDate", "ActivityEndDate")
         indicator = csvfile.replace('_Result.csv', '')
         if not table_exists(indicator):
             self.create_indicator_table(indicator)
-        with open(os.path.join(self.tmp_dir, csvfile), 'r') as csvin:
+        self.retention_policy(indicator).prepare()
+        if self.bulk_load:
+            try:
+                self.copy_indicator_rows(indicator, csvfile)
+            except Exception as e:
+                logger.error("Bulk load of {} failed".format(csvfile))
+                logger.error(traceback.format_exc())
+                if not self.skip_errors:
+                    raise e
+                self.insert_indicator_rows(indicator, csvfile)
+        else:
+            self.insert_indicator_rows(indicator, csvfile)
+        self.update_indicator_view(indicator)
+
+    def copy_indicator_rows(self, indicator, csvfile):
+        """
+        Bulk load measurement data: COPY the csv file into a temporary
+        staging table, normalize the date/time/zone columns in SQL, and
+        merge activities not already in the indicator table with a single
+        anti-join INSERT.
+        :param indicator: indicator table name
+        :param csvfile: CSV file containing measurement data
+        :return: number of rows inserted
+        """
+        csvpath = os.path.join(self.tmp_dir, csvfile)
+        with open(csvpath, 'r') as csvin:
+            headers = [x.replace('/', '_') for x in csv.reader(csvin).next()]
+        staging = '{}_staging'.format(indicator)
+        with postgres_transaction() as transaction:
+            column_types = dict(postgres_query(
+                'SELECT column_name, data_type FROM ' +
+                'information_schema.columns WHERE table_name = %s;',
+                params=(indicator,), returnable=True))
+            postgres_query(WQP_STAGING_SQL.format(
+                staging=staging,
+                columns=','.join('"{}" text'.format(x) for x in headers)))
+            with open(csvpath, 'rb') as csvin:
+                transaction.cursor.copy_expert(
+                    'COPY "{}" ({}) FROM STDIN WITH CSV HEADER;'.format(
+                        staging, ','.join('"{}"'.format(x) for x in headers)),
+                    csvin)
+            postgres_query('ANALYZE "{}";'.format(staging))
+            columns = [x for x in headers if x in column_types]
+            skipped = set(headers) - set(columns)
+            if skipped:
+                logger.warn("Ignoring unknown columns in {}: {}".format(
+                    csvfile, ', '.join(skipped)))
+            postgres_query(WQP_MERGE_SQL.format(
+                table=indicator,
+                staging=staging,
+                columns=','.join('"{}"'.format(x) for x in columns),
+                values=','.join(
+                    self.staging_value(x, headers, column_types[x])
+                    for x in columns)))
+            inserted = transaction.cursor.rowcount
+        logger.debug("Inserted {} rows into {}".format(inserted, indicator))
+        return inserted
+
+    def staging_value(self, column, headers, data_type):
+        """
+        SQL expression converting a text column of the staging table
+        into the indicator table column type.  Date columns are combined
+        with their time and time zone columns, and empty, '.' or 'None'
+        values become NULL.
+        :param column: column name
+        :param headers: all column names in the staging table
+        :param data_type: PostgreSQL type of the indicator table column
+        :return: SQL expression
+        """
+        if column in self.date_cols:
+            parts = ['s."{}"'.format(column)]
+            for suffix in ('_Time', '_TimeZoneCode'):
+                part = column.replace('Date', 'Time') + suffix
+                if part in headers:
+                    parts.append('NULLIF(s."{}", \'\')'.format(part))
+            expr = 'CASE WHEN COALESCE(s."{col}", \'\') = \'\' ' \
+                   'THEN NULL ELSE concat_ws(\' \', {parts}) END'.format(
+                       col=column, parts=', '.join(parts))
+        else:
+            expr = 'NULLIF(NULLIF(NULLIF(s."{}", \'\'), \'.\'), ' \
+                   '\'None\')'.format(column)
+        return '({})::{}'.format(expr, data_type)
+
+    def insert_indicator_rows(self, indicator, csvfile):
+        """
+        Insert measurement data one row at a time, skipping (and logging)
+        rows that fail if skip_errors is True.
+        :param indicator: indicator table name
+        :param csvfile: CSV file containing measurement data
+        :return: None
+        """
+        with open(os.path.join(self.tmp_dir, csvfile), 'r') as csvin, \
+                postgres_transaction(savepoints=self.skip_errors):
             csvreader = csv.reader(csvin)
             headers = None
             for row in csvreader:
@@ -154,7 +280,7 @@ others.\n\nSource: http://www.waterqualitydata.us"""
                         attribute = headers[i].strip('"')
                         id_idx = headers.index('"ActivityIdentifier"')
                         query_format.append("%s")
-                        if attribute in date_cols and val:
+                        if attribute in self.date_cols and val:
                             time_idx = headers.index(
                                 '"{}_Time"'.format(
                                     attribute.replace("Date", "Time")))
@@ -173,15 +299,37 @@ others.\n\nSource: http://www.waterqualitydata.us"""
                         '{} WHERE "ActivityIdentifier" = \'{}\');'.format(
                             indicator, re.sub('\'{1}', '\'\'', row[id_idx]))
                     try:
-                        postgres_query(
-                            insert_sql, params=tuple(row), commit=True)
+                        postgres_query(insert_sql, params=tuple(row))
                     except Exception as e:
                         logger.error("The query failed: {} with parameters: {}".
                                      format(insert_sql, row))
                         logger.error(traceback.format_exc())
                         if not self.skip_errors:
                             raise e
-        purge_old_data(indicator, date_cols[0], self.days_to_keep)
+
+    def retention_policy(self, indicator):
+        """
+        Measurements are kept for days_to_keep days after their start date,
+        in monthly partitions if DB_PARTITIONING is enabled.  Partitioned
+        tables replace the ActivityIdentifier primary key with a unique
+        index on ActivityIdentifier and the start date, the partition key.
+        :param indicator: indicator table name
+        :return: RetentionPolicy
+        """
+        return RetentionPolicy(
+            indicator, self.date_cols[0], self.days_to_keep,
+            interval=self.partition_interval,
+            unique={'activity_key': '("ActivityIdentifier", "{}")'.format(
+                self.date_cols[0])})
+
+    def update_indicator_view(self, indicator):
+        """
+        Remove old measurements and create the map view joining
+        measurements to stations if it does not exist yet.
+        :param indicator: indicator table name
+        :return: None
+        """
+        self.retention_policy(indicator).enforce()
         if not table_exists(indicator + self.suffix):
             view_sql = 'CREATE OR REPLACE VIEW ' + indicator + self.suffix + \
                 ' AS SELECT i.*, g.wkb_geometry from ' + indicator + ' i ' + \
@@ -189,7 +337,11 @@ others.\n\nSource: http://www.waterqualitydata.us"""
                 ' i."MonitoringLocationIdentifier" = ' + \
                 ' g.monitoringlocationidentifier;'
             postgres_query(view_sql, commit=True)
-            self.post_geoserver_vector(indicator + self.suffix)
+            # The view is recreated after its table has been partitioned
+            if not layer_exists(indicator + self.suffix,
+                                ogc_server_settings.server.get('DATASTORE'),
+                                DEFAULT_WORKSPACE):
+                self.post_geoserver_vector(indicator + self.suffix)
 
     def safe_name(self, indicator):
         """
@@ -199,10 +351,24 @@ others.\n\nSource: http://www.waterqualitydata.us"""
         """
         return re.sub('[\(\),]', '', indicator).lower().replace(' ', '')
 
+    def unzip_csv(self, zipfile, outfile):
+        """
+        Extract the csv file from a zipped WQP response without reading it
+        fully into memory, then remove the zip file
+        :param zipfile: Full path of the zip file
+        :param outfile: Full path of the csv file to create
+        :return: None
+        """
+        with ZipFile(zipfile) as zf:
+            member = zf.namelist()[0]
+            with zf.open(member) as src, open(outfile, 'wb') as dst:
+                shutil.copyfileobj(src, dst, self.chunk_size)
+        os.remove(zipfile)
+
     def download(self, indicator):
         """
-        Download separate CSV's for each water quality indicator.
-        Use multiprocessing to download asynchrously.
+        Download separate CSV's for each water quality indicator,
+        streaming each response to disk.
         :param days:
         :return: dict of csv files
         """
@@ -219,54 +385,90 @@ others.\n\nSource: http://www.waterqualitydata.us"""
                 end=today.strftime('%m-%d-%Y'),
                 indicator=indicator)
 
-            r = requests.get(indicator_url,
-                             timeout=120, stream=True, verify=False)
-            r.raise_for_status()
             outname = "{}{}_{}.csv".format(
                 self.prefix, self.safe_name(indicator), query_type)
             outfile = os.path.join(self.tmp_dir, outname)
-
-            with open(outfile, 'w') as outcsv:
-                outcsv.write(r.content)
-
+            if self.zip_download:
+                zipfile = outfile.replace('.csv', '.zip')
+                stream_download(indicator_url + '&zip=yes', zipfile,
+                                chunk_size=self.chunk_size,
+                                attempts=self.download_attempts,
+                                timeout=120, verify=False)
+                self.unzip_csv(zipfile, outfile)
+            else:
+                stream_download(indicator_url, outfile,
+                                chunk_size=self.chunk_size,
+                                attempts=self.download_attempts,
+                                timeout=120, verify=False)
             csvs[query_type] = outname
         return csvs
 
+    def safe_download(self, indicator):
+        """
+        Download the csv files for an indicator, logging instead of raising
+        errors so that a failed download does not stop the others.
+        :param indicator: water quality indicator
+        :return: tuple of indicator and dict of csv files (None on failure)
+        """
+        try:
+            return indicator, self.download(indicator)
+        except Exception:
+            logger.error('Error downloading {}'.format(indicator))
+            logger.error(traceback.format_exc())
+            return indicator, None
+
+    def process_indicator(self, indicator, csv_dict):
+        """
+        Load downloaded station and measurement data for an indicator
+        into the database and publish the indicator layer.
+        :param indicator: water quality indicator
+        :param csv_dict: dict of csv files returned by download()
+        :return: None
+        """
+        station_csv = csv_dict['Station']
+        if os.path.getsize(os.path.join(self.tmp_dir, station_csv)) > 0:
+            self.update_station_table(station_csv)
+        result_csv = csv_dict['Result']
+        datastore = ogc_server_settings.server.get('DATASTORE')
+        if os.path.getsize(os.path.join(self.tmp_dir, result_csv)) > 0:
+            self.update_indicator_table(result_csv)
+            layer_name = '{}{}{}'.format(self.prefix,
+                                         self.safe_name(indicator),
+                                         self.suffix)
+            layer_title = 'Water Quality - {} - Updated {}'.format(
+                indicator, datetime.datetime.now().strftime('%Y-%m-%d'))
+            if not layer_exists(layer_name,
+                                datastore,
+                                DEFAULT_WORKSPACE):
+                self.post_geoserver_vector(layer_name)
+            if not style_exists(layer_name):
+                with open(os.path.join(
+                        script_dir,
+                        'resources/{}.sld'.format(layer_name))) as sld:
+                    self.set_default_style(layer_name, layer_name,
+                                           sld.read())
+            self.update_geonode(layer_name,
+                                title=layer_title,
+                                description=self.description,
+                                store=datastore,
+                                extra_keywords=['category:Water Quality'])
+            self.truncate_gs_cache(layer_name)
+
     def run(self):
         """
-        Run the processor
+        Run the processor.  All indicators are downloaded in parallel, and
+        each one is loaded and published as soon as its download finishes.
         :return: None
         """
-        for indicator in self.indicators:
-            csv_dict = self.download(indicator)
-            station_csv = csv_dict['Station']
-            if os.path.getsize(os.path.join(self.tmp_dir, station_csv)) > 0:
-                self.update_station_table(station_csv)
-            result_csv = csv_dict['Result']
-            datastore = ogc_server_settings.server.get('DATASTORE')
-            if os.path.getsize(os.path.join(self.tmp_dir, result_csv)) > 0:
-                self.update_indicator_table(result_csv)
-                layer_name = '{}{}{}'.format(self.prefix,
-                                             self.safe_name(indicator),
-                                             self.suffix)
-                layer_title = 'Water Quality - {} - Updated {}'.format(
-                    indicator, datetime.datetime.now().strftime('%Y-%m-%d'))
-                if not layer_exists(layer_name,
-                                    datastore,
-                                    DEFAULT_WORKSPACE):
-                    self.post_geoserver_vector(layer_name)
-                if not style_exists(layer_name):
-                    with open(os.path.join(
-                            script_dir,
-                            'resources/{}.sld'.format(layer_name))) as sld:
-                        self.set_default_style(layer_name, layer_name,
-                                               sld.read())
-                self.update_geonode(layer_name,
-                                    title=layer_title,
-                                    description=self.description,
-                                    store=datastore,
-                                    extra_keywords=['category:Water Quality'])
-                self.truncate_gs_cache(layer_name)
+        pool = ThreadPool(max(1, min(self.pool_size, len(self.indicators))))
+        try:
+            for indicator, csv_dict in pool.imap_unordered(
+                    self.safe_download, self.indicators):
+                if csv_dict:
+                    self.process_indicator(indicator, csv_dict)
+        finally:
+            pool.close()
+            pool.join()
         self.cleanup()
 
 
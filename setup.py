@@ -40,6 +40,8 @@ setup(
         'unicodecsv',
         'shapely',
         'pymongo',
+        'lxml',
+        'ijson==2.6.1',
         'numpy',
         'rasterio==0.31.0',
         'gdal==2.1.0'